@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+'''
+    benchmarks.hot_paths
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Benchmarks of minimongo hot paths. Each one is a function, which
+    prepares whatever is needed and returns a callable to time. Database
+    access is stubbed out, so only minimongo's own overhead is measured.
+'''
+import copy
+import datetime
+from collections import deque
+
+from bson import ObjectId
+
+from minimongo import IdentityMap, Model
+from minimongo.collection import Collection, DecodedDocument
+from minimongo.model import AttrDict, to_underscore
+
+#: ``(name, setup)`` pairs, in the order they are defined.
+benchmarks = []
+
+
+def benchmark(setup):
+    benchmarks.append((setup.__name__, setup))
+    return setup
+
+
+FLAT = dict(('field_%d' % idx, idx) for idx in range(20))
+FLAT['name'] = u'Some Name'
+FLAT['created'] = datetime.datetime(2015, 1, 1)
+
+NESTED = {
+    'name': u'Some Name',
+    'address': {'street': u'Main St', 'city': u'Springfield',
+                'geo': {'lat': 1.0, 'lng': 2.0}},
+    'tags': ['a', 'b', 'c'],
+    'orders': [{'id': idx, 'items': [{'sku': 'x%d' % idx, 'qty': 1}]}
+               for idx in range(5)],
+}
+
+# Documents, which are returned by cursors; their values are scalars, so
+# that wrapping them doesn't change anything, shared between copies.
+ROW = dict(FLAT, tags=['a', 'b'])
+
+
+class _StubCollection(Collection):
+    """A collection, which "finds" a copy of the same document."""
+
+    def _fetch_one(self, spec_or_id, *args, **kwargs):
+        return DecodedDocument(ROW, _id=spec_or_id)
+
+
+class BenchmarkModel(Model):
+    class Meta:
+        database = 'minimongo_benchmarks'
+        collection = 'benchmark'
+        collection_class = _StubCollection
+
+
+class TrackedBenchmarkModel(Model):
+    class Meta:
+        database = 'minimongo_benchmarks'
+        collection = 'benchmark_tracked'
+        track_changes = True
+
+
+class LazyBenchmarkModel(Model):
+    class Meta:
+        database = 'minimongo_benchmarks'
+        collection = 'benchmark_lazy'
+        lazy_nested = True
+
+
+class MappedBenchmarkModel(Model):
+    class Meta:
+        database = 'minimongo_benchmarks'
+        collection = 'benchmark_mapped'
+        field_map = (
+            (('address', dict), AttrDict),
+            (datetime.datetime, lambda value: value.date()),
+            (lambda key, value: key == 'score', str),
+        )
+
+
+@benchmark
+def attrdict_flat():
+    return lambda: AttrDict(FLAT)
+
+
+@benchmark
+def attrdict_nested():
+    return lambda: AttrDict(NESTED)
+
+
+@benchmark
+def model_nested():
+    return lambda: BenchmarkModel(NESTED)
+
+
+@benchmark
+def model_nested_lazy():
+    return lambda: LazyBenchmarkModel(NESTED)
+
+
+@benchmark
+def model_setitem():
+    model = BenchmarkModel()
+
+    def setitem():
+        model['name'] = u'Other Name'
+        model['count'] = 1
+        model['created'] = FLAT['created']
+    return setitem
+
+
+@benchmark
+def model_setitem_field_map():
+    model = MappedBenchmarkModel()
+
+    def setitem():
+        model['name'] = u'Other Name'
+        model['count'] = 1
+        model['created'] = FLAT['created']
+    return setitem
+
+
+@benchmark
+def cursor_next():
+    """Wraps 100 documents, as if they were received from the server."""
+    rows = [ROW] * 100
+    collection = BenchmarkModel.collection
+
+    def iterate():
+        cursor = collection.find()
+        # A cursor with data, which has nothing left to fetch.
+        cursor._Cursor__data = deque(DecodedDocument(row) for row in rows)
+        cursor._Cursor__id = 0
+        for _ in cursor:
+            pass
+    return iterate
+
+
+@benchmark
+def collection_find_one():
+    _id = ObjectId()
+    return lambda: BenchmarkModel.collection.find_one(_id)
+
+
+@benchmark
+def collection_find_one_identity_map():
+    _id = ObjectId()
+    documents = IdentityMap()
+    documents.add(BenchmarkModel.collection.find_one(_id))
+
+    def find_one():
+        with documents:
+            BenchmarkModel.collection.find_one(_id)
+    return find_one
+
+
+@benchmark
+def mongo_update_payload():
+    """Builds an update document for a few changes of a loaded model."""
+    model = TrackedBenchmarkModel(copy.deepcopy(NESTED), _id=ObjectId())
+    model._mark_clean()
+    model.name = u'Other Name'
+    model.address.geo.lat = 3.0
+    del model.address.city
+    model.tags
+    assert model._get_update_document() == {
+        '$set': {'name': u'Other Name', 'address.geo.lat': 3.0},
+        '$unset': {'address.city': 1}}
+    return model._get_update_document
+
+
+@benchmark
+def underscore():
+    return lambda: to_underscore('SomeHTTPRequestModel')
@@ -0,0 +1,151 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+    benchmarks.run
+    ~~~~~~~~~~~~~~
+
+    Measures the overhead minimongo itself adds to hot paths, without a
+    MongoDB server, and writes the results as JSON, so that runs of
+    different commits can be compared::
+
+        $ python benchmarks/run.py -o before.json
+        $ git checkout some-branch
+        $ python benchmarks/run.py -o after.json --compare before.json
+
+    With ``--compare``, the exit status is 1 if any benchmark got slower
+    than ``--threshold`` allows.
+'''
+import argparse
+import fnmatch
+import json
+import os
+import platform
+import subprocess
+import sys
+import timeit
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+
+import pymongo
+
+import hot_paths
+
+
+def measure(func, repeat=5, min_time=0.2):
+    """Times calls of a given `func`, returns a dict with the ``best``
+    and ``median`` time of a single call, in seconds, and the number of
+    ``loops`` of each of the `repeat` measurements, which is picked so
+    that every one of them takes about `min_time` seconds."""
+    timer = timeit.Timer(func)
+    loops = 1
+    while True:
+        elapsed = timer.timeit(loops)
+        if elapsed >= min_time / 10:
+            break
+        loops *= 10
+    loops = max(1, int(loops * min_time / elapsed))
+
+    times = sorted(elapsed / loops for elapsed in timer.repeat(repeat, loops))
+    return {'best': times[0],
+            'median': times[len(times) // 2],
+            'loops': loops,
+            'repeat': repeat}
+
+
+def run(pattern='*', repeat=5, min_time=0.2):
+    """Runs the benchmarks, which names match a given glob `pattern`,
+    returns their results by name."""
+    results = {}
+    for name, setup in hot_paths.benchmarks:
+        if fnmatch.fnmatch(name, pattern):
+            results[name] = measure(setup(), repeat, min_time)
+    return results
+
+
+def environment():
+    """Returns a dict, which describes what's been measured."""
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=here,
+            stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit,
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'pymongo': pymongo.version,
+            'platform': platform.platform()}
+
+
+def compare(results, baseline, threshold):
+    """Returns lines of a table, which compares the best times of
+    `results` with the ones of a `baseline`, and a list of the names of
+    the benchmarks, which are more than `threshold` (a fraction) slower.
+    """
+    lines, regressions = [], []
+    for name in sorted(results):
+        best = results[name]['best']
+        if name not in baseline:
+            lines.append('%-32s %12s %12.3f %8s' % (name, '-', best * 1e6,
+                                                    'new'))
+            continue
+        old = baseline[name]['best']
+        change = best / old - 1
+        if change > threshold:
+            regressions.append(name)
+        lines.append('%-32s %12.3f %12.3f %+7.1f%%%s' % (
+            name, old * 1e6, best * 1e6, change * 100,
+            ' !' if name in regressions else ''))
+    return lines, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Microbenchmarks of minimongo hot paths.')
+    parser.add_argument('-k', dest='pattern', default='*',
+                        help='run the benchmarks matching a glob pattern')
+    parser.add_argument('-o', '--output',
+                        help='write JSON results to a file, "-" for stdout')
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help='compare with JSON results of an earlier run')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='slowdown considered a regression, '
+                             'default: 0.1 (10%%)')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='measurements per benchmark, default: 5')
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help='seconds per measurement, default: 0.2')
+    args = parser.parse_args(argv)
+
+    results = run(args.pattern, args.repeat, args.min_time)
+    report = {'environment': environment(), 'benchmarks': results}
+    if args.output == '-':
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+        out = sys.stderr
+    else:
+        if args.output:
+            with open(args.output, 'w') as output:
+                json.dump(report, output, indent=2, sort_keys=True)
+        out = sys.stdout
+
+    if args.compare:
+        with open(args.compare) as baseline:
+            baseline = json.load(baseline)
+        lines, regressions = compare(results, baseline['benchmarks'],
+                                     args.threshold)
+        out.write('%-32s %12s %12s %8s\n' % ('benchmark', 'before, us',
+                                             'after, us', 'change'))
+    else:
+        lines, regressions = ['%-32s %12.3f %12.3f' % (
+            name, results[name]['best'] * 1e6, results[name]['median'] * 1e6)
+            for name in sorted(results)], []
+        out.write('%-32s %12s %12s\n' % ('benchmark', 'best, us',
+                                         'median, us'))
+    out.write('\n'.join(lines) + '\n')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
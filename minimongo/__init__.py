@@ -7,10 +7,16 @@
     interface to MongoDB.
 '''
 from minimongo.index import Index
+from minimongo.cache import QueryCache
 from minimongo.collection import Collection
-from minimongo.model import Model, AttrDict
+from minimongo.identity import IdentityMap
+from minimongo.model import Model, AttrDict, LazyAttrDict, CompactRecord, \
+    dereference, ensure_indices
 from minimongo.options import configure
+from minimongo.writebehind import WriteBehind
 
-__all__ = ('Collection', 'Index', 'Model', 'configure', 'AttrDict')
+__all__ = ('Collection', 'Index', 'Model', 'configure', 'AttrDict',
+           'LazyAttrDict', 'CompactRecord', 'IdentityMap', 'QueryCache',
+           'WriteBehind', 'dereference', 'ensure_indices')
 
 
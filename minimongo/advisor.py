@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+'''
+    minimongo.advisor
+    ~~~~~~~~~~~~~~~~~
+
+    Recording of query shapes of the models with ``record_queries``
+    option set, and index suggestions based on them.
+'''
+import threading
+
+# Operators, which match values exactly, as far as indices are concerned.
+EQUALITY_OPERATORS = frozenset(['$eq', '$in', '$all'])
+
+
+class QueryRecorder(object):
+    """Counts queries and their total duration by model, operation and
+    query shape, that is: fields matched exactly, sort order and fields
+    matched in any other way, ex: by range.
+    """
+
+    def __init__(self):
+        self._shapes = {}
+        self._lock = threading.Lock()
+
+    def record(self, model, operation, spec, sort, duration):
+        """Records a query with a given `spec` and `sort` order, which
+        took `duration` seconds."""
+        key = (model, operation) + query_shape(spec, sort)
+        with self._lock:
+            count, total = self._shapes.get(key, (0, 0.0))
+            self._shapes[key] = count + 1, total + duration
+
+    def shapes(self, model=None):
+        """Returns a list of recorded query shapes of a given `model` (or
+        all of them), as dicts with ``model``, ``operation``,
+        ``equality``, ``sort``, ``range``, ``count`` and ``time`` keys,
+        most frequent first."""
+        with self._lock:
+            items = self._shapes.items()
+
+        shapes = [{'model': key[0], 'operation': key[1],
+                   'equality': key[2], 'sort': key[3], 'range': key[4],
+                   'count': count, 'time': total}
+                  for key, (count, total) in items
+                  if model is None or key[0] is model]
+        shapes.sort(key=lambda shape: (-shape['count'], -shape['time']))
+        return shapes
+
+    def clear(self):
+        with self._lock:
+            self._shapes.clear()
+
+
+#: Queries of all of the models with ``record_queries`` option set.
+recorder = QueryRecorder()
+
+
+def query_shape(spec, sort=None):
+    """Returns a tuple of fields a given query `spec` matches exactly,
+    ``(field, direction)`` pairs of a given `sort` order and fields
+    matched in any other way.
+
+    >>> query_shape({'a': 1, 'b': {'$gt': 1}}, [('c', -1)])
+    (('a',), (('c', -1),), ('b',))
+    """
+    equality, ranges = set(), set()
+    _collect_fields(spec, equality, ranges)
+    sort = tuple((field, direction) for field, direction in (
+        sort.items() if isinstance(sort, dict) else sort or ()))
+    return tuple(sorted(equality)), sort, tuple(sorted(ranges - equality))
+
+
+def _collect_fields(spec, equality, ranges):
+    if not isinstance(spec, dict):
+        if spec is not None:
+            equality.add('_id')  # find_one(some_id)
+        return
+
+    for key, value in spec.iteritems():
+        if key == '$and':
+            for nested in value:
+                _collect_fields(nested, equality, ranges)
+        elif key.startswith('$'):
+            continue  # $or, $where and the like can't use a single index.
+        elif isinstance(value, dict) and value and \
+                all(operator.startswith('$') for operator in value):
+            if EQUALITY_OPERATORS.issuperset(value):
+                equality.add(key)
+            else:
+                ranges.add(key)
+        else:
+            equality.add(key)
+
+
+def advise(models, recorder=recorder):
+    """Compares recorded query shapes of given `models` with indices,
+    declared in their ``Meta``, and returns a dict with:
+
+    * ``missing`` -- a list of ``(model, keys, shape)`` tuples for the
+      queries no index can serve, where ``keys`` is a suggested compound
+      index: fields matched exactly, then sort order, then the rest;
+    * ``unused`` -- a list of ``(model, index)`` pairs of declared
+      indices, none of the queries of a model would use.
+
+    Models without recorded queries are skipped.
+    """
+    missing, unused = [], []
+    for model in models:
+        shapes = recorder.shapes(model)
+        if not shapes:
+            continue
+
+        declared = [(index, index.document()['key'].items())
+                    for index in model._meta.indices]
+        indexed = [keys for _, keys in declared] + [[('_id', 1)]]
+        suggested = set()
+        for shape in shapes:
+            if not (shape['equality'] or shape['sort'] or shape['range']):
+                continue  # Nothing to index.
+            if any(_covers(keys, shape) for keys in indexed):
+                continue
+
+            keys = tuple([(field, 1) for field in shape['equality']] +
+                         list(shape['sort']) +
+                         [(field, 1) for field in shape['range']])
+            if keys not in suggested:
+                suggested.add(keys)
+                missing.append((model, list(keys), shape))
+
+        for index, keys in declared:
+            if not any(_uses(keys, shape) for shape in shapes):
+                unused.append((model, index))
+
+    return {'missing': missing, 'unused': unused}
+
+
+def report(models, recorder=recorder):
+    """Returns :func:`advise` results as human readable text."""
+    advice = advise(models, recorder)
+    lines = []
+    for model, keys, shape in advice['missing']:
+        lines.append('%s: missing index %r for %d %s queries (%.3fs)' % (
+            model.__name__, keys, shape['count'], shape['operation'],
+            shape['time']))
+    for model, index in advice['unused']:
+        lines.append('%s: unused index %r' % (
+            model.__name__, index.document()['key'].items()))
+    return '\n'.join(lines)
+
+
+def _covers(keys, shape):
+    """Checks whether an index with given `keys` can serve a query of a
+    given `shape`, without scanning or sorting in memory."""
+    fields = [field for field, _ in keys]
+    equality = shape['equality']
+    if set(fields[:len(equality)]) != set(equality):
+        return False
+
+    rest, sort = keys[len(equality):], list(shape['sort'])
+    if sort:
+        head = rest[:len(sort)]
+        inverted = [(field, -direction) for field, direction in sort]
+        if head != sort and head != inverted:
+            return False
+        rest = rest[len(sort):]
+
+    if not (equality or sort):
+        return bool(rest) and rest[0][0] in shape['range']
+    return True
+
+
+def _uses(keys, shape):
+    """Checks whether a query of a given `shape` would use an index with
+    given `keys`, even partially."""
+    field = keys[0][0]
+    return (_covers(keys, shape) or field in shape['equality'] or
+            field in shape['range'] or
+            bool(shape['sort']) and field == shape['sort'][0][0])
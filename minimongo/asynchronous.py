@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+'''
+    minimongo.asynchronous
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    Non-blocking models for Tornado applications, built on top of
+    `Motor <http://motor.readthedocs.org>`_, which has to be installed
+    separately.
+'''
+import logging
+
+import motor
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+from minimongo.collection import DecodedDocument, _wrap
+from minimongo.connections import ConnectionRegistry
+from minimongo.model import Model, ModelBase
+from minimongo.options import _Options
+
+logger = logging.getLogger('minimongo.asynchronous')
+
+
+class AsyncCursor(object):
+    """A wrapper of :class:`motor.MotorCursor`, which returns documents
+    wrapped into a given model class.
+
+    >>> cursor = SomeModel.collection.find({'x': 1}).sort('y')
+    >>> while (yield cursor.fetch_next):
+    ...     document = cursor.next_object()
+    """
+
+    # Cursor methods, which return the cursor itself.
+    _modifiers = frozenset(['add_option', 'batch_size', 'comment', 'hint',
+                            'limit', 'max_scan', 'max_time_ms',
+                            'remove_option', 'skip', 'sort', 'where'])
+
+    def __init__(self, delegate, document_class):
+        self.delegate = delegate
+        self.document_class = document_class
+
+    def __getattr__(self, attr):
+        method = getattr(self.delegate, attr)
+        if attr not in self._modifiers:
+            return method
+
+        def modifier(*args, **kwargs):
+            method(*args, **kwargs)
+            return self
+        return modifier
+
+    @property
+    def fetch_next(self):
+        """A future, which resolves to ``True`` if there's a document to
+        return from :meth:`next_object`, see
+        :attr:`motor.MotorCursor.fetch_next`."""
+        return self.delegate.fetch_next
+
+    def next_object(self):
+        """Returns the next prefetched document, or ``None``."""
+        data = self.delegate.next_object()
+        if data is None:
+            return None
+        return _wrap(self.document_class, data)
+
+    @gen.coroutine
+    def to_list(self, length):
+        """Same as :meth:`motor.MotorCursor.to_list`, except it returns
+        the right document class."""
+        documents = yield self.delegate.to_list(length)
+        raise gen.Return([_wrap(self.document_class, data)
+                          for data in documents])
+
+
+class AsyncCollection(object):
+    """A wrapper of :class:`motor.MotorCollection`, which returns
+    documents wrapped into :attr:`document_class`; all the other methods
+    are the ones of the underlying Motor collection.
+
+    .. note:: identity maps are thread-local, so they aren't consulted
+              by coroutines.
+    """
+
+    def __init__(self, database, name, document_class):
+        self.document_class = document_class
+        self.delegate = database[name]
+
+    def __getattr__(self, attr):
+        return getattr(self.delegate, attr)
+
+    def find(self, *args, **kwargs):
+        """Same as :meth:`motor.MotorCollection.find`, except it returns
+        the right document class.
+        """
+        self._set_document_class(kwargs)
+        return AsyncCursor(self.delegate.find(*args, **kwargs),
+                           self.document_class)
+
+    @gen.coroutine
+    def find_one(self, *args, **kwargs):
+        """Same as :meth:`motor.MotorCollection.find_one`, except it
+        returns the right document class.
+        """
+        self._set_document_class(kwargs)
+        data = yield self.delegate.find_one(*args, **kwargs)
+        raise gen.Return(data and _wrap(self.document_class, data))
+
+    def _set_document_class(self, kwargs):
+        if getattr(self.document_class, '_decode_in_place', False):
+            kwargs.setdefault('as_class', DecodedDocument)
+
+
+class _AsyncOptions(_Options):
+    # Options are still configured via _Options._configure(), only the
+    # default collection class differs.
+    collection_class = AsyncCollection
+
+
+class AsyncModelBase(ModelBase):
+    """Metaclass for asynchronous models; connections are pooled apart
+    from the ones of :class:`~minimongo.Model` subclasses."""
+
+    # Motor clients by MongoDB URIs and options.
+    _connections = ConnectionRegistry(motor.MotorClient)
+
+    # Asynchronous models by (database, collection) pairs.
+    _models = {}
+
+    _options_class = _AsyncOptions
+
+    _unindexed = set()
+
+    # Futures of the latest index builds by model.
+    _indexing = {}
+
+    def auto_index(mcs):
+        """Builds all indices, listed in model's Meta class; returns a
+        future, see :meth:`indexed`. Failures are logged, and unless
+        ``auto_index`` is ``False``, indices are built again once the
+        model is used next time."""
+        mcs._unindexed.discard(mcs)
+        future = mcs._indexing[mcs] = mcs._ensure_indices()
+        IOLoop.current().add_future(future, mcs._indices_built)
+        return future
+
+    def indexed(mcs):
+        """Returns a future, which resolves once the indices, built when
+        the model was first used, are ready, or fails if building them
+        did.
+
+        >>> yield SomeModel.indexed()
+        """
+        mcs._bind()
+        future = mcs._indexing.get(mcs)
+        if future is None:
+            future = Future()
+            future.set_result(None)
+        return future
+
+    @gen.coroutine
+    def _ensure_indices(mcs):
+        yield [index.ensure(mcs.collection) for index in mcs._meta.indices]
+
+    def _indices_built(mcs, future):
+        error = future.exception()
+        if error is None:
+            return
+        logger.error('Building indices of %s failed: %s', mcs.__name__,
+                     error)
+        if mcs._meta.auto_index:
+            mcs._unindexed.add(mcs)
+
+
+class AsyncModel(Model):
+    """Same as :class:`~minimongo.Model`, except the methods, which talk
+    to the database, return futures to be yielded from Tornado coroutines:
+
+    >>> @gen.coroutine
+    ... def handle(self, some_id):
+    ...     document = yield SomeModel.collection.find_one(some_id)
+    ...     document.x += 1
+    ...     yield document.save()
+
+    .. note:: indices, listed in ``class Meta``, are built once the IO
+              loop is started; ``yield SomeModel.indexed()`` waits for
+              them.
+    """
+    __metaclass__ = AsyncModelBase
+
+    class Meta:
+        interface = True
+
+    @gen.coroutine
+    def remove(self):
+        """Remove this object from the database."""
+        result = yield self.collection.remove(self._id)
+        self.__dict__.pop('_changes', None)
+        raise gen.Return(result)
+
+    @gen.coroutine
+    def mongo_update(self, values=None, **kwargs):
+        """Update database data with object data, see
+        :meth:`minimongo.Model.mongo_update`."""
+        tracked = not values
+        if tracked:
+            self._start_tracking()
+            values = self._get_update_document()
+            if not values:
+                raise gen.Return(self)  # Nothing to update.
+        yield self.collection.update({'_id': self._id}, values, **kwargs)
+
+        if tracked:
+            self._mark_clean()
+        raise gen.Return(self)
+
+    @gen.coroutine
+    def save(self, *args, **kwargs):
+        """Save this object to it's mongo collection, see
+        :meth:`minimongo.Model.save`."""
+        if kwargs.pop('partial', False):
+            self._start_tracking()
+            if self._changes is not None and '_id' in self:
+                result = yield self.mongo_update(**kwargs)
+                raise gen.Return(result)
+
+        yield self.collection.save(self, *args, **kwargs)
+        self._mark_clean()
+        raise gen.Return(self)
+
+    @gen.coroutine
+    def load(self, fields=None, **kwargs):
+        """Allow partial loading of a document, see
+        :meth:`minimongo.Model.load`."""
+        values = yield self.collection.find_one({'_id': self._id},
+                                                fields=fields, **kwargs)
+        self._update_loaded(values)
+        raise gen.Return(self)
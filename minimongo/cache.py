@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from collections import OrderedDict
+
+
+class QueryCache(object):
+    """An in-process cache of query results, with at most `max_entries`
+    entries, each expiring `ttl` seconds after it was stored. When the
+    cache is full, least recently used entries are evicted first. Results,
+    which take more than `max_result_size` bytes of BSON, aren't cached.
+
+    Any object with the same :meth:`get`, :meth:`set` and :meth:`clear`
+    methods can be used instead, see ``cache`` option of ``class Meta``;
+    unless it has :attr:`generation` as well, results of the queries, which
+    were running while the cache was cleared, may be cached.
+    """
+
+    def __init__(self, ttl=30, max_entries=10000, max_result_size=1 << 20,
+                 timer=time.time):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_result_size = max_result_size
+        #: Number of times the cache was cleared, see :meth:`set`.
+        self.generation = 0
+        self._timer = timer
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Returns a value stored under a given `key`, or ``None`` if
+        there's no such value or it has expired."""
+        with self._lock:
+            try:
+                expires, value = self._entries.pop(key)
+            except KeyError:
+                return None
+
+            if expires < self._timer():
+                return None
+
+            self._entries[key] = expires, value  # Most recently used.
+            return value
+
+    def set(self, key, value, generation=None):
+        """Stores a `value` under a given `key`, unless the cache was
+        cleared since a given `generation`, when the value was read."""
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return  # The value might be stale.
+            self._entries.pop(key, None)
+            self._entries[key] = self._timer() + self.ttl, value
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Removes all of the stored values."""
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
@@ -1,55 +1,289 @@
 # -*- coding: utf-8 -*-
+import base64
+import multiprocessing
+import sys
+import threading
+import time
+from Queue import Empty, Queue
+from contextlib import contextmanager
+from itertools import islice
 
+from bson import BSON, json_util
+from bson.errors import InvalidBSON
+from bson.son import SON
+from pymongo import ASCENDING, helpers
 from pymongo.collection import Collection as PyMongoCollection
 from pymongo.cursor import Cursor as PyMongoCursor
+from pymongo.errors import BulkWriteError, InvalidOperation, \
+    OperationFailure
+
+from minimongo import advisor, identity, metrics, slowlog
+
+
+class DecodedDocument(dict):
+    """A plain :class:`dict` subclass, which BSON documents are decoded
+    into, so that they can be turned into models in place, instead of
+    being copied."""
+
 
 class Cursor(PyMongoCursor):
 
+    #: Whether the cursor runs on behalf of :meth:`Collection.find_one`,
+    #: which times and caches the query by itself.
+    _single = False
+
     def __init__(self, *args, **kwargs):
         self._wrapper_class = kwargs.pop('wrap')
+        if getattr(self._wrapper_class, '_decode_in_place', False):
+            kwargs.setdefault('as_class', DecodedDocument)
+        self._as_class = kwargs.get('as_class') or dict
         super(Cursor, self).__init__(*args, **kwargs)
+        self._reset_cache_state()
 
     def next(self):
-        data = super(Cursor, self).next()
-        return self._wrapper_class(data)
+        if self.collection.cache is None or self._single:
+            data = super(Cursor, self).next()
+        else:
+            data = self._next_cached()
+        if self._wrapper_class is None:
+            return data
+        return _wrap(self._wrapper_class, data)
 
     def __getitem__(self, index):
         if isinstance(index, slice):
             return super(Cursor, self).__getitem__(index)
         else:
-            return self._wrapper_class(super(Cursor, self).__getitem__(index))
+            return _wrap(self._wrapper_class,
+                         super(Cursor, self).__getitem__(index))
 
+    def batches(self, size):
+        """Yields lists of at most `size` documents, wrapped into the right
+        document class, one server batch at a time.
 
-class Collection(PyMongoCollection):
-    """A wrapper around :class:`pymongo.collection.Collection` that
-    provides the same functionality, but stores the document class of
-    the collection we're working with. So that
-    :meth:`pymongo.collection.Collection.find` and
-    :meth:`pymongo.collection.Collection.find_one` can return the right
-    classes instead of plain :class:`dict`.
-    """
+        >>> for models in SomeModel.collection.find().batches(500):
+        ...     process(models)
+        """
+        if size < 1:
+            raise ValueError('Batch size must be positive, got %r' % size)
+
+        if self.collection.cache is not None:
+            # Query result cache is filled document by document.
+            batch = list(islice(self, size))
+            while batch:
+                yield batch
+                batch = list(islice(self, size))
+            return
+
+        try:
+            self.batch_size(size)
+        except InvalidOperation:
+            pass  # Already iterated, so the batch size stays as it is.
+
+        # Same as PyMongoCursor.next(), but a batch at a time.
+        database = self.collection.database
+        while not self._Cursor__empty and \
+                (self._Cursor__data or self._refresh()):
+            data = self._Cursor__data
+            batch = [data.popleft() for _ in xrange(min(size, len(data)))]
+            if self._Cursor__manipulate:
+                batch = [database._fix_outgoing(document, self.collection)
+                         for document in batch]
+            yield _wrap_many(self._wrapper_class, batch)
+
+    def compact(self):
+        """Makes the cursor return compact records instead of models, see
+        :class:`~minimongo.model.CompactRecord`; only available for models
+        with declared ``fields``."""
+        compact_class = getattr(self._wrapper_class, '_compact_class', None)
+        if compact_class is None:
+            raise ValueError('%r has no declared fields' % self._wrapper_class)
+        self._wrapper_class = compact_class
+        return self
+
+    def count(self, with_limit_and_skip=False):
+        cache = self.collection.cache
+        if cache is None or not _is_cacheable(self):
+            return super(Cursor, self).count(with_limit_and_skip)
+
+        key = 'count', _cache_key(self), with_limit_and_skip
+        count = cache.get(key)
+        if count is None:
+            generation = getattr(cache, 'generation', None)
+            count = super(Cursor, self).count(with_limit_and_skip)
+            _cache_set(cache, key, count, generation)
+        return count
+
+    def _refresh(self):
+        if self._Cursor__data or self._Cursor__killed or \
+           self._Cursor__id == 0:
+            return super(Cursor, self)._refresh()  # Nothing to fetch.
+
+        model = self.collection.document_class
+        if self._Cursor__id is not None:
+            with metrics.registry.timer(model, 'getmore') as timer:
+                timer.documents = super(Cursor, self)._refresh()
+            return timer.documents
+
+        # The query itself is sent on the first refresh.
+        operation = None if self._single else 'find'
+        with metrics.registry.timer(model, operation) as timer, \
+                self.collection._recording('find', self._Cursor__spec,
+                                           self._Cursor__ordering):
+            timer.documents = super(Cursor, self)._refresh()
+        slowlog.maybe_log(self, timer.duration)
+        return timer.documents
+
+    def rewind(self):
+        self._reset_cache_state()
+        return super(Cursor, self).rewind()
+
+    def _reset_cache_state(self):
+        self._cache_key = None
+        self._cached = None   # Iterator over the cached BSON documents.
+        self._fetched = None  # BSON documents fetched from the server.
+        self._fetched_size = 0
+        self._generation = None  # Of the cache, when the query was sent.
+
+    def _next_cached(self):
+        """Returns the next document from the query result cache, or from
+        the server, caching the whole result once it's exhausted."""
+        cache = self.collection.cache
+        if self._cache_key is None and _is_cacheable(self):
+            self._cache_key = 'find', _cache_key(self)
+            cached = cache.get(self._cache_key)
+            if cached is None:
+                self._fetched = []
+                self._generation = getattr(cache, 'generation', None)
+            else:
+                self._cached = iter(cached)
+
+        if self._cached is not None:
+            client = self.collection.database.connection
+            # Cached documents are immutable, so each of them is decoded
+            # again for every cursor.
+            return BSON(next(self._cached)).decode(
+                self._as_class, client.tz_aware, self.collection.uuid_subtype)
+
+        try:
+            data = super(Cursor, self).next()
+        except StopIteration:
+            if self._fetched is not None:
+                _cache_set(cache, self._cache_key, self._fetched,
+                           self._generation)
+                self._fetched = None
+            raise
+
+        if self._fetched is not None:
+            encoded = BSON.encode(data)
+            self._fetched_size += len(encoded)
+            if self._fetched_size > getattr(cache, 'max_result_size',
+                                            sys.maxint):
+                self._fetched = None  # Too large to be cached.
+            else:
+                self._fetched.append(encoded)
+        return data
+
+
+class _ModelCollection(object):
+    """Model-aware methods, shared by :class:`Collection` and
+    :class:`~minimongo.memory.MemoryCollection`; both of them implement
+    :meth:`find`, :meth:`_fetch_one` and :meth:`_decode_cached` for their
+    storage."""
 
     #: A reference to the model class, which uses this collection.
     document_class = None
 
-    def __init__(self, *args, **kwargs):
-        self.document_class = kwargs.pop('document_class')
-        super(Collection, self).__init__(*args, **kwargs)
+    @property
+    def cache(self):
+        """The query result cache of the model, see ``cache`` option of
+        ``class Meta``, or ``None``."""
+        meta = getattr(self.document_class, '_meta', None)
+        return meta.cache if meta is not None else None
 
-    def find(self, *args, **kwargs):
-        """Same as :meth:`pymongo.collection.Collection.find`, except
-        it returns the right document class.
-        """
-        return Cursor(self, *args, wrap=self.document_class, **kwargs)
+    def _invalidate_cache(self):
+        if self.cache is not None:
+            self.cache.clear()
+
+    @property
+    def record_queries(self):
+        """Whether query shapes are recorded, see ``record_queries``
+        option of ``class Meta``."""
+        meta = getattr(self.document_class, '_meta', None)
+        return meta is not None and meta.record_queries
+
+    @contextmanager
+    def _recording(self, operation, spec, sort=None):
+        """Records the shape of a query, made within the block, if the
+        model records queries, see :mod:`minimongo.advisor`."""
+        if not self.record_queries:
+            yield
+            return
+
+        started = time.time()
+        try:
+            yield
+        finally:
+            advisor.recorder.record(self.document_class, operation, spec,
+                                    sort, time.time() - started)
 
-    def find_one(self, *args, **kwargs):
+    def find_one(self, spec_or_id=None, *args, **kwargs):
         """Same as :meth:`pymongo.collection.Collection.find_one`, except
         it returns the right document class.
+
+        Within an :class:`~minimongo.identity.IdentityMap` scope, plain
+        lookups by ``_id`` return the same instance every time, without
+        querying the database again.
         """
-        data = super(Collection, self).find_one(*args, **kwargs)
-        if data:
-            return self.document_class(data)
-        return None
+        with metrics.registry.timer(self.document_class,
+                                    'find_one') as timer:
+            document = self._find_one(spec_or_id, *args, **kwargs)
+            timer.documents = int(document is not None)
+        return document
+
+    def _find_one(self, spec_or_id, *args, **kwargs):
+        documents = identity.current()
+        document_id = None
+        if documents is not None and not args and not kwargs:
+            document_id = _id_of(spec_or_id)
+            if document_id is not None:
+                document = documents.get(self.document_class, document_id)
+                if document is not None:
+                    return document
+
+        cache = self.cache
+        if cache is None:
+            data = self._fetch_one(spec_or_id, *args, **kwargs)
+        else:
+            data = self._fetch_one_cached(cache, spec_or_id, args, kwargs)
+        if data is None:
+            return None
+
+        document = _wrap(self.document_class, data)
+        if document_id is not None:
+            documents.add(document)
+        return document
+
+    def _fetch_one_cached(self, cache, spec_or_id, args, kwargs):
+        """Same as :meth:`_fetch_one`, but reads through the query result
+        cache; lookups, which found nothing, are cached as well."""
+        key = ('find_one', self.full_name, _freeze(spec_or_id),
+               _freeze(args), _freeze(kwargs))
+        cached = cache.get(key)
+        if cached is not None:
+            # Either a single BSON document, or none at all.
+            if not cached:
+                return None
+            as_class = kwargs.get('as_class') or \
+                _as_class(self.document_class)
+            return self._decode_cached(cached[0], as_class)
+
+        generation = getattr(cache, 'generation', None)
+        data = self._fetch_one(spec_or_id, *args, **kwargs)
+        cached = () if data is None else (BSON.encode(data), )
+        if sum(map(len, cached)) <= getattr(cache, 'max_result_size',
+                                            sys.maxint):
+            _cache_set(cache, key, cached, generation)
+        return data
 
     def from_dbref(self, dbref):
         """Given a :class:`pymongo.dbref.DBRef`, dereferences it and
@@ -59,14 +293,596 @@ class Collection(PyMongoCollection):
         .. note:: If a given `dbref` point to a different database and
                   / or collection, :exc:`ValueError` is raised.
         """
-        # Making sure a given DBRef points to a proper collection
-        # and database.
+        self._check_dbref(dbref)
+        with metrics.registry.timer(self.document_class,
+                                    'from_dbref') as timer:
+            document = self.find_one(dbref.id)
+            timer.documents = int(document is not None)
+        return document
+
+    def from_dbrefs(self, dbrefs):
+        """Same as :meth:`from_dbref`, but dereferences an iterable of
+        `dbrefs` with a single query. Documents are returned in the same
+        order as `dbrefs`, with ``None`` for the missing ones.
+        """
+        dbrefs = list(dbrefs)
+        for dbref in dbrefs:
+            self._check_dbref(dbref)
+        if not dbrefs:
+            return []
+
+        # Ids are frozen, since they may be unhashable, ex: documents.
+        found = {}
+        documents = identity.current()
+        if documents is not None:
+            for dbref in dbrefs:
+                document = documents.get(self.document_class, dbref.id)
+                if document is not None:
+                    found[_freeze(dbref.id)] = document
+
+        ids = {}
+        for dbref in dbrefs:
+            key = _freeze(dbref.id)
+            if key not in found:
+                ids.setdefault(key, dbref.id)
+        if ids:
+            for document in self.find({'_id': {'$in': ids.values()}}):
+                found[_freeze(document['_id'])] = document
+                if documents is not None:
+                    documents.add(document)
+        return [found.get(_freeze(dbref.id)) for dbref in dbrefs]
+
+    def _check_dbref(self, dbref):
+        """Makes sure a given DBRef points to this collection and
+        database."""
         if not dbref.collection == self.name:
             raise ValueError('DBRef points to an invalid collection.')
         elif dbref.database and not dbref.database == self.database.name:
             raise ValueError('DBRef points to an invalid database.')
+
+    def export(self, fp, query=None, fmt='jsonl', projection=None,
+               batch_size=1000, progress=None):
+        """Writes documents, matching a given `query`, to a file-like
+        object (or a socket) `fp`, returns the number of documents written.
+
+        Documents are streamed as plain dicts, rather than models, in
+        batches of `batch_size`, either as JSON lines, with MongoDB
+        extended JSON for ``ObjectId``, ``datetime``, ``DBRef`` and other
+        BSON types (`fmt` is ``'jsonl'``), or as concatenated BSON, the
+        same way ``mongodump`` does (`fmt` is ``'bson'``). If given,
+        `progress` is called with the number of documents written so far
+        after every batch.
+
+        >>> with open('foo.jsonl', 'w') as fp:
+        ...     Foo.collection.export(fp, {'bar': {'$gt': 1}})
+        42
+        """
+        try:
+            encode = EXPORT_FORMATS[fmt]
+        except KeyError:
+            raise ValueError('Unknown export format: %r' % fmt)
+        write = getattr(fp, 'write', None) or fp.sendall
+
+        exported, chunk = 0, []
+        with metrics.registry.timer(self.document_class, 'export') as timer:
+            for document in self._export_cursor(query, projection,
+                                                batch_size):
+                chunk.append(encode(document))
+                if len(chunk) == batch_size:
+                    write(''.join(chunk))
+                    exported += len(chunk)
+                    chunk = []
+                    if progress is not None:
+                        progress(exported)
+            if chunk:
+                write(''.join(chunk))
+                exported += len(chunk)
+                if progress is not None:
+                    progress(exported)
+            timer.documents = exported
+        return exported
+
+    def parallel_scan(self, query=None, workers=4, callback=None,
+                      processes=False, split_points=None, **kwargs):
+        """Same as :meth:`find`, but the documents are read by one cursor
+        per ``_id`` range, in `workers` threads, and returned in no
+        particular order. Any other `kwargs` are passed to :meth:`find`.
+
+        Ranges are split by the given `split_points`, or by ``_id`` of
+        every ``1 / workers`` of the documents, matching the `query`, in
+        ``_id`` order. If given, `callback` is called with each document
+        in the worker, and its results are returned instead, map-style.
+        If `processes` is ``True``, workers are processes, rather than
+        threads, and a `callback` is required; only its results are sent
+        back, all at once for each range.
+
+        >>> total = sum(Foo.collection.parallel_scan(
+        ...     {'bar': {'$gt': 1}}, workers=8, callback=compute))
+        """
+        if processes and callback is None:
+            raise ValueError('Scans by processes require a callback')
+        if split_points is None:
+            split_points = self._split_points(query, workers)
+        specs = [{'$and': [query, spec]} if query else spec
+                 for spec in _id_ranges(split_points)]
+        if processes:
+            return _scan_processes(self.document_class, specs, workers,
+                                   callback, kwargs)
+        return _scan_threads(self, specs, workers, callback, kwargs)
+
+    def paginate(self, query=None, sort=None, page_size=20, after=None,
+                 **kwargs):
+        """Returns a list of up to `page_size` documents, matching a given
+        `query`, in a given `sort` order (by ``_id`` by default), and a
+        token of the next page, or ``None`` if it's the last one. Any other
+        `kwargs` are passed to :meth:`find`.
+
+        Unlike slicing a cursor, which skips all of the documents before
+        a page, the next page is queried by a range of the sort keys (and
+        ``_id``, as a tie-breaker), starting after the last document, so
+        every page costs the same, given an index with the same keys. The
+        values of sort keys should be of the same type in all documents.
+
+        >>> page, token = Foo.collection.paginate({'bar': 1}, [('baz', -1)])
+        >>> page, token = Foo.collection.paginate({'bar': 1}, [('baz', -1)],
+        ...                                       after=token)
+        """
+        # pymongo returns lists and tuples as they are, so it's a copy.
+        keys = list(helpers._index_list(sort)) if sort else []
+        if not keys or keys[-1][0] != '_id':
+            keys.append(('_id', keys[-1][1] if keys else ASCENDING))
+
+        spec = query or {}
+        if after is not None:
+            condition = _after(keys, _decode_token(after, keys))
+            spec = {'$and': [query, condition]} if query else condition
+        documents = list(self.find(spec, **kwargs).sort(keys)
+                         .limit(page_size + 1))
+        if len(documents) <= page_size:
+            return documents, None
+        documents = documents[:page_size]
+        values = [_get_path(documents[-1], key) for key, _ in keys]
+        return documents, _encode_token(keys, values)
+
+    def _split_points(self, query, parts):
+        """Returns ``_id`` of every ``1 / parts`` of the documents,
+        matching a given `query`, in ``_id`` order, read in one pass."""
+        total = self.find(query).count()
+        offsets = set(total * idx // parts for idx in range(1, parts))
+        if not offsets:
+            return []
+        last = max(offsets)
+        # Only the plain _id values are read, and in large batches.
+        cursor = self._export_cursor(query, {'_id': True}, _SPLIT_BATCH_SIZE)
+        points = []
+        for offset, document in enumerate(cursor.sort('_id', ASCENDING)):
+            if offset in offsets:
+                points.append(document['_id'])
+            if offset >= last:
+                break
+        return _distinct_points(points)
+
+
+class Collection(_ModelCollection, PyMongoCollection):
+    """A wrapper around :class:`pymongo.collection.Collection` that
+    provides the same functionality, but stores the document class of
+    the collection we're working with. So that
+    :meth:`pymongo.collection.Collection.find` and
+    :meth:`pymongo.collection.Collection.find_one` can return the right
+    classes instead of plain :class:`dict`.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.document_class = kwargs.pop('document_class')
+        super(Collection, self).__init__(*args, **kwargs)
+
+    # Any write invalidates the query result cache of the model.
+
+    def insert(self, *args, **kwargs):
+        self._invalidate_cache()
+        return super(Collection, self).insert(*args, **kwargs)
+
+    def save(self, *args, **kwargs):
+        self._invalidate_cache()
+        return super(Collection, self).save(*args, **kwargs)
+
+    def update(self, spec, *args, **kwargs):
+        self._invalidate_cache()
+        with self._recording('update', spec):
+            return super(Collection, self).update(spec, *args, **kwargs)
+
+    def remove(self, spec_or_id=None, *args, **kwargs):
+        self._invalidate_cache()
+        with self._recording('remove', spec_or_id):
+            return super(Collection, self).remove(spec_or_id, *args,
+                                                  **kwargs)
+
+    def find_and_modify(self, *args, **kwargs):
+        self._invalidate_cache()
+        return super(Collection, self).find_and_modify(*args, **kwargs)
+
+    def drop(self):
+        self._invalidate_cache()
+        return super(Collection, self).drop()
+
+    def find(self, *args, **kwargs):
+        """Same as :meth:`pymongo.collection.Collection.find`, except
+        it returns the right document class.
+        """
+        return Cursor(self, *args, wrap=self.document_class, **kwargs)
+
+    def _fetch_one(self, spec_or_id, *args, **kwargs):
+        """Queries the database for a single document, bypassing the
+        identity map and the query result cache; returns it unwrapped, the
+        same way :meth:`pymongo.collection.Collection.find_one` does."""
+        if spec_or_id is not None and not isinstance(spec_or_id, dict):
+            spec_or_id = {'_id': spec_or_id}
+        max_time_ms = kwargs.pop('max_time_ms', None)
+        kwargs.setdefault('as_class', _as_class(self.document_class))
+        cursor = Cursor(self, spec_or_id, *args, wrap=None, **kwargs)
+        cursor._single = True
+        if max_time_ms is not None:
+            cursor.max_time_ms(max_time_ms)
+        for data in cursor.limit(-1):
+            return data
+        return None
+
+    def _decode_cached(self, data, as_class):
+        """Decodes a BSON document from the query result cache."""
+        client = self.database.connection
+        return BSON(data).decode(as_class, client.tz_aware,
+                                 self.uuid_subtype)
+
+    def _export_cursor(self, query, projection, batch_size):
+        """Returns a cursor over plain documents for :meth:`export`."""
+        return PyMongoCollection.find(self, query, projection) \
+            .batch_size(batch_size)
+
+    def _split_points(self, query, parts):
+        """Same as :meth:`_ModelCollection._split_points`, except the
+        whole collection is split with the ``splitVector`` command, which
+        only reads the ``_id`` index, if the server allows it."""
+        if query:
+            return super(Collection, self)._split_points(query, parts)
+
+        database = self.database
+        try:
+            stats = database.command('collstats', self.name)
+            total = stats.get('count', 0)
+            if total < parts:
+                return super(Collection, self)._split_points(query, parts)
+            # The size limit is no less than half of the collection, so
+            # splits are made by the number of documents.
+            result = database.command(
+                'splitVector', self.full_name, keyPattern={'_id': 1},
+                maxChunkSizeBytes=max(stats.get('size', 0), 1 << 20),
+                maxChunkObjects=-(-total // parts))
+        except OperationFailure:
+            # Ex: mongos, or not enough privileges.
+            return super(Collection, self)._split_points(query, parts)
+        return _distinct_points([key['_id'] for key in result['splitKeys']])
+
+    def save_many(self, documents, ordered=False, batch_size=1000,
+                  write_concern=None):
+        """Saves multiple `documents` with bulk write operations, sent
+        in batches of `batch_size` documents. Documents with an ``_id``
+        replace (or upsert) the stored ones, the rest are inserted and
+        get a newly generated ``_id``.
+
+        Returns the combined result of all batches, like
+        :meth:`pymongo.bulk.BulkOperationBuilder.execute` does, with the
+        ``index`` of each write error pointing into `documents`. If any
+        of the writes fail, :exc:`pymongo.errors.BulkWriteError` with the
+        same result is raised; for `ordered` writes no further batches
+        are sent after a failed one.
+        """
+        result = {}
+        documents = iter(documents)
+        offset = 0
+        while True:
+            batch = list(islice(documents, batch_size))
+            if not batch:
+                break
+
+            self._invalidate_cache()
+            if ordered:
+                bulk = self.initialize_ordered_bulk_op()
+            else:
+                bulk = self.initialize_unordered_bulk_op()
+
+            for document in batch:
+                if '_id' in document:
+                    bulk.find({'_id': document['_id']}).upsert() \
+                        .replace_one(document)
+                else:
+                    bulk.insert(document)
+
+            try:
+                # Unacknowledged writes have no results whatsoever.
+                batch_result = bulk.execute(write_concern) or {}
+            except BulkWriteError as excn:
+                batch_result = excn.details
+
+            _merge_bulk_result(result, batch_result, offset)
+            if ordered and batch_result.get('writeErrors'):
+                break
+            offset += len(batch)
+
+        if result.get('writeErrors') or result.get('writeConcernErrors'):
+            raise BulkWriteError(result)
+        return result
+
+
+def _id_ranges(points):
+    """Returns queries of the ``_id`` ranges, split by given points; ids
+    of any other type than the points belong to the first range."""
+    if not points:
+        return [{}]
+    ranges = [{'_id': {'$not': {'$gte': points[0]}}}]
+    for low, high in zip(points, points[1:]):
+        ranges.append({'_id': {'$gte': low, '$lt': high}})
+    ranges.append({'_id': {'$gte': points[-1]}})
+    return ranges
+
+
+# Number of _id values read at a time, while looking for split points.
+_SPLIT_BATCH_SIZE = 10000
+
+# Marks the end of documents of a scanned range.
+_DONE = object()
+
+
+def _scan_threads(collection, specs, workers, callback, kwargs):
+    """Scans `specs` in up to `workers` threads, one range at a time in
+    each, yields the documents, or `callback` results, as they're read."""
+    pending = Queue()
+    for spec in specs:
+        pending.put(spec)
+    results = Queue(1000)
+    stopped = threading.Event()
+
+    def scan():
+        try:
+            while not stopped.is_set():
+                try:
+                    spec = pending.get_nowait()
+                except Empty:
+                    return
+                for document in collection.find(spec, **kwargs):
+                    if stopped.is_set():
+                        return
+                    results.put((True, callback(document)
+                                 if callback is not None else document))
+        except Exception:
+            results.put((False, sys.exc_info()))
+        finally:
+            results.put((True, _DONE))
+
+    threads = [threading.Thread(target=scan, name='minimongo-scan')
+               for _ in range(max(1, min(workers, len(specs))))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        running = len(threads)
+        while running:
+            ok, result = results.get()
+            if not ok:
+                raise result[0], result[1], result[2]
+            elif result is _DONE:
+                running -= 1
+            else:
+                yield result
+    finally:
+        stopped.set()
+        while any(thread.is_alive() for thread in threads):
+            try:
+                results.get(timeout=0.1)  # Let the rest of them finish.
+            except Empty:
+                pass
+
+
+# The model, the callback and find() arguments of a scanning process.
+_scan = None
+
+
+def _init_scan(model, callback, kwargs):
+    global _scan
+    _scan = model, callback, kwargs
+
+
+def _scan_range(spec):
+    model, callback, kwargs = _scan
+    return [callback(document)
+            for document in model.collection.find(spec, **kwargs)]
+
+
+def _scan_processes(model, specs, workers, callback, kwargs):
+    """Scans each of `specs` in a pool of `workers` processes, yields
+    `callback` results of each range, once it's scanned."""
+    pool = multiprocessing.Pool(workers, _init_scan, (model, callback, kwargs))
+    try:
+        for results in pool.imap_unordered(_scan_range, specs):
+            for result in results:
+                yield result
+    finally:
+        pool.terminate()
+
+
+def _after(keys, values):
+    """Returns a query of the documents, which come after the ones with
+    given `values` of sort `keys` in their order."""
+    clauses = []
+    for idx, (key, direction) in enumerate(keys):
+        clause = dict((previous, value) for (previous, _), value
+                      in zip(keys[:idx], values))
+        clause[key] = {'$gt' if direction > 0 else '$lt': values[idx]}
+        clauses.append(clause)
+    return clauses[0] if len(clauses) == 1 else {'$or': clauses}
+
+
+def _encode_token(keys, values):
+    return base64.urlsafe_b64encode(BSON.encode({
+        'keys': [list(key) for key in keys], 'values': values}))
+
+
+def _decode_token(token, keys):
+    """Returns values of sort keys from a page token."""
+    try:
+        decoded = BSON(base64.urlsafe_b64decode(str(token))).decode()
+        token_keys = [tuple(key) for key in decoded['keys']]
+        values = decoded['values']
+    except (InvalidBSON, KeyError, TypeError, ValueError):
+        raise ValueError('Invalid page token: %r' % token)
+    if token_keys != keys:
+        raise ValueError('Page token of another sort order: %r' % token_keys)
+    return values
+
+
+def _get_path(document, path):
+    """Returns the value of a dotted `path` in a document, or ``None``."""
+    for part in path.split('.'):
+        if not isinstance(document, dict):
+            return None
+        document = dict.get(document, part)
+    return document
+
+
+def _jsonl(document):
+    return json_util.dumps(document) + '\n'
+
+
+# Encoders of documents by export format, see Collection.export().
+EXPORT_FORMATS = {'jsonl': _jsonl, 'bson': BSON.encode}
+
+
+def _merge_bulk_result(result, batch_result, offset):
+    """Merges a result of a bulk write operation into a combined
+    `result`, shifting indices by a given `offset`."""
+    for key, value in batch_result.iteritems():
+        if isinstance(value, list):
+            for item in value:
+                if 'index' in item:
+                    item['index'] += offset
+            result.setdefault(key, []).extend(value)
+        elif value is None or result.get(key, 0) is None:
+            # nModified isn't available with pre-2.6 servers.
+            result[key] = None
         else:
-            return self.find_one(dbref.id)
+            result[key] = result.get(key, 0) + value
+
+
+# Cursor options, which affect query results.
+_CACHE_KEY_OPTIONS = ('spec', 'fields', 'skip', 'limit', 'ordering', 'hint',
+                      'snapshot', 'max_scan', 'max', 'min')
+
+# Tailable and exhaust cursors.
+_UNCACHEABLE_FLAGS = 2 | 64
+
+
+def _is_cacheable(cursor):
+    """Checks whether results of a given cursor can be cached."""
+    # pymongo has no public accessors for cursor options, so we look
+    # them up the same way Cursor.clone() does.
+    options = cursor.__dict__
+    return not (options.get('_Cursor__explain') or
+                options.get('_Cursor__query_flags', 0) & _UNCACHEABLE_FLAGS)
+
+
+def _cache_key(cursor):
+    """Returns a normalized, hashable key for a query a given cursor
+    executes."""
+    options = cursor.__dict__
+    return (cursor.collection.full_name, ) + tuple(
+        _freeze(options.get('_Cursor__' + option))
+        for option in _CACHE_KEY_OPTIONS)
+
+
+def _freeze(value):
+    """Turns a (possibly nested) query document into a hashable value;
+    the order of keys only matters for :class:`bson.son.SON`."""
+    if isinstance(value, SON):
+        return (SON, ) + tuple((key, _freeze(nested))
+                               for key, nested in value.iteritems())
+    elif isinstance(value, dict):
+        return (dict, ) + tuple(sorted((key, _freeze(nested))
+                                       for key, nested in value.iteritems()))
+    elif isinstance(value, (list, tuple)):
+        return (list, ) + tuple(_freeze(nested) for nested in value)
+
+    try:
+        hash(value)
+    except TypeError:
+        return repr(value)
+    return value
+
+
+def _cache_set(cache, key, value, generation):
+    """Stores a query result in a given `cache`, unless it was cleared
+    since a given `generation`, if the cache keeps track of those."""
+    if generation is None:
+        cache.set(key, value)
+    else:
+        cache.set(key, value, generation)
+
+
+def _as_class(document_class):
+    """Returns the class, documents of a given `document_class` are
+    decoded into by default."""
+    if getattr(document_class, '_decode_in_place', False):
+        return DecodedDocument
+    return dict
+
+
+def _distinct_points(points):
+    """Drops split points, which are equal to the previous one, or of
+    a different type than the first one; ranges can't span values of
+    different types."""
+    distinct = []
+    for point in points:
+        if not distinct or type(point) is type(distinct[0]) and \
+           point != distinct[-1]:
+            distinct.append(point)
+    return distinct
+
+
+def _id_of(spec_or_id):
+    """Returns the ``_id`` a given :meth:`Collection.find_one` query
+    looks for, or ``None`` if it isn't a plain lookup by ``_id``."""
+    if spec_or_id is None:
+        return None
+    elif not isinstance(spec_or_id, dict):
+        return spec_or_id
+    elif spec_or_id.keys() == ['_id'] and \
+         not isinstance(spec_or_id['_id'], dict):
+        return spec_or_id['_id']
+    return None
+
+
+def _wrap(document_class, data):
+    """Wraps a document, loaded from the database, into a given
+    `document_class`; the result is considered in sync with the database,
+    so all further changes are tracked."""
+    if type(data) is DecodedDocument and \
+       getattr(document_class, '_decode_in_place', False):
+        document = document_class._from_document(data)
+    else:
+        document = document_class(data)
+    document._mark_clean()
+    return document
+
+
+def _wrap_many(document_class, batch):
+    """Same as :func:`_wrap`, but for a list of documents."""
+    if getattr(document_class, '_decode_in_place', False) and \
+       all(type(data) is DecodedDocument for data in batch):
+        documents = document_class._from_documents(batch)
+    else:
+        documents = [document_class(data) for data in batch]
+    for document in documents:
+        document._mark_clean()
+    return documents
 
 
 class DummyCollection(object):
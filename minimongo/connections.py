@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+import time
+
+from pymongo import Connection
+
+
+class ConnectionRegistry(object):
+    """Connections shared by models, keyed by MongoDB URI and connection
+    options, ex: ``max_pool_size``.
+
+    Connections created in a parent process aren't reused after
+    :func:`os.fork`, instead new ones are created in the child process
+    on first use.
+
+    >>> registry.get('mongodb://localhost:27017', max_pool_size=10)
+    Connection('localhost', 27017)
+    >>> registry.stats()
+    {'connections': 1, 'lookups': 1, 'wait_time': 0.0001}
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self._reset()
+
+    def __len__(self):
+        return len(self._connections)
+
+    def get(self, uri, **options):
+        """Returns a connection to a given `uri` with given `options`,
+        creating it with :attr:`factory` if there's none yet."""
+        key = uri, tuple(sorted(options.iteritems()))
+        if self._pid != os.getpid():
+            # Forked -- the lock might have been held by a thread, which
+            # doesn't exist in this process, so everything starts over.
+            self._reset()
+
+        started = time.time()
+        with self._lock:
+            connection = self._connections.get(key)
+            if connection is None:
+                connection = self._connections[key] = \
+                    self.factory(uri, **options)
+            self._lookups += 1
+            self._wait_time += time.time() - started
+        return connection
+
+    def stats(self):
+        """Returns a dict with the number of open ``connections``, the
+        number of ``lookups`` made via :meth:`get` and the total time
+        they took, ``wait_time``, in seconds, for the current process.
+
+        Models look their connection up once they're bound, so these
+        aren't socket checkouts from the pools of the connections.
+        """
+        with self._lock:
+            return {'connections': len(self._connections),
+                    'lookups': self._lookups,
+                    'wait_time': self._wait_time}
+
+    def clear(self):
+        """Disconnects and forgets all of the connections."""
+        with self._lock:
+            connections = self._connections.values()
+            self._connections.clear()
+        for connection in connections:
+            connection.disconnect()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._connections = {}
+        self._lookups = 0
+        self._wait_time = 0.0
+
+
+def _connect_lazily(uri, **options):
+    # _connect=False option
+    # creates :class:`pymongo.connection.Connection` object without
+    # establishing connection. It's required if there is no running
+    # mongodb at this time but we want to create :class:`Model`.
+    return Connection(uri, _connect=False, **options)
+
+
+#: Connections of :class:`~minimongo.Model` subclasses.
+registry = ConnectionRegistry(_connect_lazily)
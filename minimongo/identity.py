@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+import threading
+
+_local = threading.local()
+
+
+class IdentityMap(object):
+    """A scope, within which documents loaded by ``_id`` are cached per
+    model class, so that repeated lookups of the same document return
+    the same instance without querying the database.
+
+    >>> with IdentityMap():
+    ...     user = User.collection.find_one(user_id)
+    ...     user is User.collection.find_one({'_id': user_id})
+    True
+
+    Identity maps are thread-local; nested scopes don't share documents
+    with the outer ones.
+    """
+
+    def __init__(self):
+        self._documents = {}
+
+    def __enter__(self):
+        _local.__dict__.setdefault('stack', []).append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        _local.stack.pop()
+
+    def __len__(self):
+        return len(self._documents)
+
+    def get(self, document_class, document_id):
+        """Returns a cached document of a given class with a given id,
+        or ``None``."""
+        try:
+            return self._documents.get((document_class, document_id))
+        except TypeError:
+            return None  # Unhashable ids aren't cached.
+
+    def add(self, document):
+        """Caches a given `document`, replacing the one with the same
+        class and ``_id``, if any."""
+        try:
+            self._documents[type(document), document['_id']] = document
+        except (KeyError, TypeError):
+            pass
+
+    def discard(self, document_class, document_id):
+        """Removes a document of a given class with a given id from the
+        cache, if it's there."""
+        try:
+            self._documents.pop((document_class, document_id), None)
+        except TypeError:
+            pass
+
+    def clear(self):
+        self._documents.clear()
+
+
+def current():
+    """Returns the innermost active :class:`IdentityMap` for the current
+    thread, or ``None``."""
+    stack = getattr(_local, 'stack', None)
+    return stack[-1] if stack else None
+
+
+def remember(document):
+    """Caches a given `document` in the active identity map, if any."""
+    documents = current()
+    if documents is not None:
+        documents.add(document)
+
+
+def forget(document):
+    """Removes a given `document` from the active identity map, if any."""
+    documents = current()
+    if documents is not None and '_id' in document:
+        documents.discard(type(document), document['_id'])
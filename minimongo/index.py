@@ -1,4 +1,9 @@
 # -*- coding: utf-8 -*-
+from pymongo import helpers, ReadPreference
+from pymongo.collection import _gen_index_name
+from pymongo.common import COMMAND_NOT_FOUND_CODES
+from pymongo.errors import OperationFailure
+
 
 class Index(object):
     """A simple wrapper for arguments to
@@ -23,3 +28,56 @@ class Index(object):
         on the given `collection` with the stored arguments.
         """
         return collection.ensure_index(*self._args, **self._kwargs)
+
+    def document(self):
+        """Returns an index specification for the ``createIndexes``
+        command, same as the one
+        :meth:`pymongo.collection.Collection.ensure_index` sends."""
+        keys = helpers._index_list(self._args[0])
+        kwargs = dict(self._kwargs)
+        # Client-side options of ensure_index().
+        kwargs.pop('cache_for', None)
+        kwargs.pop('ttl', None)
+
+        if 'drop_dups' in kwargs:
+            kwargs['dropDups'] = kwargs.pop('drop_dups')
+        if 'bucket_size' in kwargs:
+            kwargs['bucketSize'] = kwargs.pop('bucket_size')
+
+        document = {'key': helpers._index_document(keys),
+                    'name': kwargs.get('name') or _gen_index_name(keys)}
+        document.update(kwargs)
+        return document
+
+
+def create_indices(collection, indices):
+    """Creates those of given `indices`, which don't exist yet in a given
+    `collection`, with a single ``createIndexes`` command, and returns
+    names of the created ones.
+
+    .. note:: older MongoDB versions, which don't support
+              ``createIndexes``, get one command per index.
+    """
+    if not indices:
+        return []
+
+    existing = collection.index_information()
+    documents = {}
+    for index in indices:
+        document = index.document()
+        if document['name'] not in existing:
+            documents.setdefault(document['name'], document)
+
+    if documents:
+        try:
+            collection.database.command(
+                'createIndexes', collection.name,
+                read_preference=ReadPreference.PRIMARY,
+                indexes=documents.values())
+        except OperationFailure as excn:
+            if excn.code not in COMMAND_NOT_FOUND_CODES:
+                raise
+            # MongoDB before 2.6, one index at a time then.
+            for index in indices:
+                index.ensure(collection)
+    return sorted(documents)
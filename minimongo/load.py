@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+'''
+    minimongo.load
+    ~~~~~~~~~~~~~~
+
+    Bulk loading of JSON lines or ``mongodump``-style BSON files into the
+    collection of a model::
+
+        $ python -m minimongo.load myapp.models:Reading readings.bson
+
+    A file is read as a stream of batches, which are parsed (and passed
+    through the ``field_map`` of the model) by a process pool, and
+    inserted by several concurrent writers. Reported offsets are positions
+    in the file, such that all of the documents before them are written,
+    so that an interrupted load can be resumed from there.
+'''
+import argparse
+import logging
+import multiprocessing
+import struct
+import sys
+import time
+from collections import deque
+from functools import partial
+from multiprocessing.pool import ThreadPool
+
+from bson import BSON, json_util
+from pymongo.errors import BulkWriteError
+
+from minimongo.collection import DecodedDocument, _wrap_many
+
+logger = logging.getLogger('minimongo.load')
+
+FORMATS = ('jsonl', 'bson')
+
+# The model and the format of the file, parsed by the current process.
+_parser = None
+
+
+def load(model, path, fmt=None, batch_size=1000, processes=None,
+         writers=4, offset=0, write_concern=None, progress=None):
+    """Inserts documents from a file at a given `path` into the
+    collection of a given `model`, returns the final statistics.
+
+    The `fmt` of the file is either ``'jsonl'``, one document in MongoDB
+    extended JSON per line, or ``'bson'``; by default, it's guessed by
+    the file extension. Documents are read from a given byte `offset` in
+    batches of `batch_size`, parsed by a pool of `processes` (one per CPU
+    by default, none if ``0``) and inserted with unordered bulk writes by
+    `writers` threads, with a given `write_concern` or the one of the
+    collection.
+
+    After every batch, `progress` is called with a dict of statistics:
+    numbers of ``documents`` inserted and ``failed`` so far, the
+    ``offset`` to resume from, ``elapsed`` seconds and the ``rate`` of
+    documents per second.
+    """
+    if fmt is None:
+        fmt = 'bson' if path.endswith('.bson') else 'jsonl'
+    if fmt not in FORMATS:
+        raise ValueError('Unknown format: %r' % fmt)
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    collection = model.collection
+    stats = {'documents': 0, 'failed': 0, 'offset': offset,
+             'elapsed': 0.0, 'rate': 0.0}
+    if processes:
+        parsers = multiprocessing.Pool(processes, _init_parser, (model, fmt))
+    else:
+        parsers = None
+        _init_parser(model, fmt)
+    writer_pool = ThreadPool(writers)
+    write = partial(_write, collection, write_concern)
+
+    def collect(result):
+        while not result.ready():
+            result.wait(1)  # Unlike get(), can be interrupted.
+        end, inserted, failed = result.get()
+        stats['documents'] += inserted
+        stats['failed'] += failed
+        stats['offset'] = end
+        stats['elapsed'] = time.time() - started
+        stats['rate'] = stats['documents'] / (stats['elapsed'] or 1)
+        if progress is not None:
+            progress(dict(stats))
+
+    started = time.time()
+    # Results of the batches in flight, in the order they were read.
+    pending = deque()
+    try:
+        with open(path, 'rb') as fp:
+            fp.seek(offset)
+            for batch in _read(fp, fmt, batch_size):
+                if parsers is not None:
+                    parse = parsers.apply_async(_parse, (batch, )).get
+                else:
+                    parse = partial(_parse, batch)
+                pending.append(writer_pool.apply_async(write, (parse, )))
+                if len(pending) >= 2 * (processes + writers):
+                    collect(pending.popleft())
+            while pending:
+                collect(pending.popleft())
+    finally:
+        if parsers is not None:
+            parsers.terminate()
+        writer_pool.terminate()
+        collection._invalidate_cache()
+    return stats
+
+
+def _read(fp, fmt, batch_size):
+    """Yields ``(offset, records)`` pairs: batches of raw records, read
+    from a given file, along with the offset after the last of them."""
+    records_of = _jsonl_records if fmt == 'jsonl' else _bson_records
+    position = fp.tell()
+    records = []
+    for record in records_of(fp):
+        position += len(record)
+        records.append(record)
+        if len(records) == batch_size:
+            yield position, records
+            records = []
+    if records:
+        yield position, records
+
+
+def _jsonl_records(fp):
+    return iter(fp)
+
+
+def _bson_records(fp):
+    while True:
+        header = fp.read(4)
+        if not header:
+            return
+        size = struct.unpack('<i', header)[0] if len(header) == 4 else 0
+        data = header + fp.read(size - 4)
+        if size < 5 or len(data) < size:
+            raise ValueError('Truncated BSON document at offset %d' %
+                             (fp.tell() - len(data)))
+        yield data
+
+
+def _init_parser(model, fmt):
+    global _parser
+    _parser = model, fmt
+
+
+def _parse(batch):
+    """Parses a batch of records, applies field mappers of the model to
+    them and returns them as BSON."""
+    end, records = batch
+    model, fmt = _parser
+    if fmt == 'bson':
+        documents = [BSON(data).decode(DecodedDocument) for data in records]
+    else:
+        documents = [DecodedDocument(json_util.loads(line))
+                     for line in records if line.strip()]
+    documents = _wrap_many(model, documents)
+    if model._meta.lazy_fields:
+        for document in documents:
+            document._resolve_all()
+    return end, [BSON.encode(document, True) for document in documents]
+
+
+def _write(collection, write_concern, parse):
+    """Inserts a batch of BSON documents, returned by a given `parse`
+    function, returns the offset after the batch and numbers of inserted
+    and failed documents."""
+    end, records = parse()
+    if not records:
+        return end, 0, 0
+
+    bulk = collection.initialize_unordered_bulk_op()
+    for data in records:
+        bulk.insert(BSON(data).decode())
+    try:
+        result = bulk.execute(write_concern)
+    except BulkWriteError as excn:
+        result = excn.details
+        errors = result['writeErrors'] or result['writeConcernErrors']
+        logger.warning('%d documents failed to load, ex: %s',
+                       len(result['writeErrors']), errors[0]['errmsg'])
+    if result is None:
+        return end, len(records), 0  # Unacknowledged.
+    failed = len(result['writeErrors'])
+    return end, len(records) - failed, failed
+
+
+def _import_model(name):
+    """Imports a model class, given as ``'package.module:Model'`` or
+    ``'package.module.Model'``."""
+    module, _, attr = name.rpartition(':' if ':' in name else '.')
+    if not module:
+        raise ValueError('Model should be given as package.module:Model')
+    return getattr(__import__(module, fromlist=[attr]), attr)
+
+
+class _Reporter(object):
+    """Writes statistics to a given stream, at most once in `interval`
+    seconds."""
+
+    def __init__(self, stream, interval=1.0):
+        self.stream = stream
+        self.interval = interval
+        self.stats = None
+        self._reported = 0
+
+    def __call__(self, stats, force=False):
+        self.stats = stats
+        if force or time.time() - self._reported >= self.interval:
+            self._reported = time.time()
+            self.stream.write('%(documents)d documents loaded, %(failed)d '
+                              'failed, %(rate).0f/s, offset %(offset)d\n' %
+                              stats)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m minimongo.load',
+        description='Loads a JSON lines or BSON file into the collection '
+                    'of a model.')
+    parser.add_argument('model', help='model class, ex: myapp.models:Foo')
+    parser.add_argument('path', help='file to load')
+    parser.add_argument('--format', choices=FORMATS,
+                        help='format of the file, by default guessed by '
+                             'its extension')
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help='documents per bulk write, default: 1000')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='parser processes, default: one per CPU')
+    parser.add_argument('--writers', type=int, default=4,
+                        help='concurrent writers, default: 4')
+    parser.add_argument('--offset', type=int, default=0,
+                        help='byte offset to start (or resume) from')
+    parser.add_argument('-w', type=int, default=None,
+                        help='write concern, default: the one of the model')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig()
+    reporter = _Reporter(sys.stderr)
+    try:
+        stats = load(_import_model(args.model), args.path, args.format,
+                     args.batch_size, args.processes, args.writers,
+                     args.offset, None if args.w is None else {'w': args.w},
+                     progress=reporter)
+    except KeyboardInterrupt:
+        offset = reporter.stats['offset'] if reporter.stats else args.offset
+        sys.stderr.write('Interrupted, resume with --offset %d\n' % offset)
+        return 1
+    reporter(stats, force=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,1689 @@
+# -*- coding: utf-8 -*-
+'''
+    minimongo.memory
+    ~~~~~~~~~~~~~~~~
+
+    An in-process stand-in for MongoDB collections, so that tests and
+    benchmarks don't need a running server:
+
+    >>> class SomeModel(Model):
+    ...     class Meta:
+    ...         database = 'test'
+    ...         collection_class = MemoryCollection
+
+    Documents are kept in memory of the current process, shared by all
+    the collections with the same database and collection names. Indices
+    (including the ones declared in ``class Meta``) are real in-memory
+    indices: queries, which match their leading fields exactly, by ``$in``
+    or by range, only look at the documents an index points to.
+
+    Supported are the common query and update operators, sort, skip and
+    limit, field projections and unique (and sparse) indices; anything
+    else raises :exc:`pymongo.errors.OperationFailure`, the same way an
+    unknown operator does with a real server.
+'''
+import operator
+import re
+import sys
+import threading
+from bisect import bisect_left, insort
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
+from itertools import count, islice, product
+
+from bson import BSON, DBRef, ObjectId
+from bson.binary import Binary
+from bson.code import Code
+from bson.max_key import MaxKey
+from bson.min_key import MinKey
+from bson.son import SON
+from bson.timestamp import Timestamp
+from pymongo import helpers
+from pymongo.collection import _gen_index_name
+from pymongo.errors import BulkWriteError, DuplicateKeyError, \
+    InvalidOperation, OperationFailure
+
+from minimongo import metrics
+from minimongo.collection import _ModelCollection, _as_class, _cache_set, \
+    _freeze, _merge_bulk_result, _wrap, _wrap_many
+
+# Databases by name.
+_databases = {}
+_lock = threading.Lock()
+
+
+def get_database(name):
+    """Returns the in-memory database with a given `name`, creating it
+    on first use."""
+    with _lock:
+        database = _databases.get(name)
+        if database is None:
+            database = _databases[name] = MemoryDatabase(name)
+        return database
+
+
+def clear():
+    """Drops all the collections of all the in-memory databases."""
+    with _lock:
+        databases = _databases.values()
+    for database in databases:
+        database.drop()
+
+
+class MemoryDatabase(object):
+    """An in-memory database, see :func:`get_database`; only provides
+    what :class:`MemoryCollection` and :func:`~minimongo.index.create_indices`
+    need."""
+
+    def __init__(self, name):
+        self.name = name
+        self._collections = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return 'MemoryDatabase(%r)' % self.name
+
+    def collection_names(self):
+        """Returns names of the collections with any documents or indices
+        except the ``_id`` one."""
+        with self._lock:
+            collections = self._collections.items()
+        return sorted(name for name, documents in collections
+                      if documents.records or len(documents.indices) > 1)
+
+    def drop_collection(self, name):
+        self._documents(name).clear()
+
+    def drop(self):
+        """Drops all the collections of the database."""
+        with self._lock:
+            collections = self._collections.values()
+        for documents in collections:
+            documents.clear()
+
+    def command(self, command, value=1, **kwargs):
+        """Runs a database command; only ``createIndexes`` is supported."""
+        if command != 'createIndexes':
+            raise OperationFailure('no such cmd: %s' % command, 59)
+
+        documents = self._documents(value)
+        with documents.lock:
+            before = len(documents.indices)
+            for index in kwargs.get('indexes', ()):
+                index = dict(index)
+                keys = index.pop('key').items()
+                documents.create_index(index.pop('name'), keys, **index)
+            return {'ok': 1.0, 'numIndexesBefore': before,
+                    'numIndexesAfter': len(documents.indices)}
+
+    def _documents(self, name):
+        """Returns storage of the collection with a given `name`."""
+        with self._lock:
+            documents = self._collections.get(name)
+            if documents is None:
+                documents = self._collections[name] = \
+                    _Documents('%s.%s' % (self.name, name))
+            return documents
+
+
+class MemoryCursor(object):
+    """Same as :class:`~minimongo.collection.Cursor`, but for a
+    :class:`MemoryCollection`; the query is run, when the first document
+    is requested."""
+
+    def __init__(self, collection, spec=None, fields=None, skip=0, limit=0,
+                 timeout=True, snapshot=False, tailable=False, sort=None,
+                 max_scan=None, as_class=None, wrap=None, **kwargs):
+        if spec is None:
+            spec = {}
+        if not isinstance(spec, dict):
+            raise TypeError('spec must be an instance of dict')
+        if not isinstance(skip, int):
+            raise TypeError('skip must be an instance of int')
+        if not isinstance(limit, int):
+            raise TypeError('limit must be an instance of int')
+        if tailable:
+            raise OperationFailure(
+                'tailable cursor requested on non capped collection')
+        if isinstance(fields, (list, tuple)):
+            fields = helpers._fields_list_to_dict(fields)
+
+        self.collection = collection
+        self._spec = spec
+        self._fields = fields
+        self._skip = skip
+        self._limit = limit
+        self._ordering = sort and helpers._index_list(sort)
+        self._hint = None
+        self._as_class = as_class or dict
+        self._wrapper_class = wrap
+        self._data = None    # BSON documents, which weren't returned yet.
+        self._single = False  # Same as Cursor._single.
+        self._cache_key = None
+        self._result = None  # BSON documents to cache, once all are read.
+        self._generation = None  # Of the cache, when the query was run.
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._data is None:
+            self._execute()
+        if not self._data:
+            self._cache_result()
+            raise StopIteration
+        document = self._decode(self._data.popleft())
+        if self._wrapper_class is None:
+            return document
+        return _wrap(self._wrapper_class, document)
+
+    def __getitem__(self, index):
+        self._check_okay_to_chain()
+        if isinstance(index, slice):
+            if index.step is not None:
+                raise IndexError('Cursor instances do not support slice '
+                                 'steps')
+            skip = index.start or 0
+            if skip < 0:
+                raise IndexError('Cursor instances do not support negative '
+                                 'indices')
+            limit = 0
+            if index.stop is not None:
+                limit = index.stop - skip
+                if limit < 0:
+                    raise IndexError('stop index must be greater than start '
+                                     'index for slice %r' % index)
+                if limit == 0:
+                    self._data = deque()  # Nothing to return.
+            self._skip, self._limit = skip, limit
+            return self
+
+        if index < 0:
+            raise IndexError('Cursor instances do not support negative '
+                             'indices')
+        clone = self.clone()
+        clone.skip(index + self._skip)
+        clone.limit(-1)  # Just the one document.
+        for document in clone:
+            return document
+        raise IndexError('no such item for Cursor instance')
+
+    @property
+    def alive(self):
+        return self._data is None or bool(self._data)
+
+    def _check_okay_to_chain(self):
+        if self._data is not None:
+            raise InvalidOperation('cannot set options after executing query')
+
+    def sort(self, key_or_list, direction=None):
+        self._check_okay_to_chain()
+        self._ordering = helpers._index_list(key_or_list, direction)
+        return self
+
+    def skip(self, skip):
+        if not isinstance(skip, int):
+            raise TypeError('skip must be an int')
+        self._check_okay_to_chain()
+        self._skip = skip
+        return self
+
+    def limit(self, limit):
+        if not isinstance(limit, int):
+            raise TypeError('limit must be an int')
+        self._check_okay_to_chain()
+        self._limit = limit
+        return self
+
+    def batch_size(self, batch_size):
+        if not isinstance(batch_size, int):
+            raise TypeError('batch_size must be an int')
+        if batch_size < 0:
+            raise ValueError('batch_size must be >= 0')
+        self._check_okay_to_chain()
+        return self  # All of the documents are there already.
+
+    def hint(self, index):
+        """Makes the query use a given index, either by name or by keys."""
+        self._check_okay_to_chain()
+        if index is None or isinstance(index, basestring):
+            self._hint = index
+        else:
+            self._hint = _gen_index_name(helpers._index_list(index))
+        return self
+
+    def batches(self, size):
+        """Same as :meth:`minimongo.collection.Cursor.batches`."""
+        if size < 1:
+            raise ValueError('Batch size must be positive, got %r' % size)
+        if self._data is None:
+            self._execute()
+        while self._data:
+            batch = [self._decode(self._data.popleft())
+                     for _ in xrange(min(size, len(self._data)))]
+            yield _wrap_many(self._wrapper_class, batch)
+        self._cache_result()
+
+    def compact(self):
+        """Same as :meth:`minimongo.collection.Cursor.compact`."""
+        compact_class = getattr(self._wrapper_class, '_compact_class', None)
+        if compact_class is None:
+            raise ValueError('%r has no declared fields' % self._wrapper_class)
+        self._wrapper_class = compact_class
+        return self
+
+    def count(self, with_limit_and_skip=False):
+        cache = self.collection.cache
+        if cache is not None:
+            key = 'count', self._query_key(), with_limit_and_skip
+            count = cache.get(key)
+            if count is not None:
+                return count
+            generation = getattr(cache, 'generation', None)
+
+        _, _, records = self.collection._documents.query(self._spec,
+                                                         self._hint)
+        if with_limit_and_skip:
+            records = self._slice(records)
+        if cache is not None:
+            _cache_set(cache, key, len(records), generation)
+        return len(records)
+
+    def distinct(self, key):
+        """Returns distinct values of a given field of the matching
+        documents; values of arrays are counted one by one."""
+        _, _, records = self.collection._documents.query(self._spec,
+                                                         self._hint)
+        values, seen = [], set()
+        for record in records:
+            for value in _expand(_resolve(record.document, key.split('.')),
+                                 arrays=False):
+                value_key = _key(value)
+                if value_key not in seen:
+                    seen.add(value_key)
+                    values.append(value)
+        return values
+
+    def explain(self):
+        """Returns a ``queryPlanner`` style explanation of the query, as
+        MongoDB 3.0 does, with the index used (if any) and the numbers of
+        documents examined and returned."""
+        index, examined, records = self._run()
+        if index is None:
+            plan = {'stage': 'COLLSCAN'}
+        else:
+            plan = {'stage': 'FETCH',
+                    'inputStage': {'stage': 'IXSCAN', 'indexName': index}}
+        if self._ordering:
+            plan = {'stage': 'SORT', 'inputStage': plan}
+        if self._skip:
+            plan = {'stage': 'SKIP', 'inputStage': plan}
+        if self._limit:
+            plan = {'stage': 'LIMIT', 'inputStage': plan}
+        return {'queryPlanner': {'namespace': self.collection.full_name,
+                                 'parsedQuery': self._spec,
+                                 'winningPlan': plan},
+                'executionStats': {'nReturned': len(records),
+                                   'totalDocsExamined': examined}}
+
+    def clone(self):
+        clone = MemoryCursor(self.collection, self._spec, self._fields,
+                             self._skip, self._limit, sort=self._ordering,
+                             as_class=self._as_class,
+                             wrap=self._wrapper_class)
+        clone._hint = self._hint
+        return clone
+
+    def rewind(self):
+        self._data = self._result = None
+        return self
+
+    def close(self):
+        self._data = deque()
+
+    def _execute(self):
+        collection = self.collection
+        cache = None if self._single else collection.cache
+        if cache is not None:
+            self._cache_key = 'find', self._query_key()
+            cached = cache.get(self._cache_key)
+            if cached is not None:
+                self._data = deque(cached)
+                return
+            self._generation = getattr(cache, 'generation', None)
+
+        operation = None if self._single else 'find'
+        with metrics.registry.timer(collection.document_class,
+                                    operation) as timer, \
+                collection._recording('find', self._spec, self._ordering):
+            _, _, records = self._run()
+            self._data = deque(record.data for record in records)
+            timer.documents = len(self._data)
+        max_size = getattr(cache, 'max_result_size', sys.maxint)
+        if cache is not None and \
+           sum(len(data) for data in self._data) <= max_size:
+            self._result = list(self._data)
+
+    def _run(self):
+        """Runs the query, returns the name of the index used (if any),
+        the number of examined documents and the resulting records."""
+        index, examined, records = self.collection._documents.query(
+            self._spec, self._hint)
+        if self._ordering:
+            _sort(records, self._ordering)
+        return index, examined, self._slice(records)
+
+    def _query_key(self):
+        """Returns a hashable key of the query for the result cache."""
+        return (self.collection.full_name, _freeze(self._spec),
+                _freeze(self._fields), self._skip, self._limit,
+                _freeze(self._ordering), self._hint)
+
+    def _cache_result(self):
+        """Caches the result of the query, once all of it was read."""
+        if self._result is not None:
+            _cache_set(self.collection.cache, self._cache_key, self._result,
+                       self._generation)
+            self._result = None
+
+    def _slice(self, records):
+        records = records[self._skip:]
+        if self._limit:
+            records = records[:abs(self._limit)]
+        return records
+
+    def _decode(self, data):
+        document = BSON(data).decode(self._as_class, self.collection._tz_aware)
+        if self._fields is not None:
+            document = _project(document, self._fields, self._as_class)
+        return document
+
+
+class MemoryCollection(_ModelCollection):
+    """A drop-in replacement of :class:`~minimongo.Collection`, which
+    keeps documents in memory, see :mod:`minimongo.memory`; can be used as
+    ``collection_class`` of a model, or for all of them via
+    :func:`~minimongo.configure`.
+
+    Unlike the pymongo one, :attr:`database` of a memory collection is
+    a :class:`MemoryDatabase` with the same name as the model's database.
+    Writes follow the write concern of the model's connection: errors of
+    unacknowledged writes aren't reported.
+    """
+
+    def __init__(self, database, name, document_class):
+        self.document_class = document_class
+        self.name = name
+        self.full_name = '%s.%s' % (database.name, name)
+        self._tz_aware = getattr(getattr(database, 'connection', None),
+                                 'tz_aware', False)
+        self._write_mode = getattr(database, '_get_write_mode', None)
+        self.database = get_database(database.name)
+        self._documents = self.database._documents(name)
+
+    def __repr__(self):
+        return 'MemoryCollection(%r, %r)' % (self.database, self.name)
+
+    def find(self, *args, **kwargs):
+        """Same as :meth:`minimongo.Collection.find`."""
+        return MemoryCursor(self, *args, wrap=self.document_class, **kwargs)
+
+    def _fetch_one(self, spec_or_id, *args, **kwargs):
+        if spec_or_id is not None and not isinstance(spec_or_id, dict):
+            spec_or_id = {'_id': spec_or_id}
+        kwargs.setdefault('as_class', _as_class(self.document_class))
+        cursor = MemoryCursor(self, spec_or_id, *args, **kwargs)
+        cursor._single = True
+        for data in cursor.limit(-1):
+            return data
+        return None
+
+    def _decode_cached(self, data, as_class):
+        return BSON(data).decode(as_class, self._tz_aware)
+
+    def _export_cursor(self, query, projection, batch_size):
+        return MemoryCursor(self, query, projection)
+
+    def _acknowledged(self, safe, options):
+        """Checks whether a write with given `safe` and write concern
+        `options` would be acknowledged by the connection, the way pymongo
+        does."""
+        if self._write_mode is None:
+            return True
+        return self._write_mode(safe, **options)[0]
+
+    def count(self):
+        return self.find().count()
+
+    def distinct(self, key):
+        return self.find().distinct(key)
+
+    def insert(self, doc_or_docs, manipulate=True, safe=None,
+               check_keys=True, continue_on_error=False, **kwargs):
+        """Same as :meth:`pymongo.collection.Collection.insert`."""
+        acknowledged = self._acknowledged(safe, kwargs)
+        self._invalidate_cache()
+        single = isinstance(doc_or_docs, dict)
+        documents = [doc_or_docs] if single else list(doc_or_docs)
+        for idx, document in enumerate(documents):
+            if '_id' not in document:
+                if manipulate:
+                    document['_id'] = ObjectId()
+                else:
+                    documents[idx] = dict(document, _id=ObjectId())
+
+        error = None
+        for data in [_encode(document, check_keys) for document in documents]:
+            try:
+                self._documents.insert(data)
+            except DuplicateKeyError as excn:
+                error = excn
+                if not continue_on_error:
+                    break
+
+        if error is not None and acknowledged:
+            raise error
+        ids = [document['_id'] for document in documents]
+        return ids[0] if single else ids
+
+    def save(self, to_save, manipulate=True, safe=None, check_keys=True,
+             **kwargs):
+        """Same as :meth:`pymongo.collection.Collection.save`."""
+        if not isinstance(to_save, dict):
+            raise TypeError('cannot save object of type %s' % type(to_save))
+        if '_id' not in to_save:
+            return self.insert(to_save, manipulate, safe, check_keys,
+                               **kwargs)
+
+        acknowledged = self._acknowledged(safe, kwargs)
+        self._invalidate_cache()
+        data = _encode(to_save, check_keys)
+        documents = self._documents
+        try:
+            with documents.lock:
+                pk = _key(to_save['_id'])
+                if pk in documents.records:
+                    documents.replace(pk, data)
+                else:
+                    documents.insert(data)
+        except OperationFailure:
+            if acknowledged:
+                raise
+        return to_save['_id']
+
+    def update(self, spec, document, upsert=False, manipulate=False,
+               safe=None, multi=False, check_keys=True, **kwargs):
+        """Same as :meth:`pymongo.collection.Collection.update`."""
+        if not isinstance(spec, dict):
+            raise TypeError('spec must be an instance of dict')
+        if not isinstance(document, dict):
+            raise TypeError('document must be an instance of dict')
+        acknowledged = self._acknowledged(safe, kwargs)
+        self._invalidate_cache()
+        with self._recording('update', spec):
+            try:
+                result = self._update(spec, document, upsert, multi)
+            except OperationFailure:
+                if acknowledged:
+                    raise
+                return None
+        return result if acknowledged else None
+
+    def _update(self, spec, document, upsert=False, multi=False):
+        operators = _is_operators(document)
+        if not operators:
+            if any(key.startswith('$') for key in document):
+                raise OperationFailure(
+                    "Can't mix update operators with document fields")
+            if multi:
+                raise OperationFailure(
+                    'multi update only works with $ operators')
+
+        documents = self._documents
+        with documents.lock:
+            _, _, records = documents.query(spec)
+            if not multi:
+                records = records[:1]
+            modified = 0
+            for record in records:
+                new = _updated(record, document, operators)
+                if _key(new) != _key(record.document):
+                    documents.replace(_key(new['_id']), _encode(new))
+                    modified += 1
+
+            result = {'ok': 1.0, 'err': None, 'n': len(records),
+                      'nModified': modified,
+                      'updatedExisting': bool(records)}
+            if not records and upsert:
+                new = _upserted(spec, document, operators)
+                documents.insert(_encode(new))
+                result['n'] = 1
+                result['upserted'] = new['_id']
+        return result
+
+    def remove(self, spec_or_id=None, safe=None, multi=True, **kwargs):
+        """Same as :meth:`pymongo.collection.Collection.remove`."""
+        if spec_or_id is None:
+            spec = {}
+        elif not isinstance(spec_or_id, dict):
+            spec = {'_id': spec_or_id}
+        else:
+            spec = spec_or_id
+
+        acknowledged = self._acknowledged(safe, kwargs)
+        self._invalidate_cache()
+        documents = self._documents
+        with self._recording('remove', spec_or_id), documents.lock:
+            _, _, records = documents.query(spec)
+            if not multi:
+                records = records[:1]
+            for record in records:
+                documents.delete(_key(record.document['_id']))
+        if acknowledged:
+            return {'ok': 1.0, 'err': None, 'n': len(records)}
+        return None
+
+    def find_and_modify(self, query={}, update=None, upsert=False,
+                        sort=None, full_response=False, manipulate=False,
+                        **kwargs):
+        """Same as :meth:`pymongo.collection.Collection.find_and_modify`,
+        returns a plain :class:`dict`."""
+        remove = kwargs.get('remove', False)
+        if not update and not remove:
+            raise ValueError('Must either update or remove')
+        if update and remove:
+            raise ValueError("Can't do both update and remove")
+
+        if isinstance(sort, dict):
+            sort = sort.items()
+        self._invalidate_cache()
+        documents = self._documents
+        with documents.lock:
+            _, _, records = documents.query(query)
+            if sort:
+                _sort(records, helpers._index_list(sort))
+            old = records[0] if records else None
+            new = upserted = None
+            if old is None:
+                if upsert and not remove:
+                    upserted = self._update(query, update,
+                                            upsert=True)['upserted']
+                    new = documents.records[_key(upserted)]
+            elif remove:
+                documents.delete(_key(old.document['_id']))
+            else:
+                self._update({'_id': old.document['_id']}, update)
+                new = documents.records[_key(old.document['_id'])]
+
+            record = new if kwargs.get('new') and not remove else old
+            value = None
+            if record is not None:
+                value = BSON(record.data).decode(dict, self._tz_aware)
+                fields = kwargs.get('fields')
+                if isinstance(fields, (list, tuple)):
+                    fields = helpers._fields_list_to_dict(fields)
+                if fields is not None:
+                    value = _project(value, fields, dict)
+
+        if not full_response:
+            return value
+        last_error = {'n': int(old is not None or upserted is not None),
+                      'updatedExisting': old is not None and not remove}
+        if upserted is not None:
+            last_error['upserted'] = upserted
+        return {'ok': 1.0, 'value': value, 'lastErrorObject': last_error}
+
+    def drop(self):
+        self._invalidate_cache()
+        self._documents.clear()
+
+    def save_many(self, documents, ordered=False, batch_size=1000,
+                  write_concern=None):
+        """Same as :meth:`minimongo.Collection.save_many`; there're no
+        batches, since nothing is sent over the network."""
+        result = {'writeErrors': [], 'writeConcernErrors': [],
+                  'nInserted': 0, 'nUpserted': 0, 'nMatched': 0,
+                  'nModified': 0, 'nRemoved': 0, 'upserted': []}
+        self._invalidate_cache()
+        for idx, document in enumerate(documents):
+            batch_result = {}
+            try:
+                if '_id' not in document:
+                    document['_id'] = ObjectId()
+                    self._documents.insert(_encode(document))
+                    batch_result['nInserted'] = 1
+                else:
+                    update = self._update({'_id': document['_id']},
+                                          document, upsert=True)
+                    if 'upserted' in update:
+                        batch_result['nUpserted'] = 1
+                        batch_result['upserted'] = [
+                            {'index': 0, '_id': update['upserted']}]
+                    else:
+                        batch_result['nMatched'] = 1
+                        batch_result['nModified'] = update['nModified']
+            except DuplicateKeyError as excn:
+                batch_result['writeErrors'] = [{
+                    'index': 0, 'code': excn.code, 'errmsg': str(excn),
+                    'op': document}]
+            _merge_bulk_result(result, batch_result, idx)
+            if ordered and batch_result.get('writeErrors'):
+                break
+
+        if result['writeErrors']:
+            raise BulkWriteError(result)
+        return result
+
+    def initialize_ordered_bulk_op(self):
+        """Same as :meth:`pymongo.collection.Collection.
+        initialize_ordered_bulk_op`."""
+        return MemoryBulkOperation(self, ordered=True)
+
+    def initialize_unordered_bulk_op(self):
+        """Same as :meth:`pymongo.collection.Collection.
+        initialize_unordered_bulk_op`."""
+        return MemoryBulkOperation(self, ordered=False)
+
+    def create_index(self, key_or_list, cache_for=300, **kwargs):
+        """Same as :meth:`pymongo.collection.Collection.create_index`."""
+        keys = helpers._index_list(key_or_list)
+        if 'drop_dups' in kwargs:
+            kwargs['dropDups'] = kwargs.pop('drop_dups')
+        if 'bucket_size' in kwargs:
+            kwargs['bucketSize'] = kwargs.pop('bucket_size')
+        name = kwargs.pop('name', None) or _gen_index_name(keys)
+        kwargs.pop('ttl', None)
+        self._invalidate_cache()
+        self._documents.create_index(name, keys, **kwargs)
+        return name
+
+    ensure_index = create_index
+
+    def index_information(self):
+        """Same as :meth:`pymongo.collection.Collection.index_information`."""
+        with self._documents.lock:
+            return dict((index.name, index.information())
+                        for index in self._documents.indices.itervalues())
+
+    def drop_index(self, index_or_name):
+        """Drops an index, given its name or keys."""
+        name = index_or_name
+        if not isinstance(index_or_name, basestring):
+            name = _gen_index_name(helpers._index_list(index_or_name))
+        if name == '_id_':
+            raise OperationFailure('cannot drop _id index')
+        with self._documents.lock:
+            if self._documents.indices.pop(name, None) is None:
+                raise OperationFailure(
+                    'index not found with name [%s]' % name, 27)
+
+    def drop_indexes(self):
+        with self._documents.lock:
+            for name in list(self._documents.indices):
+                if name != '_id_':
+                    del self._documents.indices[name]
+
+
+class MemoryBulkOperation(object):
+    """Same as :class:`pymongo.bulk.BulkOperationBuilder`, for a memory
+    collection; operations are executed one by one, in the order they
+    were added, and unordered execution only differs in that it doesn't
+    stop on the first error."""
+
+    def __init__(self, collection, ordered=True):
+        self.collection = collection
+        self.ordered = ordered
+        self._operations = []
+        self._executed = False
+
+    def find(self, selector):
+        if not isinstance(selector, dict):
+            raise TypeError('selector must be an instance of dict')
+        return _MemoryBulkSelector(self, selector)
+
+    def insert(self, document):
+        if not isinstance(document, dict):
+            raise TypeError('document must be an instance of dict')
+        if '_id' not in document:
+            document['_id'] = ObjectId()
+        self._operations.append(('insert', document))
+
+    def execute(self, write_concern=None):
+        """Executes the operations, returns the result in the same format
+        pymongo does, or ``None`` for unacknowledged writes."""
+        if not self._operations:
+            raise InvalidOperation('No operations to execute')
+        if self._executed:
+            raise InvalidOperation('Bulk operations can only be executed '
+                                   'once.')
+        self._executed = True
+        collection = self.collection
+        acknowledged = collection._acknowledged(None, write_concern or {})
+        collection._invalidate_cache()
+
+        result = {'writeErrors': [], 'writeConcernErrors': [],
+                  'nInserted': 0, 'nUpserted': 0, 'nMatched': 0,
+                  'nModified': 0, 'nRemoved': 0, 'upserted': []}
+        documents = collection._documents
+        for idx, (operation, args) in enumerate(self._operations):
+            try:
+                if operation == 'insert':
+                    documents.insert(_encode(args))
+                    result['nInserted'] += 1
+                elif operation == 'update':
+                    selector, document, upsert, multi = args
+                    update = collection._update(selector, document, upsert,
+                                                multi)
+                    if 'upserted' in update:
+                        result['nUpserted'] += 1
+                        result['upserted'].append(
+                            {'index': idx, '_id': update['upserted']})
+                    else:
+                        result['nMatched'] += update['n']
+                        result['nModified'] += update['nModified']
+                else:
+                    selector, multi = args
+                    with documents.lock:
+                        _, _, records = documents.query(selector)
+                        for record in records if multi else records[:1]:
+                            documents.delete(_key(record.document['_id']))
+                            result['nRemoved'] += 1
+            except OperationFailure as excn:
+                result['writeErrors'].append({
+                    'index': idx, 'code': excn.code or 8,
+                    'errmsg': str(excn), 'op': args})
+                if self.ordered:
+                    break
+
+        if not acknowledged:
+            return None
+        if result['writeErrors']:
+            raise BulkWriteError(result)
+        return result
+
+
+class _MemoryBulkSelector(object):
+    """Operations on the documents, matching a selector, see
+    :meth:`MemoryBulkOperation.find`."""
+
+    def __init__(self, bulk, selector, upsert=False):
+        self._bulk = bulk
+        self._selector = selector
+        self._upsert = upsert
+
+    def upsert(self):
+        return _MemoryBulkSelector(self._bulk, self._selector, upsert=True)
+
+    def update_one(self, update):
+        self._add_update(update, multi=False)
+
+    def update(self, update):
+        self._add_update(update, multi=True)
+
+    def replace_one(self, replacement):
+        if _is_operators(replacement):
+            raise ValueError('replacement can not include $ operators')
+        self._bulk._operations.append(
+            ('update', (self._selector, replacement, self._upsert, False)))
+
+    def remove_one(self):
+        self._bulk._operations.append(('remove', (self._selector, False)))
+
+    def remove(self):
+        self._bulk._operations.append(('remove', (self._selector, True)))
+
+    def _add_update(self, update, multi):
+        if not _is_operators(update):
+            raise ValueError('update only works with $ operators')
+        self._bulk._operations.append(
+            ('update', (self._selector, update, self._upsert, multi)))
+
+
+class _Record(object):
+    """A stored document: its position in the collection, the decoded
+    document, which queries match, and its BSON, which is returned."""
+
+    __slots__ = ('seq', 'document', 'data')
+
+    def __init__(self, seq, document, data):
+        self.seq = seq
+        self.document = document
+        self.data = data
+
+
+class _Documents(object):
+    """Documents and indices of a single collection; all of the writes
+    are done with :attr:`lock` held."""
+
+    def __init__(self, full_name):
+        self.full_name = full_name
+        self.lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.records = OrderedDict()  # In the insertion order.
+            self.indices = OrderedDict()
+            self._seq = count()
+            self.create_index('_id_', [('_id', 1)], unique=True)
+
+    def insert(self, data):
+        document = BSON(data).decode()
+        pk = _key(document['_id'])
+        with self.lock:
+            if pk in self.records:
+                raise DuplicateKeyError(
+                    'E11000 duplicate key error index: %s.$_id_ dup key: '
+                    '%r' % (self.full_name, document['_id']), 11000)
+            self._check_unique(pk, document)
+            for index in self.indices.itervalues():
+                index.add(pk, document)
+            self.records[pk] = _Record(next(self._seq), document, data)
+
+    def replace(self, pk, data):
+        document = BSON(data).decode()
+        with self.lock:
+            record = self.records[pk]
+            self._check_unique(pk, document)
+            for index in self.indices.itervalues():
+                index.discard(pk, record.document)
+                index.add(pk, document)
+            record.document, record.data = document, data
+
+    def delete(self, pk):
+        with self.lock:
+            record = self.records.pop(pk)
+            for index in self.indices.itervalues():
+                index.discard(pk, record.document)
+
+    def _check_unique(self, pk, document):
+        for index in self.indices.itervalues():
+            if not index.unique:
+                continue
+            for key in index.keys_of(document):
+                owners = index.entries.get(key)
+                if owners and (len(owners) > 1 or pk not in owners):
+                    raise DuplicateKeyError(
+                        'E11000 duplicate key error index: %s.$%s '
+                        'dup key: %r' % (self.full_name, index.name,
+                                         index.values_of(document)), 11000)
+
+    def create_index(self, name, keys, unique=False, sparse=False,
+                     dropDups=False, **options):
+        with self.lock:
+            if name in self.indices:
+                return  # Already there.
+
+            index = MemoryIndex(name, keys, unique, sparse, **options)
+            for pk, record in self.records.items():
+                if unique:
+                    for key in index.keys_of(record.document):
+                        if key in index.entries:
+                            if not dropDups:
+                                raise DuplicateKeyError(
+                                    'E11000 duplicate key error index: '
+                                    '%s.$%s dup key: %r' % (
+                                        self.full_name, name,
+                                        index.values_of(record.document)),
+                                    11000)
+                            self.delete(pk)
+                            break
+                    else:
+                        index.add(pk, record.document)
+                else:
+                    index.add(pk, record.document)
+            self.indices[name] = index
+
+    def query(self, spec, hint=None):
+        """Returns the name of the index used (or ``None``), the number
+        of examined documents and a list of records, matching a given
+        `spec`, in natural order."""
+        with self.lock:
+            index, bounds = self._plan(spec, hint)
+            if bounds is None:
+                candidates = self.records.values()
+            else:
+                pks = set()
+                for prefix, low, high in bounds:
+                    pks.update(index.scan(prefix, low, high))
+                candidates = sorted((self.records[pk] for pk in pks),
+                                    key=operator.attrgetter('seq'))
+        records = [record for record in candidates
+                   if _matches(record.document, spec)]
+        return index and index.name, len(candidates), records
+
+    def _plan(self, spec, hint=None):
+        """Returns the index to use for a given `spec` along with its
+        bounds (see :meth:`MemoryIndex.bounds`), or ``(None, None)`` for
+        a collection scan."""
+        if hint is not None:
+            index = self.indices.get(hint)
+            if index is None:
+                raise OperationFailure('bad hint')
+            score, bounds = index.bounds(spec)
+            return index, bounds if score else None
+
+        best, best_score, best_bounds = None, 0, None
+        for index in self.indices.itervalues():
+            if index.sparse:
+                continue  # Doesn't point to documents without the fields.
+            score, bounds = index.bounds(spec)
+            if score > best_score:
+                best, best_score, best_bounds = index, score, bounds
+        return best, best_bounds
+
+
+class MemoryIndex(object):
+    """An in-memory index: a hash of index keys to ``_id`` keys of the
+    documents, for exact lookups, and a sorted list of index keys, for
+    prefix and range scans. Fields with array values are indexed by each
+    of their elements."""
+
+    def __init__(self, name, keys, unique=False, sparse=False, **options):
+        self.name = name
+        self.keys = list(keys)
+        self.unique = unique
+        self.sparse = sparse
+        self.options = options
+        self.entries = {}
+        self.multikey = False
+        self._sorted = []
+        self._paths = [field.split('.') for field, _ in self.keys]
+
+    def information(self):
+        information = dict(self.options, key=self.keys)
+        if self.unique and self.name != '_id_':
+            information['unique'] = True
+        if self.sparse:
+            information['sparse'] = True
+        return information
+
+    def keys_of(self, document):
+        """Returns index keys of a given `document`."""
+        fields, present = [], False
+        for path in self._paths:
+            values = _resolve(document, path)
+            present = present or bool(values)
+            keys = set(_key(value) for value in _expand(values, arrays=False))
+            fields.append(keys or set([_key(None)]))
+        if self.sparse and not present:
+            return []
+        return list(product(*fields))
+
+    def values_of(self, document):
+        """Returns indexed values of a given `document`, for messages."""
+        return tuple((_resolve(document, path) or [None])[0]
+                     for path in self._paths)
+
+    def add(self, pk, document):
+        keys = self.keys_of(document)
+        if len(keys) > 1:
+            self.multikey = True
+        for key in keys:
+            pks = self.entries.get(key)
+            if pks is None:
+                pks = self.entries[key] = set()
+                insort(self._sorted, key)
+            pks.add(pk)
+
+    def discard(self, pk, document):
+        for key in self.keys_of(document):
+            pks = self.entries.get(key)
+            if pks is None:
+                continue
+            pks.discard(pk)
+            if not pks:
+                del self.entries[key]
+                del self._sorted[bisect_left(self._sorted, key)]
+
+    def bounds(self, spec):
+        """Returns a score of the index for a given query `spec` (twice
+        the number of leading fields matched exactly, plus one for a range
+        on the next one) and a list of ``(prefix, low, high)`` bounds to
+        :meth:`scan`."""
+        prefixes, low, high = [()], None, None
+        for field, _ in self.keys:
+            condition = spec.get(field, _MISSING)
+            values = _equality_values(condition)
+            if values is None:
+                low, high = _range_bounds(condition, self.multikey)
+                break
+            prefixes = [prefix + (_key(value), ) for prefix in prefixes
+                        for value in values]
+            if not prefixes:
+                return 2 * len(self.keys), []  # $in without any values.
+
+        score = 2 * len(prefixes[0]) + (low is not None)
+        return score, [(prefix, low, high) for prefix in prefixes]
+
+    def scan(self, prefix, low=None, high=None):
+        """Returns ``_id`` keys of the documents with index keys, which
+        start with a given `prefix`, optionally followed by a key between
+        `low` and `high`, inclusive."""
+        depth = len(prefix)
+        if depth == len(self.keys):
+            return self.entries.get(prefix, ())  # Exact lookup.
+
+        start = prefix if low is None else prefix + (low, )
+        pks = set()
+        for key in islice(self._sorted, bisect_left(self._sorted, start),
+                          None):
+            if key[:depth] != prefix or \
+               high is not None and key[depth] > high:
+                break
+            pks.update(self.entries[key])
+        return pks
+
+
+def _encode(document, check_keys=True):
+    """Returns BSON of a given `document`, the same way it'd be sent to
+    the server."""
+    return BSON.encode(document, check_keys)
+
+
+# Ranks of BSON types in the order MongoDB compares and sorts them.
+_MIN_KEY, _NULL, _NUMBER, _STRING, _OBJECT, _ARRAY, _BINARY, _OBJECT_ID, \
+    _BOOLEAN, _DATE, _TIMESTAMP, _REGEX, _CODE, _OTHER, _MAX_KEY = range(15)
+
+_REGEX_TYPE = type(re.compile(''))
+
+# Flags of regular expressions by options of $regex.
+_REGEX_FLAGS = {'i': re.I, 'm': re.M, 's': re.S, 'x': re.X}
+
+# Marks a missing field of a query.
+_MISSING = object()
+
+
+def _key(value):
+    """Returns a hashable key of a given BSON `value`, which compares and
+    sorts the way MongoDB does: by the type rank first, then by value."""
+    if value is None:
+        return (_NULL, )
+    elif isinstance(value, bool):
+        return (_BOOLEAN, value)
+    elif isinstance(value, (int, long, float)):
+        return (_NUMBER, value)
+    elif isinstance(value, Binary):
+        return (_BINARY, value.subtype, str(value))
+    elif isinstance(value, Code):
+        return (_CODE, str(value))
+    elif isinstance(value, str):
+        return (_STRING, value.decode('utf-8'))
+    elif isinstance(value, unicode):
+        return (_STRING, value)
+    elif isinstance(value, DBRef):
+        return _key(value.as_doc())
+    elif isinstance(value, SON):
+        return (_OBJECT, tuple((key, _key(nested))
+                               for key, nested in value.iteritems()))
+    elif isinstance(value, dict):
+        return (_OBJECT, tuple(sorted((key, _key(nested))
+                                      for key, nested in value.iteritems())))
+    elif isinstance(value, (list, tuple)):
+        return (_ARRAY, tuple(_key(nested) for nested in value))
+    elif isinstance(value, ObjectId):
+        return (_OBJECT_ID, value.binary)
+    elif isinstance(value, datetime):
+        # Aware datetimes are stored in UTC.
+        return (_DATE, value.replace(tzinfo=None) -
+                (value.utcoffset() or timedelta()))
+    elif isinstance(value, Timestamp):
+        return (_TIMESTAMP, value.time, value.inc)
+    elif isinstance(value, _REGEX_TYPE):
+        return (_REGEX, value.pattern, value.flags)
+    elif isinstance(value, MinKey):
+        return (_MIN_KEY, )
+    elif isinstance(value, MaxKey):
+        return (_MAX_KEY, )
+    return (_OTHER, repr(value))
+
+
+def _resolve(value, parts):
+    """Returns a list of values under a dotted path, split into `parts`,
+    descending into arrays of documents, the way MongoDB queries do; an
+    empty list if there's none."""
+    if not parts:
+        return [value]
+
+    head, rest = parts[0], parts[1:]
+    if isinstance(value, dict):
+        if head in value:
+            return _resolve(value[head], rest)
+        return []
+    elif isinstance(value, list):
+        values = []
+        if head.isdigit() and int(head) < len(value):
+            values.extend(_resolve(value[int(head)], rest))
+        for item in value:
+            if isinstance(item, dict):
+                values.extend(_resolve(item, parts))
+        return values
+    return []
+
+
+def _expand(values, arrays=True):
+    """Returns given `values` along with the elements of the arrays among
+    them; arrays themselves are only included if `arrays` is ``True``."""
+    expanded = []
+    for value in values:
+        if isinstance(value, list):
+            if arrays:
+                expanded.append(value)
+            expanded.extend(value)
+        else:
+            expanded.append(value)
+    return expanded
+
+
+def _is_operators(value):
+    """Checks whether a given value is a dict of ``$`` operators."""
+    return isinstance(value, dict) and bool(value) and \
+        all(key.startswith('$') for key in value)
+
+
+def _is_indexable(value):
+    return not isinstance(value, (list, _REGEX_TYPE)) and \
+        not _is_operators(value)
+
+
+def _equality_values(condition):
+    """Returns a list of values a field is matched to exactly by a given
+    query `condition`, or ``None`` if it matches otherwise."""
+    if condition is _MISSING:
+        return None
+    elif not _is_operators(condition):
+        values = [condition]
+    elif '$eq' in condition:
+        values = [condition['$eq']]
+    elif isinstance(condition.get('$in'), list):
+        values = condition['$in']
+    else:
+        return None
+    return values if all(_is_indexable(value) for value in values) else None
+
+
+def _range_bounds(condition, multikey=False):
+    """Returns ``(low, high)`` index keys, a given range `condition` is
+    within, either of which can be ``None``."""
+    if not _is_operators(condition):
+        return None, None
+
+    low = high = None
+    for operator_ in ('$gt', '$gte'):
+        if operator_ in condition and _is_indexable(condition[operator_]):
+            low = _key(condition[operator_])
+    for operator_ in ('$lt', '$lte'):
+        if operator_ in condition and _is_indexable(condition[operator_]):
+            high = _key(condition[operator_])
+
+    # Ranges only match values of the same type.
+    if low is not None and (high is None or multikey):
+        # Different elements of an array may satisfy either of the bounds,
+        # so only one of them is used for multikey indices.
+        high = (low[0] + 1, )
+    elif high is not None and low is None:
+        low = (high[0], )
+    return low, high
+
+
+def _matches(document, spec):
+    """Checks whether a given `document` matches a query `spec`."""
+    for key, condition in spec.iteritems():
+        if key == '$and':
+            matches = all(_matches(document, nested) for nested in condition)
+        elif key == '$or':
+            matches = any(_matches(document, nested) for nested in condition)
+        elif key == '$nor':
+            matches = not any(_matches(document, nested)
+                              for nested in condition)
+        elif key == '$comment':
+            continue
+        elif key.startswith('$'):
+            raise OperationFailure('unsupported query operator: %s' % key)
+        else:
+            matches = _match_condition(_resolve(document, key.split('.')),
+                                       condition)
+        if not matches:
+            return False
+    return True
+
+
+def _match_condition(values, condition):
+    """Checks whether any of the `values` of a field match a given
+    condition: either a value or a dict of operators."""
+    if not _is_operators(condition):
+        return _match_value(values, condition)
+
+    for operator_, argument in condition.iteritems():
+        if operator_ == '$options':
+            continue
+        elif operator_ == '$regex':
+            matches = _match_regex(values, _compile(argument,
+                                                    condition.get('$options')))
+        else:
+            match = _QUERY_OPERATORS.get(operator_)
+            if match is None:
+                raise OperationFailure('unknown operator: %s' % operator_)
+            matches = match(values, argument)
+        if not matches:
+            return False
+    return True
+
+
+def _match_value(values, value):
+    if isinstance(value, _REGEX_TYPE):
+        return _match_regex(values, value)
+    elif value is None and not values:
+        return True  # Missing fields are null.
+    key = _key(value)
+    return any(_key(nested) == key for nested in _expand(values))
+
+
+def _match_regex(values, regex):
+    return any(isinstance(value, basestring) and regex.search(value)
+               for value in _expand(values))
+
+
+def _compile(pattern, options=None):
+    if isinstance(pattern, _REGEX_TYPE):
+        return pattern
+    flags = 0
+    for option in options or '':
+        flags |= _REGEX_FLAGS.get(option, 0)
+    return re.compile(pattern, flags)
+
+
+def _comparison(compare):
+    def match(values, argument):
+        key = _key(argument)
+        for value in _expand(values):
+            value_key = _key(value)
+            # Only values of the same type are compared.
+            if value_key[0] == key[0] and compare(value_key, key):
+                return True
+        return False
+    return match
+
+
+def _match_in(values, argument):
+    if not isinstance(argument, list):
+        raise OperationFailure('$in needs an array')
+    return any(_match_value(values, value) for value in argument)
+
+
+def _match_all(values, argument):
+    if not isinstance(argument, list):
+        raise OperationFailure('$all needs an array')
+    return bool(argument) and all(_match_value(values, value)
+                                  for value in argument)
+
+
+def _match_elements(values, condition):
+    for value in values:
+        if not isinstance(value, list):
+            continue
+        for item in value:
+            if _is_operators(condition):
+                if _match_condition([item], condition):
+                    return True
+            elif isinstance(item, dict) and _matches(item, condition):
+                return True
+    return False
+
+
+def _match_mod(values, argument):
+    divisor, remainder = argument
+    return any(isinstance(value, (int, long, float)) and
+               not isinstance(value, bool) and
+               value % divisor == remainder for value in _expand(values))
+
+
+# Python types of the BSON type numbers $type can match.
+_TYPE_NUMBERS = {1: float, 2: basestring, 3: dict, 4: list, 7: ObjectId,
+                 8: bool, 9: datetime, 10: type(None), 16: int, 18: long}
+
+
+def _match_type(values, argument):
+    python_type = _TYPE_NUMBERS.get(argument)
+    if python_type is None:
+        raise OperationFailure('unsupported $type: %r' % argument)
+    return any(isinstance(value, python_type) and
+               (python_type is bool or not isinstance(value, bool))
+               for value in _expand(values))
+
+
+_QUERY_OPERATORS = {
+    '$eq': _match_value,
+    '$ne': lambda values, argument: not _match_value(values, argument),
+    '$gt': _comparison(operator.gt),
+    '$gte': _comparison(operator.ge),
+    '$lt': _comparison(operator.lt),
+    '$lte': _comparison(operator.le),
+    '$in': _match_in,
+    '$nin': lambda values, argument: not _match_in(values, argument),
+    '$all': _match_all,
+    '$exists': lambda values, argument: bool(values) == bool(argument),
+    '$size': lambda values, argument: any(
+        isinstance(value, list) and len(value) == argument
+        for value in values),
+    '$elemMatch': _match_elements,
+    '$not': lambda values, argument: not _match_condition(values, argument),
+    '$mod': _match_mod,
+    '$type': _match_type,
+}
+
+
+def _sort(records, ordering):
+    """Sorts `records` in place by an ``[(field, direction)]`` list."""
+    # Stable sorts, from the least significant field to the most one.
+    for field, direction in reversed(ordering):
+        if field == '$natural':
+            if direction < 0:
+                records.reverse()
+            continue
+
+        path = field.split('.')
+        # Arrays are sorted by their smallest element in ascending
+        # order, and by the largest one in descending order.
+        choose = min if direction > 0 else max
+
+        def sort_key(record):
+            keys = [_key(value) for value in
+                    _expand(_resolve(record.document, path), arrays=False)]
+            return choose(keys) if keys else (_NULL, )
+
+        records.sort(key=sort_key, reverse=direction < 0)
+
+
+def _project(document, fields, as_class):
+    """Returns a given `document` with only the given `fields`, as
+    :meth:`find` does."""
+    if any(isinstance(value, dict) for value in fields.itervalues()):
+        raise OperationFailure('unsupported projection: %r' % fields)
+
+    included = [field for field, value in fields.iteritems()
+                if value and field != '_id']
+    if included:
+        projected = as_class()
+        if fields.get('_id', True) and '_id' in document:
+            projected['_id'] = document['_id']
+        for field in included:
+            _copy_path(document, projected, field.split('.'), as_class)
+        return projected
+
+    for field, value in fields.iteritems():
+        if not value:
+            _delete_path(document, field.split('.'))
+    return document
+
+
+def _copy_path(source, target, parts, as_class):
+    head = parts[0]
+    if head not in source:
+        return
+    value = source[head]
+    if len(parts) == 1:
+        target[head] = value
+    elif isinstance(value, dict):
+        _copy_path(value, target.setdefault(head, as_class()), parts[1:],
+                   as_class)
+    elif isinstance(value, list):
+        items = target.setdefault(head, [as_class() for item in value
+                                         if isinstance(item, dict)])
+        for item, projected in zip([item for item in value
+                                    if isinstance(item, dict)], items):
+            _copy_path(item, projected, parts[1:], as_class)
+
+
+def _delete_path(value, parts):
+    if isinstance(value, list):
+        for item in value:
+            _delete_path(item, parts)
+    elif isinstance(value, dict) and parts[0] in value:
+        if len(parts) == 1:
+            del value[parts[0]]
+        else:
+            _delete_path(value[parts[0]], parts[1:])
+
+
+def _updated(record, update, operators):
+    """Returns a new version of a stored record's document, updated with
+    a given update document or replaced by it."""
+    document = BSON(record.data).decode()
+    if not operators:
+        replacement = dict(update)
+        if '_id' in replacement and \
+           _key(replacement['_id']) != _key(document['_id']):
+            raise OperationFailure('The _id field cannot be changed')
+        replacement['_id'] = document['_id']
+        return replacement
+
+    _apply_update(document, update)
+    if _key(document.get('_id')) != _key(record.document['_id']):
+        raise OperationFailure('The _id field cannot be changed')
+    return document
+
+
+def _upserted(spec, update, operators):
+    """Returns a document to insert for an upsert, which didn't match any
+    of the documents."""
+    if not operators:
+        document = dict(update)
+        if '_id' not in document and '_id' in spec and \
+           _is_indexable(spec['_id']):
+            document['_id'] = spec['_id']
+    else:
+        document = {}
+        for key, condition in spec.iteritems():
+            if key.startswith('$'):
+                continue
+            if _is_operators(condition):
+                if '$eq' in condition:
+                    _set(document, key, condition['$eq'])
+            elif not isinstance(condition, _REGEX_TYPE):
+                _set(document, key, condition)
+        _apply_update(document, update, inserting=True)
+
+    if '_id' not in document:
+        document['_id'] = ObjectId()
+    return document
+
+
+def _apply_update(document, update, inserting=False):
+    for operator_, fields in update.iteritems():
+        apply_ = _UPDATE_OPERATORS.get(operator_)
+        if apply_ is None:
+            raise OperationFailure('Unknown modifier: %s' % operator_)
+        if operator_ == '$setOnInsert' and not inserting:
+            continue
+        for path, argument in fields.iteritems():
+            if path.startswith('$') or '.$' in path:
+                raise OperationFailure(
+                    'unsupported positional update of %r' % path)
+            apply_(document, path, argument)
+
+
+def _parent(document, path, create=False):
+    """Returns ``(container, key)`` for a dotted `path` in a given
+    `document`, creating missing documents on the way if `create` is
+    ``True``; container is ``None`` if there's none."""
+    parts = path.split('.')
+    container = document
+    for part in parts[:-1]:
+        if isinstance(container, list):
+            if not part.isdigit():
+                raise OperationFailure(
+                    'cannot use the part (%s of %s) to traverse the element'
+                    % (part, path))
+            idx = int(part)
+            if idx >= len(container):
+                if not create:
+                    return None, parts[-1]
+                container.extend([None] * (idx + 1 - len(container)))
+            child = container[idx]
+            if child is None and create:
+                child = container[idx] = {}
+        else:
+            child = container.get(part)
+            if child is None and create:
+                child = container[part] = {}
+        if child is None:
+            return None, parts[-1]
+        if not isinstance(child, (dict, list)):
+            raise OperationFailure(
+                'cannot use the part (%s of %s) to traverse the element'
+                % (part, path))
+        container = child
+    return container, parts[-1]
+
+
+def _get(document, path, default=None):
+    container, key = _parent(document, path)
+    if isinstance(container, list):
+        idx = int(key) if key.isdigit() else len(container)
+        return container[idx] if idx < len(container) else default
+    elif container is not None:
+        return container.get(key, default)
+    return default
+
+
+def _set(document, path, value):
+    container, key = _parent(document, path, create=True)
+    if isinstance(container, list):
+        if not key.isdigit():
+            raise OperationFailure(
+                'cannot use the part (%s of %s) to traverse the element'
+                % (key, path))
+        idx = int(key)
+        container.extend([None] * (idx + 1 - len(container)))
+        container[idx] = value
+    else:
+        container[key] = value
+
+
+def _unset(document, path, _=None):
+    container, key = _parent(document, path)
+    if isinstance(container, list):
+        if key.isdigit() and int(key) < len(container):
+            container[int(key)] = None  # Arrays keep their length.
+    elif container is not None:
+        container.pop(key, None)
+
+
+def _number(document, path, operator_):
+    value = _get(document, path, 0)
+    if not isinstance(value, (int, long, float)) or isinstance(value, bool):
+        raise OperationFailure(
+            'Cannot apply %s to a value of non-numeric type' % operator_)
+    return value
+
+
+def _array(document, path, operator_):
+    value = _get(document, path)
+    if value is None:
+        value = []
+        _set(document, path, value)
+    elif not isinstance(value, list):
+        raise OperationFailure(
+            'Cannot apply %s to a non-array field' % operator_)
+    return value
+
+
+def _inc(document, path, argument):
+    _set(document, path, _number(document, path, '$inc') + argument)
+
+
+def _mul(document, path, argument):
+    _set(document, path, _number(document, path, '$mul') * argument)
+
+
+def _min_max(compare):
+    def apply_(document, path, argument):
+        value = _get(document, path, _MISSING)
+        if value is _MISSING or compare(_key(argument), _key(value)):
+            _set(document, path, argument)
+    return apply_
+
+
+def _rename(document, path, argument):
+    value = _get(document, path, _MISSING)
+    if value is not _MISSING:
+        _unset(document, path)
+        _set(document, argument, value)
+
+
+def _push(document, path, argument):
+    values = _array(document, path, '$push')
+    if isinstance(argument, dict) and '$each' in argument:
+        position = argument.get('$position')
+        if position is None:
+            values.extend(argument['$each'])
+        else:
+            values[position:position] = argument['$each']
+        if '$slice' in argument:
+            limit = argument['$slice']
+            values[:] = values[limit:] if limit < 0 else values[:limit]
+    else:
+        values.append(argument)
+
+
+def _push_all(document, path, argument):
+    _array(document, path, '$pushAll').extend(argument)
+
+
+def _add_to_set(document, path, argument):
+    values = _array(document, path, '$addToSet')
+    if isinstance(argument, dict) and '$each' in argument:
+        new_values = argument['$each']
+    else:
+        new_values = [argument]
+    keys = set(_key(value) for value in values)
+    for value in new_values:
+        if _key(value) not in keys:
+            keys.add(_key(value))
+            values.append(value)
+
+
+def _pull(document, path, argument):
+    values = _get(document, path)
+    if not isinstance(values, list):
+        return
+    if _is_operators(argument):
+        matches = lambda value: _match_condition([value], argument)
+    elif isinstance(argument, dict):
+        matches = lambda value: isinstance(value, dict) and \
+            _matches(value, argument)
+    else:
+        matches = lambda value: _match_value([value], argument)
+    values[:] = [value for value in values if not matches(value)]
+
+
+def _pull_all(document, path, argument):
+    values = _get(document, path)
+    if isinstance(values, list):
+        keys = set(_key(value) for value in argument)
+        values[:] = [value for value in values if _key(value) not in keys]
+
+
+def _pop(document, path, argument):
+    values = _get(document, path)
+    if isinstance(values, list) and values:
+        values.pop(0 if argument < 0 else -1)
+
+
+_UPDATE_OPERATORS = {
+    '$set': _set,
+    '$setOnInsert': _set,
+    '$unset': _unset,
+    '$inc': _inc,
+    '$mul': _mul,
+    '$min': _min_max(operator.lt),
+    '$max': _min_max(operator.gt),
+    '$rename': _rename,
+    '$push': _push,
+    '$pushAll': _push_all,
+    '$addToSet': _add_to_set,
+    '$pull': _pull,
+    '$pullAll': _pull_all,
+    '$pop': _pop,
+}
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+'''
+    minimongo.metrics
+    ~~~~~~~~~~~~~~~~~
+
+    Call counts, latency histograms and numbers of returned documents of
+    database operations, by model class.
+'''
+import threading
+import time
+
+# Upper bounds of latency histogram buckets, in seconds.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metrics(object):
+    """Collects statistics of operations by model class and operation
+    name, ex: ``'find_one'``; queries of :meth:`Collection.find_one` are
+    only counted as ``'find_one'``, not as ``'find'``.
+
+    >>> registry.snapshot()[SomeModel, 'find_one']
+    {'count': 2, 'time': 0.003, 'documents': 1,
+     'buckets': [(0.0005, 0), (0.001, 1), ..., (10.0, 2)]}
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._operations = {}
+        self._lock = threading.Lock()
+
+    def timer(self, model, operation):
+        """Returns a context manager, which observes the time spent in
+        the block; the number of documents it returned can be set via
+        its ``documents`` attribute. With no `operation`, the block is
+        timed, but not recorded."""
+        return _Timer(self, model, operation)
+
+    def observe(self, model, operation, duration, documents=0):
+        """Records an `operation` of a given `model`, which took
+        `duration` seconds and returned a given number of `documents`."""
+        with self._lock:
+            stats = self._operations.get((model, operation))
+            if stats is None:
+                stats = self._operations[model, operation] = \
+                    [0, 0.0, 0, [0] * len(self.buckets)]
+            stats[0] += 1
+            stats[1] += duration
+            stats[2] += documents
+            counts = stats[3]
+            for idx, bound in enumerate(self.buckets):
+                if duration <= bound:
+                    counts[idx] += 1
+                    break
+
+    def snapshot(self):
+        """Returns a dict with ``count``, total ``time``, ``documents``
+        and cumulative histogram ``buckets`` of every operation, by
+        ``(model, operation)`` pairs."""
+        with self._lock:
+            items = [(key, (count, total, documents, list(counts)))
+                     for key, (count, total, documents, counts)
+                     in self._operations.items()]
+
+        snapshot = {}
+        for key, (count, total, documents, counts) in items:
+            buckets, cumulative = [], 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                buckets.append((bound, cumulative))
+            snapshot[key] = {'count': count, 'time': total,
+                             'documents': documents, 'buckets': buckets}
+        return snapshot
+
+    def exposition(self, prefix='minimongo'):
+        """Returns the statistics in Prometheus text exposition format."""
+        snapshot = sorted(
+            self.snapshot().items(),
+            key=lambda ((model, operation), _): (model.__name__, operation))
+        duration = prefix + '_operation_duration_seconds'
+        documents = prefix + '_documents_total'
+        lines = ['# HELP %s Duration of database operations.' % duration,
+                 '# TYPE %s histogram' % duration]
+        for (model, operation), stats in snapshot:
+            labels = 'model="%s",operation="%s"' % (model.__name__,
+                                                    operation)
+            for bound, count in stats['buckets']:
+                lines.append('%s_bucket{%s,le="%r"} %d' % (
+                    duration, labels, bound, count))
+            lines.append('%s_bucket{%s,le="+Inf"} %d' % (
+                duration, labels, stats['count']))
+            lines.append('%s_sum{%s} %r' % (duration, labels, stats['time']))
+            lines.append('%s_count{%s} %d' % (
+                duration, labels, stats['count']))
+
+        lines += ['# HELP %s Documents returned by database operations.' %
+                  documents,
+                  '# TYPE %s counter' % documents]
+        for (model, operation), stats in snapshot:
+            lines.append('%s{model="%s",operation="%s"} %d' % (
+                documents, model.__name__, operation, stats['documents']))
+        return '\n'.join(lines) + '\n'
+
+    def clear(self):
+        with self._lock:
+            self._operations.clear()
+
+
+class _Timer(object):
+
+    def __init__(self, metrics, model, operation):
+        self.metrics = metrics
+        self.model = model
+        self.operation = operation
+        self.documents = 0
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.duration = time.time() - self.started
+        if self.operation is not None:
+            self.metrics.observe(self.model, self.operation,
+                                 self.duration, self.documents)
+
+
+#: Statistics of all of the models.
+registry = Metrics()
@@ -1,11 +1,19 @@
 # -*- coding: utf-8 -*-
-import copy
-
+import hashlib
+import os
 import re
-from bson import DBRef, ObjectId
-from minimongo.collection import DummyCollection
+from collections import OrderedDict
+from functools import partial
+from multiprocessing.pool import ThreadPool
+from bson import BSON, DBRef, ObjectId
+from bson.errors import InvalidDocument
+from minimongo import connections, identity, metrics
+from minimongo.cache import QueryCache
+from minimongo.collection import DecodedDocument, DummyCollection
+from minimongo.index import create_indices
 from minimongo.options import _Options
-from pymongo import Connection
+from minimongo.writebehind import WriteBehind
+from pymongo.errors import BulkWriteError
 
 
 class ModelBase(type):
@@ -15,28 +23,50 @@ class ModelBase(type):
               populated from the parrent's Meta if any.
     """
 
-    # A very rudimentary connection pool.
-    _connections = {}
+    # Connections by MongoDB URIs and options.
+    _connections = connections.registry
+
+    # Models by (database, collection) pairs, used for dereferencing.
+    _models = {}
+
+    # Container class for model metadata.
+    _options_class = _Options
+
+    # Models, which indices weren't created yet.
+    _unindexed = set()
 
     def __new__(mcs, name, bases, attrs):
-        new_class = super(ModelBase,
-                          mcs).__new__(mcs, name, bases, attrs)
         parents = [b for b in bases if isinstance(b, ModelBase)]
         if not parents:
             # If this isn't a subclass of Model, don't do anything special.
-            return new_class
+            return super(ModelBase, mcs).__new__(mcs, name, bases, attrs)
 
-        # Processing Model metadata.
-        try:
-            meta = getattr(new_class, 'Meta')
-        except AttributeError:
-            meta = None
-        else:
-            delattr(new_class, 'Meta')  # Won't need the original metadata
-                                        # container anymore.
+        # Processing Model metadata; the original metadata container
+        # isn't needed anymore.
+        options = mcs._options_class(attrs.pop('Meta', None))
+        if (options.lazy_nested or options.lazy_fields) and \
+           not any(issubclass(base, LazyAttrDict) for base in bases):
+            # Only lazy models wrap values on access, the rest of them
+            # keep the builtin accessors of dict.
+            bases = (_LazyModel, ) + bases
+        new_class = super(ModelBase,
+                          mcs).__new__(mcs, name, bases, attrs)
 
-        options = _Options(meta)
         options.collection = options.collection or to_underscore(name)
+        new_class._field_mapper = (
+            _compile_field_map(options.field_map, options.field_map_pure)
+            if options.field_map else None)
+        new_class._compact_class = (
+            _compact_class(new_class, options.fields)
+            if options.fields else None)
+        new_class._lazy = options.lazy_nested or options.lazy_fields
+        new_class._track_changes = options.track_changes
+        # Decoded documents can only be turned into models in place, if
+        # the model doesn't customize the way fields are assigned.
+        new_class._decode_in_place = (
+            new_class.__init__.im_func is AttrDict.__init__.im_func and
+            new_class.__setitem__.im_func in (Model.__setitem__.im_func,
+                                              _LazyModel.__setitem__.im_func))
 
         if options.interface:
             new_class._meta = None
@@ -44,36 +74,69 @@ class ModelBase(type):
             new_class.collection = DummyCollection
             return new_class
 
-        if not (options.host and options.port and options.database):
+        if not ((options.uri or options.host and options.port) and
+                options.database):
             raise Exception(
                 'Model %r improperly configured: %s %s %s' % (
-                    name, options.host, options.port, options.database))
+                    name, options.uri or options.host, options.port,
+                    options.database))
 
-        # Checking connection pool for an existing connection.
-        hostport = options.host, options.port
-        if hostport in mcs._connections:
-            connection = mcs._connections[hostport]
-        else:
-            # _connect=False option
-            # creates :class:`pymongo.connection.Connection` object without
-            # establishing connection. It's required if there is no running
-            # mongodb at this time but we want to create :class:`Model`.
-            connection = Connection(*hostport, _connect=False)
-            mcs._connections[hostport] = connection
+        if isinstance(options.cache, dict):
+            options.cache = QueryCache(**options.cache)
+        if isinstance(options.write_behind, dict):
+            options.write_behind = WriteBehind(**options.write_behind)
 
         new_class._meta = options
-        new_class.connection = connection
-        new_class.database = connection[options.database]
-        new_class.collection = options.collection_class(
-            new_class.database, options.collection, document_class=new_class)
+        # Connection, database and collection are bound on first use, so
+        # that defining a model doesn't touch the network.
+        new_class.connection = _Binding('connection')
+        new_class.database = _Binding('database')
+        new_class.collection = _Binding('collection')
+        mcs._models[options.database, options.collection] = new_class
 
         if options.auto_index:
-            new_class.auto_index()   # Generating required indices.
+            # Indices are generated once the model is bound.
+            mcs._unindexed.add(new_class)
 
         return new_class
 
+    def _bind(mcs):
+        """Returns ``(pid, connection, database, collection)`` of the
+        model, binding it on first use in the current process."""
+        binding = mcs.__dict__.get('_binding')
+        if binding is None or binding[0] != os.getpid():
+            options = mcs._meta
+            connection = mcs._connect(options)
+            database = connection[options.database]
+            collection = options.collection_class(
+                database, options.collection, document_class=mcs)
+            binding = mcs._binding = \
+                os.getpid(), connection, database, collection
+
+        if mcs in mcs._unindexed:
+            # auto_index() uses the binding as well, so the model is only
+            # put back, if generating required indices fails; then they're
+            # generated again on next use.
+            mcs._unindexed.discard(mcs)
+            try:
+                mcs.auto_index()
+            except Exception:
+                mcs._unindexed.add(mcs)
+                raise
+        return binding
+
+    @classmethod
+    def _connect(mcs, options):
+        """Returns a shared connection for given model `options`."""
+        uri = options.uri or 'mongodb://%s:%s' % (options.host, options.port)
+        kwargs = dict(options.connection_options)
+        if options.max_pool_size is not None:
+            kwargs['max_pool_size'] = options.max_pool_size
+        return mcs._connections.get(uri, **kwargs)
+
     def auto_index(mcs):
-        """Builds all indices, listed in model's Meta class.
+        """Builds all missing indices, listed in model's Meta class, with
+        a single command.
 
            >>> class SomeModel(Model)
            ...     class Meta:
@@ -81,16 +144,64 @@ class ModelBase(type):
            ...             Index('foo'),
            ...         )
 
-        .. note:: this will result in calls to
-                  :meth:`pymongo.collection.Collection.ensure_index`
-                  method at import time, so import all your models up
-                  front.
+        .. note:: unless ``auto_index`` is ``False``, this is done
+                  when the model is first used.
+        """
+        mcs._unindexed.discard(mcs)
+        create_indices(mcs.collection, mcs._meta.indices)
+
+    def save_many(mcs, instances, **kwargs):
+        """Saves multiple model `instances` with bulk write operations,
+        instead of calling :meth:`Model.save` for each one.
+
+           >>> SomeModel.save_many([SomeModel(x=1), SomeModel(x=2)])
+
+        Accepts the same arguments as :meth:`Collection.save_many`.
+        Instances, which failed to save, are listed in ``writeErrors`` of
+        the raised :exc:`pymongo.errors.BulkWriteError`.
         """
-        for index in mcs._meta.indices:
-            index.ensure(mcs.collection)
+        instances = list(instances)
+        if mcs._meta.write_behind is not None:
+            mcs._meta.write_behind.flush()
+        try:
+            result = mcs.collection.save_many(instances, **kwargs)
+        except BulkWriteError as excn:
+            _mark_saved(instances, excn.details, kwargs.get('ordered'))
+            raise
+
+        _mark_saved(instances, result, kwargs.get('ordered'))
+        return result
+
+
+class _Binding(object):
+    """Lazily bound ``connection``, ``database`` or ``collection``
+    attribute of a model, see :meth:`ModelBase._bind`."""
+
+    _attrs = ('connection', 'database', 'collection')
+
+    def __init__(self, attr):
+        self.index = self._attrs.index(attr) + 1
+
+    def __get__(self, instance, owner):
+        return owner._bind()[self.index]
 
 
 class AttrDict(dict):
+    #: If ``True``, nested :class:`dict` values (including the ones stored
+    #: in lists) are converted to :class:`AttrDict` on first access and
+    #: cached, instead of being converted recursively on assignment, see
+    #: :class:`LazyAttrDict`.
+    _lazy = False
+
+    #: Keys assigned and deleted since the last time the object was in
+    #: sync with the database, or ``None`` if changes aren't tracked.
+    #: An empty tuple means that nothing has changed yet.
+    _changes = None
+
+    #: Digests of the lists, taken when the object was last in sync with
+    #: the database, since those can be modified in place.
+    _digests = None
+
     def __init__(self, initial=None, **kwargs):
         # Make sure that during initialization, that we recursively apply
         # AttrDict.  Maybe this could be better done with the builtin
@@ -107,6 +218,11 @@ class AttrDict(dict):
 
         super(AttrDict, self).__init__()
 
+    def __copy__(self):
+        # A copy isn't in sync with the database, so it shouldn't share
+        # tracked changes with the original.
+        return self.__class__(self)
+
     # These lines make this object behave both like a dict (x['y']) and like
     # an object (x.y).  We have to translate from KeyError to AttributeError
     # since model.undefined raises a KeyError and model['undefined'] raises
@@ -114,7 +230,7 @@ class AttrDict(dict):
     # 'translate' them below:
     def __getattr__(self, attr):
         try:
-            return super(AttrDict, self).__getitem__(attr)
+            return self[attr]
         except KeyError as excn:
             raise AttributeError(excn)
 
@@ -127,16 +243,214 @@ class AttrDict(dict):
 
     def __delattr__(self, key):
         try:
-            return super(AttrDict, self).__delitem__(key)
+            super(AttrDict, self).__delitem__(key)
         except KeyError as excn:
             raise AttributeError(excn)
+        self._track(key, deleted=True)
 
     def __setitem__(self, key, value):
-        # Coerce all nested dict-valued fields into AttrDicts
-        new_value = value
+        # Coerce all nested dict-valued fields into AttrDicts; in lazy
+        # mode plain dicts are left as is, until they're accessed.
         if isinstance(value, dict):
-            new_value = AttrDict(value)
-        return super(AttrDict, self).__setitem__(key, new_value)
+            if not self._lazy:
+                value = AttrDict(value)
+            elif isinstance(value, AttrDict):
+                value = LazyAttrDict(value)
+        dict.__setitem__(self, key, value)
+        if self._changes is not None:
+            self._track(key)
+
+    def __delitem__(self, key):
+        super(AttrDict, self).__delitem__(key)
+        self._track(key, deleted=True)
+
+    def _track(self, key, deleted=False):
+        """Records an assignment or a deletion of a given `key`, if
+        changes are tracked."""
+        changes = self._changes
+        if changes is None:
+            return
+        elif not changes:
+            changes = self.__dict__['_changes'] = (set(), set())
+
+        assigned, removed = changes
+        if deleted:
+            assigned.discard(key)
+            removed.add(key)
+        else:
+            removed.discard(key)
+            assigned.add(key)
+
+    def _mark_clean(self, deep=True):
+        """Starts tracking changes from scratch, assuming the object is
+        in sync with the database. If `deep` is ``True``, the same is
+        done for all of the nested :class:`AttrDict` values."""
+        digests = {}
+        for key, value in super(AttrDict, self).iteritems():
+            if isinstance(value, list):
+                digests[key] = _digest(value)
+            elif deep and isinstance(value, AttrDict):
+                value._mark_clean()
+        self.__dict__['_changes'] = ()
+        self.__dict__['_digests'] = digests
+
+    def _collect_changes(self, sets, unsets, prefix=''):
+        """Fills `sets` and `unsets` with dotted paths of the values,
+        which were assigned or deleted since the last sync."""
+        assigned, removed = self._changes or ((), ())
+        digests = self._digests or {}
+        for key in removed:
+            unsets[prefix + key] = 1
+
+        for key, value in super(AttrDict, self).iteritems():
+            if key in assigned:
+                sets[prefix + key] = value
+            elif isinstance(value, AttrDict):
+                if value._changes is None:
+                    sets[prefix + key] = value  # Not tracked as a whole.
+                else:
+                    value._collect_changes(sets, unsets, prefix + key + '.')
+            elif isinstance(value, list):
+                digest = _digest(value)
+                if digest is None or digest != digests.get(key):
+                    sets[prefix + key] = value
+
+    # The methods below bypass __setitem__ and __delitem__ in the builtin
+    # dict, so they have to be overridden as well.
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *args):
+        if key not in self:
+            return super(AttrDict, self).pop(key, *args)
+
+        value = self[key]
+        del self[key]
+        return value
+
+    def popitem(self):
+        key, value = super(AttrDict, self).popitem()
+        self._track(key, deleted=True)
+        return key, value
+
+    def clear(self):
+        for key in self.keys():
+            self._track(key, deleted=True)
+        super(AttrDict, self).clear()
+
+    def update(self, *args, **kwargs):
+        if self._changes is None:
+            return super(AttrDict, self).update(*args, **kwargs)
+
+        other = dict(*args, **kwargs)
+        super(AttrDict, self).update(other)
+        for key in other:
+            self._track(key)
+
+
+class LazyAttrDict(AttrDict):
+    """An :class:`AttrDict`, which wraps nested dicts on first access.
+
+    >>> d = LazyAttrDict({'foo': {'bar': 42}})
+    >>> type(dict.__getitem__(d, 'foo'))
+    <type 'dict'>
+    >>> d.foo.bar
+    42
+    >>> type(dict.__getitem__(d, 'foo'))
+    <class 'minimongo.model.LazyAttrDict'>
+
+    Lists are wrapped as a whole on first access, so dicts added to them
+    afterwards aren't. Models with ``lazy_nested`` or ``lazy_fields``
+    option set are :class:`LazyAttrDict` subclasses as well.
+    """
+    _lazy = True
+
+    #: Lists, which were wrapped already, by key.
+    _wrapped_lists = None
+
+    def __getitem__(self, key):
+        return self._wrap_lazily(key,
+                                 super(LazyAttrDict, self).__getitem__(key))
+
+    def _wrap_lazily(self, key, value):
+        """Wraps a raw nested `value`, stored under a given `key`, and
+        caches the result, so the conversion is only done once."""
+        if type(value) is DecodedDocument:
+            value.__class__ = LazyAttrDict  # No need to copy these.
+        elif isinstance(value, dict):
+            if isinstance(value, AttrDict):
+                return value
+            value = LazyAttrDict(value)
+            super(AttrDict, self).__setitem__(key, value)
+        elif isinstance(value, list):
+            wrapped = self._wrapped_lists
+            if wrapped is None:
+                wrapped = self.__dict__['_wrapped_lists'] = {}
+            if wrapped.get(key) is not value:
+                _wrap_list(value)
+                wrapped[key] = value
+            return value
+        else:
+            return value
+
+        if self._changes is not None:
+            # Loaded along with the object, so it's in sync as well.
+            value._mark_clean()
+        return value
+
+    # The methods below bypass __getitem__ in the builtin dict, so they
+    # have to be overridden as well.
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def itervalues(self):
+        return (self[key] for key in self)
+
+    def iteritems(self):
+        return ((key, self[key]) for key in self)
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+
+def _wrap_list(values):
+    """Wraps all dicts in a given list (and its sublists) in place."""
+    for idx, value in enumerate(values):
+        if type(value) is DecodedDocument:
+            value.__class__ = LazyAttrDict
+        elif isinstance(value, dict):
+            if not isinstance(value, AttrDict):
+                values[idx] = LazyAttrDict(value)
+        elif isinstance(value, list):
+            _wrap_list(value)
+
+
+def _digest(values):
+    """Returns a digest of the contents of a given list, or ``None`` if
+    it can't be encoded as BSON."""
+    try:
+        return hashlib.sha1(BSON.encode({'': values})).digest()
+    except (InvalidDocument, OverflowError, TypeError):
+        return None
+
+
+def _adopt_nested(value):
+    """Turns all decoded documents nested in a given `value` into
+    :class:`AttrDict` in place."""
+    if type(value) is DecodedDocument:
+        value.__class__ = AttrDict
+        for nested in dict.itervalues(value):
+            _adopt_nested(nested)
+    elif isinstance(value, list):
+        for nested in value:
+            _adopt_nested(nested)
 
 
 class Model(AttrDict):
@@ -158,29 +472,108 @@ class Model(AttrDict):
 
     __metaclass__ = ModelBase
 
+    #: Keys of the loaded fields, which field mappers weren't applied to
+    #: yet, see ``lazy_fields`` option.
+    _pending = None
+
+    #: Compiled ``field_map`` option, or ``None`` if there's none.
+    _field_mapper = None
+
+    #: Whether changes of the instances are tracked, see ``track_changes``
+    #: option; ``None`` until the model first sends a partial update.
+    _track_changes = None
+
     def __str__(self):
+        self._resolve_all()
         return '%s(%s)' % (self.__class__.__name__,
                            super(Model, self).__str__())
 
+    def __repr__(self):
+        self._resolve_all()
+        return super(Model, self).__repr__()
+
     def __unicode__(self):
         return str(self).decode('utf-8')
 
+    def __eq__(self, other):
+        self._resolve_all()
+        if isinstance(other, Model):
+            other._resolve_all()
+        return super(Model, self).__eq__(other)
+
+    def __ne__(self, other):
+        return not self == other
+
     def __setitem__(self, key, value):
-        # Go through the defined list of field mappers.  If the fild
-        # matches, then modify the field value by calling the function in
-        # the mapper.  Mapped fields must have a different type than their
-        # counterpart, otherwise they'll be mapped more than once as they
-        # come back in from a find() or find_one() call.
-        if self._meta and self._meta.field_map:
-            for matcher, mogrify in self._meta.field_map:
-                if matcher(key, value):
-                    new_value = mogrify(value)
-                    if type(new_value) == type(value):
-                        raise Exception(
-                            "Field mapper didn't change field type!")
-                    value = new_value
-
-        super(Model, self).__setitem__(key, value)
+        super(Model, self).__setitem__(key, self._map_field(key, value))
+
+    @classmethod
+    def _from_document(cls, document):
+        """Turns a :class:`~minimongo.collection.DecodedDocument` into an
+        instance of this class in place, applying field mappers once."""
+        cls._from_documents((document, ))
+        return document
+
+    @classmethod
+    def _from_documents(cls, documents):
+        """Same as :meth:`_from_document`, but for a batch of `documents`,
+        which are returned as a list."""
+        field_map = cls._meta.field_map
+        if cls._meta.lazy_fields:
+            for document in documents:
+                document.__class__ = cls
+                if field_map:
+                    document.__dict__['_pending'] = set(document)
+        elif field_map or not cls._lazy:
+            for document in documents:
+                document.__class__ = cls
+                for key, value in dict.items(document):
+                    new_value = document._map_field(key, value)
+                    if new_value is not value:
+                        AttrDict.__setitem__(document, key, new_value)
+                    elif not cls._lazy:
+                        _adopt_nested(value)
+        else:
+            for document in documents:
+                document.__class__ = cls
+        return list(documents)
+
+    def _resolve(self, key):
+        """Applies field mappers to a pending field, see
+        :attr:`_pending`."""
+        self._pending.discard(key)
+        try:
+            value = dict.__getitem__(self, key)
+        except KeyError:
+            return  # Deleted before it was ever accessed.
+
+        new_value = self._map_field(key, value)
+        if new_value is not value:
+            # Nested dicts are wrapped on access, since lazy_fields
+            # implies lazy_nested.
+            dict.__setitem__(self, key, new_value)
+
+    def _resolve_all(self):
+        """Applies field mappers to all of the pending fields."""
+        for key in list(self._pending or ()):
+            self._resolve(key)
+
+    def _map_field(self, key, value):
+        """Returns a given field `value`, modified by field mappers."""
+        if self._field_mapper is not None:
+            value = self._field_mapper(key, value)
+        return value
+
+    @classmethod
+    def _start_tracking(cls):
+        """Turns change tracking on, once a model with ``track_changes``
+        left as ``None`` sends a partial update."""
+        if cls._track_changes is None:
+            cls._track_changes = True
+
+    def _mark_clean(self, deep=True):
+        if self._track_changes:
+            super(Model, self)._mark_clean(deep)
 
     def dbref(self, with_database=True, **kwargs):
         """Returns a DBRef for the current object.
@@ -199,23 +592,84 @@ class Model(AttrDict):
 
     def remove(self):
         """Remove this object from the database."""
-        return self.collection.remove(self._id)
+        if self._meta.write_behind is not None:
+            # Buffered writes of the object mustn't bring it back.
+            self._meta.write_behind.flush()
+        with metrics.registry.timer(type(self), 'remove'):
+            result = self.collection.remove(self._id)
+        # The object is no longer in sync with the database, so there's
+        # nothing to track changes against.
+        self.__dict__.pop('_changes', None)
+        identity.forget(self)
+        return result
 
     def mongo_update(self, values=None, **kwargs):
-        """Update database data with object data."""
+        """Update database data with object data.
+
+        Unless `values` are given explicitly, only the fields assigned or
+        deleted since the object was loaded or saved are sent, as ``$set``
+        and ``$unset`` of their (possibly dotted) paths. An object, which
+        was never loaded or saved, is sent as a whole via ``$set``.
+
+        Changes of a model are tracked according to its ``track_changes``
+        option: by default, once it first sends a partial update, so the
+        objects loaded before that are sent as a whole. Lists are
+        considered changed, unless their contents are the same as when the
+        object was loaded or saved.
+
+        Models with the ``write_behind`` option set buffer the update,
+        unless there're any `kwargs`, see :mod:`minimongo.writebehind`.
+        """
         # Allow to update external values as well as the model itself
-        if not values:
-            # Remove the _id and wrap self into a $set statement.
-            self_copy = copy.copy(self)
-            del self_copy._id
-            values = {'$set': self_copy}
-        self.collection.update({'_id': self._id}, values, **kwargs)
+        tracked = not values
+        if tracked:
+            self._start_tracking()
+            values = self._get_update_document()
+            if not values:
+                return self  # Nothing to update.
+        buffer = self._meta.write_behind
+        if buffer is not None and not kwargs:
+            buffer.update(self.collection, self._id, values)
+        else:
+            if buffer is not None:
+                buffer.flush()  # Keeping the order of the writes.
+            with metrics.registry.timer(type(self), 'mongo_update'):
+                self.collection.update({'_id': self._id}, values, **kwargs)
 
+        if tracked:
+            self._mark_clean()
+            identity.remember(self)
+        else:
+            # The stored document no longer matches the object.
+            identity.forget(self)
         return self
 
     def save(self, *args, **kwargs):
-        """Save this object to it's mongo collection."""
-        self.collection.save(self, *args, **kwargs)
+        """Save this object to it's mongo collection.
+
+        If `partial` is ``True`` and the object was loaded or saved before,
+        only the changed fields are sent, see :meth:`mongo_update`.
+
+        Models with the ``write_behind`` option set buffer the save,
+        unless there're any other arguments.
+        """
+        if kwargs.pop('partial', False):
+            self._start_tracking()
+            if self._changes is not None and '_id' in self:
+                return self.mongo_update(**kwargs)
+
+        buffer = self._meta.write_behind
+        if buffer is not None and not args and not kwargs:
+            if '_id' not in self:
+                self['_id'] = ObjectId()
+            buffer.save(self.collection, self)
+        else:
+            if buffer is not None:
+                buffer.flush()
+            with metrics.registry.timer(type(self), 'save'):
+                self.collection.save(self, *args, **kwargs)
+        self._mark_clean()
+        identity.remember(self)
         return self
 
     def load(self, fields=None, **kwargs):
@@ -225,15 +679,448 @@ class Model(AttrDict):
         self.collection.find_one( self._id, fields={'name': 1} )
 
         """
-        values = self.collection.find_one({'_id': self._id},
-                                          fields=fields, **kwargs)
+        with metrics.registry.timer(type(self), 'load') as timer:
+            values = self.collection.find_one({'_id': self._id},
+                                              fields=fields, **kwargs)
+            timer.documents = int(values is not None)
         # Merge the loaded values with whatever is currently in self.
-        self.update(values)
+        # Loaded values are in sync with the database, so they aren't
+        # tracked as changes.
+        self._update_loaded(values)
+        if self._changes is not None:
+            for key, value in dict.iteritems(values):
+                if isinstance(value, list):
+                    self._digests[key] = _digest(value)
         return self
 
+    def _update_loaded(self, values):
+        """Merges `values`, loaded by :meth:`load`, into the instance;
+        the ones field mappers weren't applied to yet stay pending."""
+        dict.update(self, values)
+        if self._pending or values._pending:
+            pending = self.__dict__.setdefault('_pending', set())
+            pending.difference_update(values)
+            pending.update(values._pending or ())
+
+    def _get_update_document(self):
+        """Returns an update document with ``$set`` and ``$unset``
+        statements for the changes made since the last sync."""
+        if self._changes is None:
+            # Not tracked -- wrap the whole document into a $set statement.
+            sets = dict(dict.iteritems(self))
+            unsets = {}
+        else:
+            sets, unsets = {}, {}
+            self._collect_changes(sets, unsets)
+
+        sets.pop('_id', None)
+        unsets.pop('_id', None)
+
+        document = {}
+        if sets:
+            document['$set'] = sets
+        if unsets:
+            document['$unset'] = unsets
+        return document
+
+
+class _LazyModel(LazyAttrDict):
+    """A base of the models with ``lazy_nested`` or ``lazy_fields``
+    option set, see :meth:`ModelBase.__new__`; field mappers are applied
+    to pending fields on first access."""
+
+    def __getitem__(self, key):
+        pending = self._pending
+        if pending and key in pending:
+            self._resolve(key)
+        return super(_LazyModel, self).__getitem__(key)
+
+    def __setitem__(self, key, value):
+        pending = self._pending
+        if pending:
+            pending.discard(key)  # The new value takes precedence.
+        super(_LazyModel, self).__setitem__(key, value)
+
+
+def ensure_indices(models=None, threads=4, callback=None):
+    """Creates missing indices of given `models` in up to `threads`
+    background threads, with a single command per collection, and returns
+    :class:`multiprocessing.pool.AsyncResult`, which resolves to a list
+    of ``(collection name, created index names)`` pairs.
+
+    By default, indices of all the models, which weren't indexed yet
+    (see ``auto_index`` option), are created -- and won't be created
+    again when those models are first used:
+
+    >>> result = ensure_indices()
+    >>> serve_requests()  # Doesn't have to wait for indices.
+    >>> result.wait()
+
+    `callback`, if given, is called with the same list in a background
+    thread, once all of the indices are created. If creating indices of
+    a collection fails, its models are indexed again on first use.
+    """
+    if models is None:
+        models = list(ModelBase._unindexed)
+
+    indices = OrderedDict()
+    for model in models:
+        # Binding the model doesn't create its indices, once it's
+        # discarded; it's put back, if creating them fails.
+        ModelBase._unindexed.discard(model)
+        collection = model.collection
+        group = indices.setdefault(collection.full_name,
+                                   (collection, [], []))
+        group[1].extend(model._meta.indices)
+        group[2].append(model)
+
+    def create(group):
+        collection, indices, models = group
+        try:
+            return collection.full_name, create_indices(collection, indices)
+        except Exception:
+            ModelBase._unindexed.update(
+                model for model in models if model._meta.auto_index)
+            raise
+
+    pool = ThreadPool(max(1, min(threads, len(indices))))
+    try:
+        return pool.map_async(create, indices.values(), callback=callback)
+    finally:
+        pool.close()  # Workers exit, once the indices are created.
+
+
+def dereference(dbrefs):
+    """Dereferences an iterable of `dbrefs`, which may point to any of the
+    declared models, with a single query per collection. Documents are
+    returned in the same order as `dbrefs`, wrapped in the appropriate
+    model classes, with ``None`` for the missing ones.
+
+    >>> first, second = dereference([foo.dbref(), bar.dbref()])
+
+    .. note:: If a given DBRef points to a collection no model is declared
+              for, :exc:`ValueError` is raised. The same goes for DBRefs
+              without a database, matching several models.
+    """
+    dbrefs = list(dbrefs)
+    groups = {}
+    for idx, dbref in enumerate(dbrefs):
+        groups.setdefault(_model_for(dbref), []).append(idx)
+
+    documents = [None] * len(dbrefs)
+    for model, indices in groups.iteritems():
+        found = model.collection.from_dbrefs(dbrefs[idx] for idx in indices)
+        for idx, document in zip(indices, found):
+            documents[idx] = document
+    return documents
+
+
+def _model_for(dbref):
+    """Returns a model class a given `dbref` points to."""
+    if dbref.database:
+        models = [ModelBase._models.get((dbref.database, dbref.collection))]
+    else:
+        models = [model for (_, collection), model
+                  in ModelBase._models.iteritems()
+                  if collection == dbref.collection]
+
+    if len(models) > 1:
+        raise ValueError('DBRef matches several models: %s.' % dbref)
+    elif not models or models[0] is None:
+        raise ValueError('DBRef points to an unknown collection: %s.' % dbref)
+    return models[0]
+
+
+class CompactRecord(object):
+    """A compact representation of a loaded document of a model with
+    declared ``fields``, see :meth:`~minimongo.collection.Cursor.compact`.
+
+    Declared fields are stored in slots, the rest of them -- in an
+    overflow dict, which is only allocated if there are any. Records
+    support both item and attribute access, but aren't :class:`dict`
+    instances, don't track changes and can't be saved as is:
+
+    >>> record = SomeModel.collection.find().compact().next()
+    >>> record.x == record['x']
+    True
+    >>> model = record.to_model()
+    """
+    __slots__ = ('_overflow', )
+
+    #: Model class the record belongs to.
+    _model = None
+
+    #: Declared fields, stored in slots, and a set of them.
+    _fields = ()
+    _field_set = frozenset()
+
+    def __init__(self, initial=None, **kwargs):
+        self._overflow = None
+        if initial:
+            for key, value in initial.iteritems():
+                self[key] = value
+        for key, value in kwargs.iteritems():
+            self[key] = value
+
+    def __getattr__(self, attr):
+        # Only called, if there's no such attribute or slot is empty.
+        overflow = object.__getattribute__(self, '_overflow')
+        if overflow is None or attr not in overflow or \
+           attr in self._field_set:
+            raise AttributeError(attr)
+        return overflow[attr]
+
+    def __setattr__(self, attr, value):
+        if attr == '_overflow':
+            object.__setattr__(self, attr, value)
+        else:
+            self[attr] = value
+
+    def __delattr__(self, attr):
+        try:
+            del self[attr]
+        except KeyError as excn:
+            raise AttributeError(excn)
+
+    def __getitem__(self, key):
+        if key in self._field_set:
+            try:
+                return object.__getattribute__(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        elif self._overflow is None:
+            raise KeyError(key)
+        return self._overflow[key]
+
+    def __setitem__(self, key, value):
+        if self._model._field_mapper is not None:
+            value = self._model._field_mapper(key, value)
+        _adopt_nested(value)
+        if isinstance(value, dict) and not isinstance(value, AttrDict):
+            value = AttrDict(value)
+
+        if key in self._field_set:
+            object.__setattr__(self, key, value)
+        else:
+            if self._overflow is None:
+                self._overflow = {}
+            self._overflow[key] = value
+
+    def __delitem__(self, key):
+        if key in self._field_set:
+            try:
+                object.__delattr__(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        elif self._overflow is None:
+            raise KeyError(key)
+        else:
+            del self._overflow[key]
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    has_key = __contains__
+
+    def __iter__(self):
+        return self.iterkeys()
+
+    def __len__(self):
+        return sum(1 for _ in self.iterkeys())
+
+    def __eq__(self, other):
+        return dict(self.iteritems()) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, dict(self.iteritems()))
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def iteritems(self):
+        for key in self._fields:
+            try:
+                yield key, object.__getattribute__(self, key)
+            except AttributeError:
+                pass
+        if self._overflow is not None:
+            for item in self._overflow.iteritems():
+                yield item
+
+    def iterkeys(self):
+        for key, _ in self.iteritems():
+            yield key
+
+    def itervalues(self):
+        for _, value in self.iteritems():
+            yield value
+
+    def items(self):
+        return list(self.iteritems())
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def to_model(self):
+        """Returns a model instance with the same fields, which is
+        considered in sync with the database."""
+        model = self._model(self)
+        model._mark_clean()
+        return model
+
+    def _mark_clean(self, deep=True):
+        """Records don't track changes, so there's nothing to do."""
+
+
+def _compact_class(model, fields):
+    """Generates a :class:`CompactRecord` subclass for a given `model`,
+    storing given `fields` in slots."""
+    fields = tuple(fields)
+    clashes = [field for field in fields if hasattr(CompactRecord, field)]
+    if clashes:
+        raise Exception('Model %r declares reserved fields: %s' % (
+            model.__name__, ', '.join(clashes)))
+
+    return type(model.__name__ + 'Record', (CompactRecord, ), {
+        '__slots__': fields,
+        '__module__': model.__module__,
+        '_model': model,
+        '_fields': fields,
+        '_field_set': frozenset(fields),
+    })
+
+
+def _compile_field_map(field_map, pure=False):
+    """Returns a function, which applies mappers of a given ``field_map``
+    option to a key and a value, see :class:`_FieldMapper`."""
+    field_map = tuple(field_map)
+    if pure or any(_is_declarative(matcher) for matcher, _ in field_map):
+        return _FieldMapper(field_map, pure)
+    # There's nothing to memoise, all of the matchers have to be called.
+    return partial(_map_fields, field_map)
+
+
+def _map_fields(field_map, key, value):
+    # Go through the defined list of field mappers.  If the fild
+    # matches, then modify the field value by calling the function in
+    # the mapper.  Mapped fields must have a different type than their
+    # counterpart, otherwise they'll be mapped more than once as they
+    # come back in from a find() or find_one() call.
+    for matcher, mogrify in field_map:
+        if matcher(key, value):
+            new_value = mogrify(value)
+            if type(new_value) == type(value):
+                raise Exception("Field mapper didn't change field type!")
+            value = new_value
+    return value
+
+
+def _is_declarative(matcher):
+    return isinstance(matcher, (type, tuple))
+
+
+class _FieldMapper(object):
+    """Compiled ``field_map`` option.
+
+    Besides callables, taking a key and a value, matchers can be given as
+    a type (or a tuple of types) of values to match, or as a pair of a key
+    and a type, ex: ``('x', int)``. Whether those match is memoised per
+    key and value type, so that they aren't checked for every assigned
+    field. The same goes for callable matchers, if they're `pure`, i.e.
+    only depend on the key and the type of the value, see
+    ``field_map_pure`` option; otherwise, they're called every time.
+    """
+
+    # Memoised dispatch lists are dropped once there's that many.
+    max_memo = 10000
+
+    def __init__(self, field_map, pure=False):
+        self._field_map = tuple(field_map)
+        self._pure = pure
+        self._memo = {}
+
+    def __call__(self, key, value):
+        # Same as _map_fields(), except that the mappers, which may match,
+        # are looked up by the key and the value type.
+        mappers = self._dispatch(key, value, 0)
+        idx = 0
+        while idx < len(mappers):
+            position, matcher, mogrify = mappers[idx]
+            idx += 1
+            if matcher is None or matcher(key, value):
+                new_value = mogrify(value)
+                if type(new_value) == type(value):
+                    raise Exception("Field mapper didn't change field type!")
+                value = new_value
+                # The rest of the mappers are dispatched on the new type.
+                mappers = self._dispatch(key, value, position + 1)
+                idx = 0
+        return value
+
+    def _dispatch(self, key, value, start):
+        """Returns ``(position, matcher, mogrify)`` triples of the mappers,
+        starting from `start`, which may match a given key and the type of
+        a given value; ``matcher`` is ``None`` for the ones, which always
+        do."""
+        value_type = type(value)
+        try:
+            return self._memo[key, value_type, start]
+        except KeyError:
+            pass
+
+        mappers = []
+        for position in xrange(start, len(self._field_map)):
+            matcher, mogrify = self._field_map[position]
+            if isinstance(matcher, tuple) and matcher and \
+               isinstance(matcher[0], basestring):
+                key_matcher, matcher = matcher
+                if key_matcher == key and issubclass(value_type, matcher):
+                    mappers.append((position, None, mogrify))
+            elif _is_declarative(matcher):
+                if issubclass(value_type, matcher):
+                    mappers.append((position, None, mogrify))
+            elif not self._pure:
+                mappers.append((position, matcher, mogrify))
+            elif matcher(key, value):
+                mappers.append((position, None, mogrify))
+
+        if len(self._memo) >= self.max_memo:
+            self._memo.clear()
+        self._memo[key, value_type, start] = mappers
+        return mappers
+
 
 # Utils.
 
+def _mark_saved(instances, result, ordered):
+    """Marks `instances`, which were saved according to a given bulk
+    write `result`, as in sync with the database."""
+    failed = set(error['index'] for error in result.get('writeErrors', ()))
+    if ordered and failed:
+        # Nothing was written after the first failure.
+        instances = instances[:min(failed)]
+
+    for idx, instance in enumerate(instances):
+        if idx not in failed:
+            instance._mark_clean()
+            identity.remember(instance)
+
+
 def to_underscore(string):
     """Converts a given string from CamelCase to under_score.
 
@@ -40,6 +40,13 @@ class _Options(object):
     # Host & port of MongoDB server
     host = 'localhost'
     port = 27017
+    # MongoDB URI, ex: 'mongodb://db1,db2/?replicaSet=rs', used instead
+    # of host & port, if given.
+    uri = None
+    # Maximum number of sockets in the connection pool, None for the
+    # pymongo default, and any other Connection arguments.
+    max_pool_size = None
+    connection_options = {}
     # Indexes that should be generated for this model
     indices = ()
 
@@ -50,9 +57,46 @@ class _Options(object):
     # Should indices be created at startup?
     auto_index = True
 
+    # Should nested dicts be wrapped into AttrDicts on first access,
+    # rather than recursively when the document is constructed?
+    lazy_nested = False
+
+    # Should field mappers be applied to the fields of loaded documents
+    # on first access, rather than when the document is loaded? Implies
+    # lazy_nested.
+    lazy_fields = False
+
+    # Should changes of the objects, loaded from or saved to the database,
+    # be tracked, so that mongo_update() and save(partial=True) only send
+    # the changed fields? None means once the model first does either.
+    track_changes = None
+
     # What is the base class for Collections.
     collection_class = Collection
 
+    # Query result cache -- either a dict of QueryCache arguments, ex:
+    # {'ttl': 30, 'max_entries': 10000}, or an object with the same
+    # get(), set() and clear() methods.
+    cache = None
+
+    # Names of the fields, stored in slots of compact records, see
+    # Cursor.compact().
+    fields = ()
+
+    # Should shapes of the queries be recorded for minimongo.advisor?
+    record_queries = False
+
+    # Queries, which take longer than that many seconds, are logged by
+    # minimongo.slowlog, with explain() summaries for the given fraction
+    # of them.
+    slow_query_threshold = None
+    slow_query_explain = 0.0
+
+    # Buffered saves and updates -- either a dict of WriteBehind
+    # arguments, ex: {'max_ops': 1000, 'max_delay': 0.05}, or a
+    # WriteBehind object, see minimongo.writebehind.
+    write_behind = None
+
     # A list of tuples.  Each tuple's first element is function that will be
     # called for every __setitem__, and takes the key & value.  It should
     # return a boolean value as to whether or not the second function should
@@ -61,6 +105,11 @@ class _Options(object):
     # or dbref's that are coming in from a loaded object, etc.
     field_map = ()
 
+    # Do callable matchers of field_map only depend on the key and the
+    # type of the value? If so, whether they match is memoised per key
+    # and value type, the same way as for declarative matchers.
+    field_map_pure = False
+
     # Is this an interface (i.e. will we derive from it and declare Meta
     # properly in the subclasses.)
     interface = False
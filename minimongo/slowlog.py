@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+'''
+    minimongo.slowlog
+    ~~~~~~~~~~~~~~~~~
+
+    Logging of the queries, which took longer than the
+    ``slow_query_threshold`` of their model, with sampled ``explain()``
+    summaries. Queries are logged (and explained) on a background thread,
+    so that slow requests don't get even slower.
+'''
+import logging
+import os
+import random
+import threading
+from Queue import Queue, Full
+
+logger = logging.getLogger('minimongo.slowlog')
+
+
+class SlowQueryLog(object):
+    """Queue of slow queries, logged by a background thread, which is
+    started on first use in every process."""
+
+    def __init__(self, logger=logger, max_pending=1000):
+        self.logger = logger
+        self.max_pending = max_pending
+        self._pid = None
+        self._queue = None
+        self._lock = threading.Lock()
+
+    def add(self, cursor, duration, explain=False):
+        """Queues a `cursor`, which query took `duration` seconds, to be
+        logged, along with an ``explain()`` summary if `explain` is
+        ``True``; if there're too many queries queued already, the query
+        is dropped."""
+        meta = cursor.collection.document_class._meta
+        options = cursor.__dict__
+        record = {'model': cursor.collection.document_class.__name__,
+                  'filter': options.get('_Cursor__spec'),
+                  'projection': options.get('_Cursor__fields'),
+                  'sort': options.get('_Cursor__ordering'),
+                  'duration': duration,
+                  'threshold': meta.slow_query_threshold}
+        # Explained is a copy of the query, the cursor itself may be
+        # iterated by the time the worker gets to it.
+        explained = cursor.clone() if explain else None
+        try:
+            self._get_queue().put_nowait((record, explained))
+        except Full:
+            pass
+
+    def _get_queue(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    # Threads don't survive fork(), so a new one is needed.
+                    self._queue = Queue(self.max_pending)
+                    worker = threading.Thread(target=self._work,
+                                              args=(self._queue, ),
+                                              name='minimongo-slowlog')
+                    worker.daemon = True
+                    worker.start()
+                    self._pid = os.getpid()
+        return self._queue
+
+    def _work(self, queue):
+        while True:
+            record, explained = queue.get()
+            message = ('Slow query of %(model)s took %(duration).3fs: '
+                       'filter=%(filter)r projection=%(projection)r '
+                       'sort=%(sort)r')
+            if explained is not None:
+                try:
+                    record.update(explain_summary(explained.explain()))
+                except Exception as excn:
+                    record['explain_error'] = excn
+                    message += ' explain failed: %(explain_error)s'
+                else:
+                    message += (' plan=%(plan)s index=%(index)s '
+                                'examined=%(examined)s returned=%(returned)s')
+            self.logger.warning(message, record, extra={'query': record})
+            queue.task_done()
+
+
+#: Slow queries of all of the models.
+log = SlowQueryLog()
+
+
+def maybe_log(cursor, duration):
+    """Logs a `cursor`, which query took `duration` seconds, if it's
+    slower than the threshold of the model, see ``slow_query_threshold``
+    and ``slow_query_explain`` options of ``class Meta``."""
+    meta = getattr(cursor.collection.document_class, '_meta', None)
+    if meta is None or meta.slow_query_threshold is None or \
+       duration < meta.slow_query_threshold:
+        return
+    explain = random.random() < meta.slow_query_explain
+    log.add(cursor, duration, explain)
+
+
+def explain_summary(explanation):
+    """Returns a dict with the winning ``plan``, the ``index`` used,
+    numbers of documents ``examined`` and ``returned`` from a given
+    ``explain()`` output of either MongoDB 3.0+ or an older version."""
+    if 'queryPlanner' not in explanation:
+        cursor = explanation.get('cursor', '')
+        return {'plan': cursor,
+                'index': cursor.split(' ', 1)[1] if ' ' in cursor else None,
+                'examined': explanation.get('nscannedObjects'),
+                'returned': explanation.get('n')}
+
+    plan = explanation['queryPlanner'].get('winningPlan', {})
+    stages, index = [], None
+    while plan:
+        stages.append(plan.get('stage'))
+        index = index or plan.get('indexName')
+        plan = plan.get('inputStage')
+    stats = explanation.get('executionStats', {})
+    return {'plan': ' <- '.join(filter(None, stages)),
+            'index': index,
+            'examined': stats.get('totalDocsExamined'),
+            'returned': stats.get('nReturned')}
@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+import os
+
+from minimongo import configure
+from minimongo.memory import MemoryCollection
+
+# With MINIMONGO_TEST_BACKEND=memory the tests don't need a MongoDB server.
+if os.environ.get('MINIMONGO_TEST_BACKEND') == 'memory':
+    configure(collection_class=MemoryCollection)
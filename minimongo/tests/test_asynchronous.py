@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+from __future__ import with_statement
+
+import pytest
+
+pytest.importorskip('motor')
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+from pymongo.errors import OperationFailure
+
+from minimongo import Index
+from minimongo.asynchronous import AsyncCollection, AsyncModel
+
+
+class AsyncTestModel(AsyncModel):
+    '''Model class for asynchronous test cases.'''
+    class Meta:
+        database = 'minimongo_test'
+        collection = 'minimongo_async'
+        indices = (
+            Index('x'),
+        )
+
+
+def run_sync(func):
+    '''Runs a given coroutine function on the IO loop.'''
+    return IOLoop.current().run_sync(func)
+
+
+def setup():
+    run_sync(AsyncTestModel.collection.drop)
+
+
+def teardown():
+    run_sync(AsyncTestModel.collection.drop)
+
+
+def test_meta():
+    assert isinstance(AsyncTestModel.collection, AsyncCollection)
+    assert AsyncTestModel.collection.document_class is AsyncTestModel
+    assert AsyncTestModel.connection is \
+        AsyncTestModel.__class__._connections.get('mongodb://localhost:27017')
+
+
+def test_save_and_find():
+    @gen.coroutine
+    def check():
+        object_a = yield AsyncTestModel({'x': 1}).save()
+        object_b = yield AsyncTestModel({'x': 2}).save()
+
+        found = yield AsyncTestModel.collection.find_one(object_a._id)
+        assert isinstance(found, AsyncTestModel)
+        assert found == object_a
+
+        found.x = 3
+        yield found.save(partial=True)
+        yield object_a.load()
+        assert object_a.x == 3
+
+        cursor = AsyncTestModel.collection.find().sort('x', -1)
+        documents = []
+        while (yield cursor.fetch_next):
+            documents.append(cursor.next_object())
+        assert documents == [object_a, object_b]
+        assert all(isinstance(document, AsyncTestModel)
+                   for document in documents)
+
+        documents = yield AsyncTestModel.collection.find().to_list(10)
+        assert len(documents) == 2
+
+        yield object_b.remove()
+        found = yield AsyncTestModel.collection.find_one(object_b._id)
+        assert found is None
+
+    run_sync(check)
+
+
+def test_index_errors():
+    class UniqueAsyncModel(AsyncModel):
+        class Meta:
+            database = 'minimongo_test'
+            collection = 'minimongo_async_unique'
+            indices = (
+                Index('x', unique=True),
+            )
+
+    @gen.coroutine
+    def check():
+        duplicates = AsyncTestModel.database['minimongo_async_unique']
+        yield duplicates.insert([{'x': 1}, {'x': 1}])
+        try:
+            with pytest.raises(OperationFailure):
+                yield UniqueAsyncModel.indexed()
+            # Indices are built again once the model is used next time.
+            assert UniqueAsyncModel in UniqueAsyncModel._unindexed
+        finally:
+            yield duplicates.drop()
+
+    run_sync(check)
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+from __future__ import with_statement
+
+import datetime
+import os
+
+import pytest
+
+from minimongo import Index, Model
+from minimongo.load import _import_model, load, main
+from minimongo.memory import get_database, MemoryCollection
+
+
+class Source(Model):
+    class Meta:
+        database = 'minimongo_load'
+        collection = 'minimongo_source'
+        collection_class = MemoryCollection
+
+
+class Target(Model):
+    class Meta:
+        database = 'minimongo_load'
+        collection = 'minimongo_target'
+        collection_class = MemoryCollection
+        indices = (
+            Index('x', unique=True),
+        )
+        field_map = (
+            (('x', int), float),
+        )
+
+
+def setup_function(function):
+    get_database('minimongo_load').drop()
+    Target.auto_index()
+    for x in range(10):
+        Source({'x': x, 'created': datetime.datetime(2015, 1, 1),
+                'nested': {'y': x}}).save()
+
+
+def export(tmpdir, fmt):
+    path = str(tmpdir.join('source.' + fmt))
+    with open(path, 'wb') as fp:
+        Source.collection.export(fp, fmt=fmt)
+    return path
+
+
+@pytest.mark.parametrize('fmt', ['jsonl', 'bson'])
+@pytest.mark.parametrize('processes', [0, 2])
+def test_load(tmpdir, fmt, processes):
+    path = export(tmpdir, fmt)
+    reported = []
+    stats = load(Target, path, batch_size=3, processes=processes,
+                 writers=2, progress=reported.append)
+    assert stats['documents'] == 10 and stats['failed'] == 0
+    assert stats['offset'] == os.path.getsize(path)
+    assert [report['documents'] for report in reported] == [3, 6, 9, 10]
+
+    documents = list(Target.collection.find().sort('x'))
+    assert [document.x for document in documents] == range(10)
+    assert all(type(document.x) is float for document in documents)
+    assert documents[1].nested == {'y': 1}
+    assert documents[1].created == datetime.datetime(2015, 1, 1)
+    assert documents[1]._id == Source.collection.find_one({'x': 1})._id
+
+    # Resuming from an offset, loaded documents are reported as failed.
+    Target.collection.remove({'x': {'$gte': 6}})
+    stats = load(Target, path, batch_size=3, processes=processes,
+                 offset=reported[0]['offset'], write_concern={'w': 1})
+    assert stats['documents'] == 4 and stats['failed'] == 3
+    assert Target.collection.find().count() == 10
+
+
+def test_errors(tmpdir):
+    path = str(tmpdir.join('broken.bson'))
+    with open(export(tmpdir, 'bson'), 'rb') as source:
+        data = source.read()
+    with open(path, 'wb') as fp:
+        fp.write(data[:-5])
+    with pytest.raises(ValueError):
+        load(Target, path, processes=0)
+
+    with pytest.raises(ValueError):
+        load(Target, path, fmt='csv')
+
+
+def test_main(tmpdir, capsys):
+    path = export(tmpdir, 'jsonl')
+    assert _import_model('minimongo.tests.test_load:Target') is Target
+    assert _import_model('minimongo.tests.test_load.Target') is Target
+    assert main(['minimongo.tests.test_load:Target', path,
+                 '--processes', '0']) == 0
+    assert '10 documents loaded, 0 failed' in capsys.readouterr()[1]
+    assert Target.collection.find().count() == 10
@@ -0,0 +1,401 @@
+# -*- coding: utf-8 -*-
+from __future__ import with_statement
+
+import datetime
+import json
+import re
+import threading
+from StringIO import StringIO
+
+import pytest
+from bson import DBRef, decode_all, json_util
+
+from minimongo import Index, Model, ensure_indices
+from minimongo.memory import MemoryCollection, MemoryDatabase, \
+    get_database
+from minimongo.slowlog import explain_summary
+from pymongo.errors import BulkWriteError, DuplicateKeyError, \
+    OperationFailure
+
+
+class MemoryModel(Model):
+    '''Model class for in-memory test cases.'''
+    class Meta:
+        database = 'minimongo_memory'
+        collection = 'minimongo_memory'
+        collection_class = MemoryCollection
+        indices = (
+            Index('x'),
+            Index([('a', 1), ('b', -1)]),
+            Index('tags'),
+        )
+
+
+class MemoryModelUnique(Model):
+    class Meta:
+        database = 'minimongo_memory'
+        collection = 'minimongo_memory_unique'
+        collection_class = MemoryCollection
+        # A client, which acknowledges writes.
+        uri = 'mongodb://localhost:27017/?w=1'
+        indices = (
+            Index('x', unique=True),
+            Index('y', unique=True, sparse=True),
+        )
+
+
+def setup_function(function):
+    get_database('minimongo_memory').drop()
+    MemoryModel.auto_index()
+    MemoryModelUnique.auto_index()
+
+
+def plan(cursor):
+    summary = explain_summary(cursor.explain())
+    return summary['index'], summary['examined']
+
+
+def test_meta():
+    collection = MemoryModel.collection
+    assert isinstance(collection, MemoryCollection)
+    assert isinstance(collection.database, MemoryDatabase)
+    assert collection.database is get_database('minimongo_memory')
+    assert collection.full_name == 'minimongo_memory.minimongo_memory'
+    assert sorted(collection.index_information()) == \
+        ['_id_', 'a_1_b_-1', 'tags_1', 'x_1']
+    assert collection.index_information()['a_1_b_-1'] == \
+        {'key': [('a', 1), ('b', -1)]}
+
+
+def test_find():
+    for x in range(10):
+        MemoryModel({'x': x, 'a': x % 3, 'b': x,
+                     'tags': ['t%d' % (x % 2), 'all'],
+                     'nested': {'y': x * 10}}).save()
+    find = MemoryModel.collection.find
+
+    found = list(find({'x': {'$gte': 3, '$lt': 6}}))
+    assert [model.x for model in found] == [3, 4, 5]
+    assert all(isinstance(model, MemoryModel) for model in found)
+
+    assert [model.x for model in find({'nested.y': 40})] == [4]
+    assert [model.x for model in find({'x': {'$in': [7, 2, 11]}})] == [2, 7]
+    assert [model.x for model in find({'x': {'$nin': range(1, 10)}})] == [0]
+    assert [model.x for model in find({'$or': [{'x': 1}, {'b': 8}]})] == \
+        [1, 8]
+    assert find({'tags': 't1'}).count() == 5
+    assert find({'tags': {'$all': ['t1', 'all']}}).count() == 5
+    assert find({'tags': {'$size': 2}}).count() == 10
+    assert find({'missing': None}).count() == 10
+    assert find({'missing': {'$exists': True}}).count() == 0
+    assert find({'tags': re.compile('^t')}).count() == 10
+    assert find({'tags': {'$regex': '^T1', '$options': 'i'}}).count() == 5
+    assert find({'x': {'$not': {'$gt': 2}}}).count() == 3
+    assert find({'x': {'$mod': [4, 1]}}).count() == 3
+    # Ranges only match values of the same type.
+    assert find({'x': {'$gt': 'a'}}).count() == 0
+
+    with pytest.raises(OperationFailure):
+        find({'x': {'$unknown': 1}}).count()
+
+    assert [model.x for model in
+            find({'a': 1}).sort([('b', -1)]).skip(1).limit(2)] == [4, 1]
+    assert find().sort('x', -1)[2].x == 7
+    assert find().count() == 10
+    assert find().skip(8).count(with_limit_and_skip=True) == 2
+    assert sorted(MemoryModel.collection.distinct('a')) == [0, 1, 2]
+
+    projected = MemoryModel.collection.find_one(
+        {'x': 1}, fields={'nested.y': 1, '_id': 0})
+    assert projected == {'nested': {'y': 10}}
+    projected = MemoryModel.collection.find_one({'x': 1},
+                                                fields={'tags': 0})
+    assert 'tags' not in projected and projected.x == 1
+
+
+def test_indices():
+    for x in range(20):
+        MemoryModel({'x': x, 'a': x % 4, 'b': x, 'c': x,
+                     'tags': ['t%d' % (x % 5)]}).save()
+    find = MemoryModel.collection.find
+
+    assert plan(find({'x': 3})) == ('x_1', 1)
+    assert plan(find({'x': {'$gte': 16}})) == ('x_1', 4)
+    assert plan(find({'x': {'$in': [1, 2]}})) == ('x_1', 2)
+    assert plan(find({'a': 1, 'b': {'$lte': 9}})) == ('a_1_b_-1', 3)
+    assert plan(find({'a': 2})) == ('a_1_b_-1', 5)
+    assert plan(find({'tags': 't2'})) == ('tags_1', 4)
+    assert plan(find({'c': 3})) == (None, 20)
+    assert plan(find({'b': 3})) == (None, 20)  # Not a prefix.
+
+    # Indices are kept up to date with writes.
+    MemoryModel.collection.update({'x': 3}, {'$set': {'x': 30}})
+    assert plan(find({'x': 3})) == ('x_1', 0)
+    assert find({'x': 30}).count() == 1
+    MemoryModel.collection.remove({'x': {'$gte': 10}})
+    assert plan(find({'x': {'$gte': 0}})) == ('x_1', 9)
+
+    assert plan(find({'x': 4}).hint('a_1_b_-1')) == ('a_1_b_-1', 9)
+    with pytest.raises(OperationFailure):
+        find().hint('missing_1').count()
+
+
+def test_unique_index():
+    MemoryModelUnique({'x': 1}).save()
+    with pytest.raises(DuplicateKeyError):
+        MemoryModelUnique({'x': 1}).save()
+    # Sparse indices skip documents without the field.
+    MemoryModelUnique({'x': 2}).save()
+    MemoryModelUnique({'x': 3, 'y': 1}).save()
+    with pytest.raises(DuplicateKeyError):
+        MemoryModelUnique({'x': 4, 'y': 1}).save()
+    assert MemoryModelUnique.collection.find().count() == 3
+
+    # Unacknowledged writes don't report errors.
+    MemoryModelUnique.collection.insert({'x': 1}, w=0)
+    assert MemoryModelUnique.collection.find().count() == 3
+
+    model = MemoryModelUnique.collection.find_one({'x': 2})
+    with pytest.raises(DuplicateKeyError):
+        MemoryModelUnique.collection.insert({'_id': model._id, 'x': 5})
+    assert MemoryModelUnique.collection.find_one(model._id).x == 2
+
+    with pytest.raises(DuplicateKeyError):
+        MemoryModelUnique.collection.update({'x': 2}, {'$set': {'x': 3}})
+    assert MemoryModelUnique.collection.find({'x': 2}).count() == 1
+
+
+def test_update():
+    collection = MemoryModel.collection
+    model = MemoryModel({'x': 1, 'tags': ['a'], 'counts': {'n': 1}}).save()
+
+    result = collection.update({'x': 1}, {
+        '$inc': {'counts.n': 2, 'counts.m': 1},
+        '$push': {'tags': {'$each': ['b', 'c']}},
+        '$addToSet': {'set': 'a'},
+        '$unset': {'missing': True},
+    }, w=1)
+    assert result['n'] == 1 and result['nModified'] == 1
+    model = collection.find_one(model._id)
+    assert model.counts == {'n': 3, 'm': 1}
+    assert model.tags == ['a', 'b', 'c']
+    assert model.set == ['a']
+
+    collection.update({'_id': model._id}, {'$pull': {'tags': 'b'},
+                                           '$pop': {'tags': -1},
+                                           '$rename': {'set': 'other'}})
+    model = collection.find_one(model._id)
+    assert model.tags == ['c'] and model.other == ['a'] and 'set' not in model
+
+    # Replacements keep the _id.
+    collection.update({'_id': model._id}, {'x': 5})
+    assert collection.find_one(model._id) == {'_id': model._id, 'x': 5}
+    with pytest.raises(OperationFailure):
+        collection.update({'x': 5}, {'x': 6}, multi=True, w=1)
+
+    result = collection.update({'x': 7}, {'$set': {'y': 1}}, upsert=True,
+                               w=1)
+    upserted = collection.find_one(result['upserted'])
+    assert upserted.x == 7 and upserted.y == 1
+
+    found = collection.find_and_modify({'x': 7}, {'$inc': {'y': 1}},
+                                       new=True)
+    assert found['y'] == 2 and type(found) is dict
+    found = collection.find_and_modify({'x': 7}, remove=True)
+    assert found['y'] == 2 and collection.find_one({'x': 7}) is None
+
+    model = MemoryModel({'x': 8}).save()
+    model.x = 9
+    model.save(partial=True)
+    assert collection.find_one(model._id).x == 9
+
+
+def test_ensure_indices():
+    class IndexedMemoryModel(Model):
+        class Meta:
+            database = 'minimongo_memory'
+            collection = 'minimongo_memory_indexed'
+            collection_class = MemoryCollection
+            indices = (
+                Index('x'),
+                Index([('y', -1), ('z', 1)], unique=True),
+            )
+
+    IndexedMemoryModel({'y': 1, 'z': 1}).save()
+    assert sorted(IndexedMemoryModel.collection.index_information()) == \
+        ['_id_', 'x_1', 'y_-1_z_1']
+    assert ensure_indices([IndexedMemoryModel]).get(timeout=10) == [
+        ('minimongo_memory.minimongo_memory_indexed', [])]
+
+    IndexedMemoryModel.collection.drop()
+    assert IndexedMemoryModel.collection.index_information().keys() == \
+        ['_id_']
+    IndexedMemoryModel.auto_index()
+    assert len(IndexedMemoryModel.collection.index_information()) == 3
+
+
+def test_ensure_indices_failure():
+    class UniqueMemoryModel(Model):
+        class Meta:
+            database = 'minimongo_memory'
+            collection = 'minimongo_memory_unique'
+            collection_class = MemoryCollection
+            indices = (
+                Index('x', unique=True),
+            )
+
+    collection = MemoryCollection(get_database('minimongo_memory'),
+                                  'minimongo_memory_unique', dict)
+    collection.insert([{'x': 1}, {'x': 1}])
+
+    result = ensure_indices([UniqueMemoryModel], threads=1)
+    with pytest.raises(DuplicateKeyError):
+        result.get(timeout=10)
+    # Indices are created again on first use.
+    assert UniqueMemoryModel in UniqueMemoryModel._unindexed
+
+    collection.remove({'x': 1}, multi=False)
+    UniqueMemoryModel._bind()
+    assert UniqueMemoryModel not in UniqueMemoryModel._unindexed
+    assert 'x_1' in UniqueMemoryModel.collection.index_information()
+    collection.drop()
+
+
+def test_bulk():
+    collection = MemoryModelUnique.collection
+    bulk = collection.initialize_ordered_bulk_op()
+    bulk.insert({'x': 1})
+    bulk.find({'x': 2}).upsert().update_one({'$set': {'y': 2}})
+    bulk.find({'x': 1}).update_one({'$set': {'y': 1}})
+    bulk.find({'x': 2}).replace_one({'x': 3})
+    bulk.find({'x': 3}).remove_one()
+    result = bulk.execute()
+    assert (result['nInserted'], result['nUpserted'], result['nMatched'],
+            result['nModified'], result['nRemoved']) == (1, 1, 2, 2, 1)
+    assert result['upserted'][0]['index'] == 1
+    assert [(model.x, model.y) for model in collection.find()] == [(1, 1)]
+    with pytest.raises(ValueError):
+        bulk.find({}).update_one({'x': 1})
+
+    bulk = collection.initialize_unordered_bulk_op()
+    bulk.insert({'x': 1})
+    bulk.insert({'x': 4})
+    with pytest.raises(BulkWriteError) as excinfo:
+        bulk.execute()
+    assert excinfo.value.details['writeErrors'][0]['index'] == 0
+    assert excinfo.value.details['nInserted'] == 1
+    assert collection.find().count() == 2
+
+
+def test_export():
+    created = datetime.datetime(2015, 1, 1)
+    for x in range(5):
+        MemoryModel({'x': x, 'created': created,
+                     'ref': DBRef('other', x)}).save()
+
+    output, batches = StringIO(), []
+    assert MemoryModel.collection.export(
+        output, {'x': {'$lt': 3}}, projection={'x': 1, 'created': 1},
+        batch_size=2, progress=batches.append) == 3
+    assert batches == [2, 3]
+    lines = output.getvalue().splitlines()
+    assert len(lines) == 3
+    assert json.loads(lines[0])['created'] == {'$date': 1420070400000}
+    assert json_util.loads(lines[2])['x'] == 2
+
+    output = StringIO()
+    assert MemoryModel.collection.export(output, fmt='bson') == 5
+    documents = decode_all(output.getvalue())
+    assert [document['x'] for document in documents] == range(5)
+    assert documents[0]['ref'] == DBRef('other', 0)
+    assert type(documents[0]) is dict
+
+    with pytest.raises(ValueError):
+        MemoryModel.collection.export(output, fmt='csv')
+
+
+def count_tags(model):
+    return len(model.tags)
+
+
+def test_parallel_scan():
+    for x in range(100):
+        MemoryModel({'x': x, 'tags': ['t%d' % (x % 3)]}).save()
+    MemoryModel({'_id': 'string', 'x': 100, 'tags': []}).save()
+    collection = MemoryModel.collection
+
+    points = collection._split_points(None, 4)
+    assert len(points) == 3
+    assert [collection.find({'_id': {'$gte': low, '$lt': high}}).count()
+            for low, high in zip(points, points[1:])] == [25, 25]
+    points = collection._split_points({'tags': 't1'}, 3)
+    assert len(points) == 2
+    assert collection.find({'tags': 't1',
+                            '_id': {'$lt': points[0]}}).count() == 11
+
+    scanned = list(collection.parallel_scan(workers=4))
+    assert all(isinstance(model, MemoryModel) for model in scanned)
+    assert sorted(model.x for model in scanned) == range(101)
+
+    scanned = collection.parallel_scan({'tags': 't1'}, workers=3,
+                                       fields={'x': 1})
+    assert sorted(model.x for model in scanned) == range(1, 100, 3)
+
+    assert sum(collection.parallel_scan(workers=3,
+                                        callback=count_tags)) == 100
+    assert sum(collection.parallel_scan(workers=2, callback=count_tags,
+                                        processes=True)) == 100
+    with pytest.raises(ValueError):
+        collection.parallel_scan(processes=True)
+
+    with pytest.raises(ZeroDivisionError):
+        list(collection.parallel_scan(callback=lambda model: 1 / 0))
+
+    ids = sorted(model._id for model in collection.find({'x': {'$lt': 100}}))
+    threads = set()
+    scanned = collection.parallel_scan(
+        workers=2, split_points=ids[10::10],
+        callback=lambda model: threads.add(threading.current_thread()))
+    assert len(list(scanned)) == 101
+    assert 1 <= len(threads) <= 2
+
+
+def test_paginate():
+    for x in range(25):
+        MemoryModel({'x': x, 'a': x % 4, 'nested': {'b': x // 2}}).save()
+    paginate = MemoryModel.collection.paginate
+
+    def pages(*args, **kwargs):
+        page, token = paginate(*args, **kwargs)
+        result = [page]
+        while token is not None:
+            page, token = paginate(*args, after=token, **kwargs)
+            result.append(page)
+        return [[model.x for model in page] for page in result]
+
+    assert pages(page_size=10) == [range(10), range(10, 20), range(20, 25)]
+    assert pages(page_size=5) == [range(0, 5), range(5, 10), range(10, 15),
+                                  range(15, 20), range(20, 25)]
+    assert pages({'a': 1}, [('x', -1)], page_size=4) == \
+        [[21, 17, 13, 9], [5, 1]]
+
+    # Sort keys of the caller are left as they are.
+    sort = [('x', -1)]
+    assert pages({'a': 1}, sort, page_size=4) == [[21, 17, 13, 9], [5, 1]]
+    assert pages({'a': 1}, sort, page_size=4) == [[21, 17, 13, 9], [5, 1]]
+    assert sort == [('x', -1)]
+    assert pages({'a': 1}, (('x', -1), ), page_size=4) == \
+        [[21, 17, 13, 9], [5, 1]]
+
+    # Ties of the sort keys are broken by _id.
+    by_a = sum(pages(sort=[('a', 1), ('nested.b', -1)], page_size=3), [])
+    assert by_a == sorted(range(25), key=lambda x: (x % 4, -(x // 2), x))
+
+    page, token = paginate(page_size=25)
+    assert len(page) == 25 and token is None
+    page, token = paginate(page_size=10)
+    assert all(isinstance(model, MemoryModel) for model in page)
+    with pytest.raises(ValueError):
+        paginate(sort=[('x', -1)], after=token)
+    with pytest.raises(ValueError):
+        paginate(after='invalid')
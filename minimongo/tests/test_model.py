@@ -6,8 +6,11 @@ import operator
 import pytest
 
 from bson import DBRef
-from minimongo import Collection, Index, Model
-from pymongo.errors import DuplicateKeyError
+from minimongo import advisor, metrics
+from minimongo import Collection, IdentityMap, Index, Model, dereference, \
+    ensure_indices
+from minimongo.memory import MemoryCollection
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 
 
 class TestCollection(Collection):
@@ -23,6 +26,7 @@ class TestModel(Model):
         indices = (
             Index('x'),
         )
+        track_changes = True
 
     def a_method(self):
         self.x = 123
@@ -84,9 +88,16 @@ class TestFieldMapper(Model):
         )
 
 
+def drop_database():
+    if isinstance(TestModel.collection, MemoryCollection):
+        TestModel.collection.database.drop()
+    else:
+        TestModel.connection.drop_database(TestModel.database)
+
+
 def setup():
     # Make sure we start with a clean, empty DB.
-    TestModel.connection.drop_database(TestModel.database)
+    drop_database()
 
     # Create indices up front
     TestModel.auto_index()
@@ -95,7 +106,7 @@ def setup():
 
 def teardown():
     # This will drop the entire minimongo_test database.  Careful!
-    TestModel.connection.drop_database(TestModel.database)
+    drop_database()
 
 
 def test_meta():
@@ -199,6 +210,40 @@ def test_mongo_update():
     assert model.y == 1
 
 
+def test_mongo_update_changed_fields():
+    model = TestModel(x=1, y=1, z={'a': 1, 'b': 1}).save()
+    # Somebody else updates the same document.
+    TestModel.collection.update({'_id': model._id}, {'$set': {'y': 2}})
+
+    model.x = 2
+    model.z.a = 2
+    del model.z.b
+    model.mongo_update()
+
+    model = TestModel.collection.find_one({'_id': model._id})
+    assert model == {'_id': model._id, 'x': 2, 'y': 2, 'z': {'a': 2}}
+
+    # Nothing changed -- no update is sent.
+    assert model.mongo_update() is model
+
+
+def test_partial_save():
+    model = TestModel(x=1, y=1).save()
+    TestModel.collection.update({'_id': model._id}, {'$set': {'z': 1}})
+
+    model = TestModel.collection.find_one({'_id': model._id})
+    del model.x
+    model.y = 2
+    model.save(partial=True)
+
+    assert TestModel.collection.find_one({'_id': model._id}) == \
+           {'_id': model._id, 'y': 2, 'z': 1}
+
+    # Objects, which were never saved, are saved as a whole.
+    model = TestModel(x=1).save(partial=True)
+    assert TestModel.collection.find_one({'_id': model._id}) == model
+
+
 def test_load():
     """Partial loading of documents.x"""
     # object_a and object_b are 2 instances of the same document
@@ -237,12 +282,63 @@ def test_load_and_field_mapper():
     assert object_b.y == 1
 
 
+def test_load_lazy_fields():
+    class LazyFieldMapper(Model):
+        class Meta:
+            database = 'minimongo_test'
+            collection = 'minimongo_lazy_mapper'
+            lazy_fields = True
+            field_map = (
+                (lambda k, v: k == 'x' and isinstance(v, int), float),
+            )
+
+    _id = LazyFieldMapper.collection.insert({'x': 1, 'y': {'z': 2}})
+    model = LazyFieldMapper(_id=_id)
+
+    # Loaded fields are mapped on access, the same as found ones.
+    model.load(fields={'x': 1})
+    assert model.x == 1.0 and type(model.x) is float
+    model.load()
+    assert type(model.x) is float
+    assert model.y.z == 2
+    assert model == {'_id': _id, 'x': 1.0, 'y': {'z': 2}}
+
+    LazyFieldMapper.collection.drop()
+
+
 def test_index_existance():
     '''Test that indexes were created properly.'''
     indices = TestModel.collection.index_information()
     assert indices['x_1'] == {'key': [('x', 1)]}
 
 
+def test_ensure_indices():
+    class IndexedModel(Model):
+        class Meta:
+            database = 'minimongo_test'
+            collection = 'minimongo_indexed'
+            indices = (
+                Index('x'),
+                Index([('y', -1), ('z', 1)], unique=True),
+            )
+
+    assert IndexedModel in IndexedModel._unindexed
+    callbacks = []
+    result = ensure_indices([IndexedModel], callback=callbacks.append)
+    created = [('minimongo_test.minimongo_indexed', ['x_1', 'y_-1_z_1'])]
+    assert result.get(timeout=10) == created
+    assert callbacks == [created]
+    assert IndexedModel not in IndexedModel._unindexed
+
+    indices = IndexedModel.collection.index_information()
+    assert indices['y_-1_z_1']['unique']
+
+    # Existing indices aren't created again.
+    result = ensure_indices([IndexedModel])
+    assert result.get(timeout=10) == [
+        ('minimongo_test.minimongo_indexed', [])]
+
+
 def test_unique_index():
     '''Test behavior of indices with unique=True'''
     # This will work (y is undefined)
@@ -260,6 +356,46 @@ def test_unique_index():
     assert TestModelUnique.collection.find().count() == 2
 
 
+def test_save_many():
+    TestModel.collection.remove()
+    existing = TestModel(x=1).save()
+    existing.x = 2
+    models = [existing] + [TestModel(x=x) for x in range(3, 8)]
+
+    result = TestModel.save_many(models, batch_size=2)
+    assert result['nInserted'] == 5
+    assert result['nUpserted'] + result['nMatched'] == 1
+
+    assert all('_id' in model for model in models)
+    assert TestModel.collection.find().count() == 6
+    assert TestModel.collection.find_one({'_id': existing._id}).x == 2
+    for model in models:
+        assert TestModel.collection.find_one(model._id) == model
+
+
+def test_save_many_errors():
+    TestModelUnique.collection.remove()
+    TestModelUnique(x=1).save()
+    models = [TestModelUnique(x=x) for x in (0, 1, 2, 1, 3)]
+
+    with pytest.raises(BulkWriteError) as excinfo:
+        TestModelUnique.save_many(models, batch_size=2)
+
+    errors = excinfo.value.details['writeErrors']
+    assert [error['index'] for error in errors] == [1, 3]
+    assert TestModelUnique.collection.find().count() == 4
+
+    # Ordered writes stop at the first failure.
+    models = [TestModelUnique(x=x) for x in (4, 0, 5)]
+    with pytest.raises(BulkWriteError) as excinfo:
+        TestModelUnique.save_many(models, ordered=True)
+
+    errors = excinfo.value.details['writeErrors']
+    assert [error['index'] for error in errors] == [1]
+    assert TestModelUnique.collection.find_one({'x': 5}) is None
+    TestModelUnique.collection.remove()
+
+
 def test_unique_constraint():
     x1_a = TestModelUnique({'x': 1, 'y': 1})
     x1_b = TestModelUnique({'x': 1, 'y': 2})
@@ -446,6 +582,268 @@ def test_dbref():
     assert ref_a.name == 'foo'
 
 
+def test_from_dbrefs():
+    object_a = TestModel({'x': 1, 'y': 997}).save()
+    object_b = TestModel({'x': 1, 'y': 998}).save()
+    missing = TestModel({'x': 1, 'y': 999}).dbref()
+
+    found = TestModel.collection.from_dbrefs(
+        [object_b.dbref(), missing, object_a.dbref(with_database=False),
+         object_b.dbref()])
+    assert found == [object_b, None, object_a, object_b]
+    assert all(isinstance(obj, TestModel) for obj in found if obj)
+
+    # Documents are valid ids, even though they aren't hashable.
+    object_c = TestModel({'_id': {'a': 1, 'b': 2}, 'x': 1}).save()
+    found = TestModel.collection.from_dbrefs(
+        [object_c.dbref(), object_a.dbref(), object_c.dbref()])
+    assert found == [object_c, object_a, object_c]
+
+    assert TestModel.collection.from_dbrefs([]) == []
+    with pytest.raises(ValueError):
+        TestModel.collection.from_dbrefs([DBRef('foo', object_a._id)])
+
+
+def test_dereference():
+    object_a = TestModel({'x': 1}).save()
+    object_b = TestDerivedModel({'x': 2}).save()
+    missing = TestDerivedModel({'x': 3}).dbref()
+
+    found = dereference([object_b.dbref(), object_a.dbref(), missing,
+                         object_a.dbref(with_database=False)])
+    assert found == [object_b, object_a, None, object_a]
+    assert type(found[0]) is TestDerivedModel
+    assert type(found[1]) is TestModel
+
+    with pytest.raises(ValueError):
+        dereference([DBRef('foo', object_a._id, 'minimongo_test')])
+
+
+def test_identity_map():
+    with IdentityMap() as documents:
+        # Saved objects are remembered as well.
+        object_a = TestModel({'x': 1}).save()
+        ref_a = object_a.dbref()
+        assert TestModel.collection.find_one(object_a._id) is object_a
+
+        documents.clear()
+        found = TestModel.collection.find_one(object_a._id)
+        assert found == object_a and found is not object_a
+        assert TestModel.collection.find_one({'_id': object_a._id}) is found
+        assert TestModel.collection.from_dbref(ref_a) is found
+        assert TestModel.collection.from_dbrefs([ref_a]) == [found]
+        assert TestModel.collection.from_dbrefs([ref_a])[0] is found
+
+        # Partial loads and arbitrary queries aren't cached.
+        assert TestModel.collection.find_one(
+            object_a._id, fields={'x': 1}) is not found
+        assert TestModel.collection.find_one({'x': 1}) is not found
+
+        # Explicit updates make the cached object stale.
+        found.mongo_update({'$inc': {'x': 1}})
+        found = TestModel.collection.find_one(object_a._id)
+        assert found.x == 2
+
+        found.remove()
+        assert TestModel.collection.find_one(object_a._id) is None
+
+    object_b = TestModel({'x': 1}).save()
+    assert TestModel.collection.find_one(object_b._id) is not object_b
+
+
+def test_query_cache():
+    class CachedModel(Model):
+        class Meta:
+            database = 'minimongo_test'
+            collection = 'minimongo_cached'
+            cache = {'ttl': 60}
+
+    CachedModel.collection.remove()
+    object_a = CachedModel({'x': 1}).save()
+    cache = CachedModel.collection.cache
+
+    assert list(CachedModel.collection.find({'x': 1})) == [object_a]
+    assert CachedModel.collection.find({'x': 1}).count() == 1
+    assert len(cache) == 2
+
+    # Hits decode a fresh instance every time.
+    cached = list(CachedModel.collection.find({'x': 1}))
+    assert cached == [object_a] and cached[0] is not object_a
+    assert isinstance(cached[0], CachedModel)
+
+    # Incomplete reads aren't cached.
+    next(CachedModel.collection.find({'x': {'$gt': 0}}))
+    assert len(cache) == 2
+
+    # Writes invalidate the cache.
+    CachedModel({'x': 1}).save()
+    assert len(cache) == 0
+    assert CachedModel.collection.find({'x': 1}).count() == 2
+
+    # Neither do the ones, which were running during a write.
+    cache.clear()
+    cursor = CachedModel.collection.find({'x': 1})
+    next(cursor)
+    CachedModel({'x': 1}).save()
+    assert len(list(cursor)) == 1
+    assert len(cache) == 0
+    assert len(list(CachedModel.collection.find({'x': 1}))) == 3
+
+    # Results, which are too large, aren't cached.
+    cache.clear()
+    cache.max_result_size = 50
+    assert len(list(CachedModel.collection.find({'x': 1}))) == 3
+    assert len(cache) == 0
+    assert len(list(CachedModel.collection.find({'x': 1}).limit(1))) == 1
+    assert len(cache) == 1
+
+    CachedModel.collection.drop()
+
+
+def test_query_cache_find_one(monkeypatch):
+    class CachedModel(Model):
+        class Meta:
+            database = 'minimongo_test'
+            collection = 'minimongo_cached'
+            cache = {'ttl': 60}
+
+    collection = CachedModel.collection
+    collection.remove()
+    object_a = CachedModel({'x': 1}).save()
+
+    fetched = []
+    fetch_one = collection._fetch_one
+
+    def counting_fetch_one(*args, **kwargs):
+        fetched.append(args)
+        return fetch_one(*args, **kwargs)
+    monkeypatch.setattr(collection, '_fetch_one', counting_fetch_one)
+
+    assert collection.find_one(object_a._id) == object_a
+    found = collection.find_one(object_a._id)
+    assert found == object_a and found is not object_a
+    assert isinstance(found, CachedModel)
+    assert len(fetched) == 1
+
+    # Lookups, which found nothing, are cached as well.
+    assert collection.find_one({'x': 2}) is None
+    assert collection.find_one({'x': 2}) is None
+    assert len(fetched) == 2
+
+    # Writes invalidate the cache.
+    collection.update({'_id': object_a._id}, {'$set': {'x': 2}})
+    assert collection.find_one({'x': 2}) == dict(object_a, x=2)
+    assert collection.find_one(object_a._id).x == 2
+    assert len(fetched) == 4
+
+    collection.drop()
+
+
+def test_batches():
+    TestModel.collection.remove()
+    for x in range(5):
+        TestModel({'x': x}).save()
+
+    batches = list(TestModel.collection.find().sort('x').batches(2))
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+    assert [model.x for batch in batches for model in batch] == range(5)
+    assert all(isinstance(model, TestModel)
+               for batch in batches for model in batch)
+
+    # Batches continue from where iteration stopped.
+    cursor = TestModel.collection.find().sort('x')
+    next(cursor)
+    assert [len(batch) for batch in cursor.batches(3)] == [3, 1]
+
+    with pytest.raises(ValueError):
+        next(TestModel.collection.find().batches(0))
+
+
+def test_compact():
+    class CompactModel(Model):
+        class Meta:
+            database = 'minimongo_test'
+            collection = 'minimongo_compact'
+            fields = ('_id', 'x')
+
+    CompactModel.collection.remove()
+    object_a = CompactModel({'x': 1, 'y': 2}).save()
+
+    record, = CompactModel.collection.find().compact()
+    assert isinstance(record, CompactModel._compact_class)
+    assert record == object_a
+    assert record.x == 1 and record.y == 2
+
+    with pytest.raises(ValueError):
+        TestModel.collection.find().compact()
+
+
+def test_record_queries():
+    class RecordedModel(Model):
+        class Meta:
+            database = 'minimongo_test'
+            collection = 'minimongo_recorded'
+            record_queries = True
+
+    advisor.recorder.clear()
+    object_a = RecordedModel({'x': 1}).save()
+    list(RecordedModel.collection.find({'x': {'$gt': 0}}).sort('y'))
+    RecordedModel.collection.find_one(object_a._id)
+    object_a.remove()
+    TestModel.collection.find_one()  # Not recorded.
+
+    shapes = [(shape['operation'], shape['equality'], shape['sort'],
+               shape['range']) for shape in advisor.recorder.shapes()]
+    assert sorted(shapes) == [
+        ('find', (), (('y', 1), ), ('x', )),
+        ('find', ('_id', ), (), ()),
+        ('remove', ('_id', ), (), ()),
+    ]
+    advice = advisor.advise([RecordedModel])
+    assert [keys for _, keys, _ in advice['missing']] == [[('y', 1), ('x', 1)]]
+    advisor.recorder.clear()
+
+
+def test_metrics():
+    metrics.registry.clear()
+    object_a = TestModel({'x': 1}).save()
+    TestModel.collection.find_one(object_a._id)
+    TestModel.collection.from_dbref(object_a.dbref())
+    object_a.load()
+    object_a.x = 2
+    object_a.mongo_update()
+    list(TestModel.collection.find({'x': 2}))
+    object_a.remove()
+
+    snapshot = metrics.registry.snapshot()
+    for operation in ('save', 'find_one', 'from_dbref', 'load',
+                      'mongo_update', 'find', 'remove'):
+        assert snapshot[TestModel, operation]['count'] >= 1
+    # Lookups of single documents aren't counted as cursor queries.
+    assert snapshot[TestModel, 'find']['count'] == 1
+    assert snapshot[TestModel, 'from_dbref']['documents'] == 1
+    assert 'model="TestModel",operation="save"' in \
+        metrics.registry.exposition()
+
+
+
+def test_parallel_scan():
+    TestModel.collection.remove()
+    for x in range(100):
+        TestModel({'x': x}).save()
+
+    points = TestModel.collection._split_points(None, 4)
+    assert 3 <= len(points) <= 4
+    assert points == sorted(points)
+    points = TestModel.collection._split_points({'x': {'$lt': 50}}, 2)
+    below = TestModel.collection.find({'x': {'$lt': 50},
+                                       '_id': {'$lt': points[0]}})
+    assert below.count() == 25
+
+    scanned = TestModel.collection.parallel_scan(workers=4)
+    assert sorted(model.x for model in scanned) == range(100)
+    TestModel.collection.remove()
+
 def test_db_and_collection_names():
     '''Test the methods that return the current class's DB and
     Collection names.'''
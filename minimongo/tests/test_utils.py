@@ -1,11 +1,24 @@
 # -*- coding: utf-8 -*-
+import copy
+import logging
 from types import ModuleType
 
 import pytest
 
-from minimongo import Model, configure, AttrDict
+from bson import BSON
+from bson.son import SON
+from minimongo import Collection, Index, Model, configure, AttrDict, \
+    LazyAttrDict, CompactRecord, IdentityMap, QueryCache
+from minimongo import connections, identity, slowlog
+from minimongo.advisor import QueryRecorder, advise, query_shape, report
+from minimongo.collection import DecodedDocument, _freeze, _id_of, _wrap, \
+    _wrap_many
+from minimongo.connections import ConnectionRegistry
+from minimongo.metrics import Metrics
+from minimongo.slowlog import SlowQueryLog, explain_summary
 from minimongo.options import _Options
-from minimongo.model import to_underscore
+from minimongo.model import _FieldMapper, to_underscore
+from pymongo.errors import AutoReconnect
 
 
 def test_nometa():
@@ -176,6 +189,630 @@ def test_attr_dict_from_dict():
     assert attr_dict['b']['d']['e'] == 3
 
 
+def test_lazy_attr_dict():
+    d = LazyAttrDict({'a': 1,
+                      'b': {'c': {'d': 2}},
+                      'l': [{'e': 3}, [{'f': 4}], 5]})
+
+    # Nothing is wrapped until accessed.
+    assert type(dict.__getitem__(d, 'b')) is dict
+    assert type(dict.__getitem__(d, 'l')[0]) is dict
+
+    assert d.b.c.d == d['b']['c']['d'] == 2
+    assert isinstance(d.b, AttrDict)
+    assert d.b is d['b']  # Wrapped values are cached.
+    assert d.l[0].e == 3
+    assert d.l[1][0].f == 4
+    assert d.l[2] == 5
+    # Lists are only wrapped once, unless replaced.
+    d.l.append({'g': 6})
+    assert type(d.l[3]) is dict
+    d.l = [{'g': 6}]
+    assert d.l[0].g == 6
+
+    assert isinstance(d.get('b'), AttrDict)
+    assert d.get('missing', 42) == 42
+    assert all(isinstance(v, AttrDict) for v in d.itervalues()
+               if isinstance(v, dict))
+    assert d == {'a': 1, 'b': {'c': {'d': 2}}, 'l': [{'g': 6}]}
+
+    e = LazyAttrDict({'x': {'y': 1}})
+    assert isinstance(e.pop('x'), AttrDict)
+    assert e == {}
+
+
+def test_lazy_nested_model():
+    class LazyModel(Model):
+        class Meta:
+            database = 'test'
+            lazy_nested = True
+            track_changes = True
+
+    model = LazyModel({'x': {'y': 1}})
+    assert type(dict.__getitem__(model, 'x')) is dict
+    assert model.x.y == 1
+    assert isinstance(dict.__getitem__(model, 'x'), AttrDict)
+
+    model.z = AttrDict({'w': 2})
+    assert model.z.w == 2
+
+    # Only lazy models override the builtin accessors of dict.
+    assert isinstance(model, LazyAttrDict)
+    assert AttrDict.__getitem__ is Model.__getitem__ is dict.__getitem__
+    assert AttrDict.get is dict.get
+
+    # Nested dicts are tracked once they're wrapped.
+    model = LazyModel({'_id': 1, 'x': {'y': 1}, 'l': [{'y': 1}]})
+    model._mark_clean()
+    model.x.y = 2
+    model.l[0].y = 2
+    assert model._get_update_document() == {
+        '$set': {'x.y': 2, 'l': [{'y': 2}]}}
+
+
+def test_lazy_fields():
+    calls = []
+
+    def to_float(value):
+        calls.append(value)
+        return float(value)
+
+    class LazyModel(Model):
+        class Meta:
+            database = 'test'
+            lazy_fields = True
+            field_map = (
+                (lambda k, v: isinstance(v, int), to_float),
+            )
+
+    data = BSON.encode({'x': 1, 'y': 2, 'z': 3, 'w': {'a': 4}})
+    model = LazyModel._from_document(BSON(data).decode(DecodedDocument))
+
+    assert not calls
+    assert type(dict.__getitem__(model, 'x')) is int
+    assert model.x == 1.0 and type(model.x) is float
+    assert model['x'] == 1.0
+    assert calls == [1]  # Mapped values are cached.
+
+    model.y = 5  # Assigned values take precedence over the loaded ones.
+    assert model.y == 5.0
+    del model.z
+    assert 'z' not in model
+
+    assert isinstance(model.w, AttrDict)
+    assert model.w.a == 4  # Nested fields aren't mapped.
+    assert model == {'x': 1.0, 'y': 5.0, 'w': {'a': 4}}
+    assert calls == [1, 5]
+
+
+def test_change_tracking():
+    class TrackedModel(Model):
+        class Meta:
+            database = 'test'
+            track_changes = True
+
+    model = TrackedModel({'_id': 1, 'x': 1, 'y': 2,
+                          'sub': {'a': 1, 'b': {'c': 2}}, 'l': [1],
+                          'm': [{'n': 1}]})
+    # Never loaded or saved -- the whole document is updated.
+    assert model._get_update_document() == {
+        '$set': {'x': 1, 'y': 2, 'sub': {'a': 1, 'b': {'c': 2}}, 'l': [1],
+                 'm': [{'n': 1}]}}
+
+    model._mark_clean()
+    assert model._get_update_document() == {}
+
+    model.x = 2
+    del model.y
+    model.sub.b.c = 3
+    del model['sub']['a']
+    model.z = {'w': 1}
+    assert model._get_update_document() == {
+        '$set': {'x': 2, 'sub.b.c': 3, 'z': {'w': 1}},
+        '$unset': {'y': 1, 'sub.a': 1}}
+
+    model._mark_clean()
+    assert model.l == [1] and model.m[0]['n'] == 1  # Reads aren't changes.
+    assert model._get_update_document() == {}
+    model.l.append(2)
+    model.m[0]['n'] = 2
+    model.pop('x')
+    assert model._get_update_document() == {
+        '$set': {'l': [1, 2], 'm': [{'n': 2}]}, '$unset': {'x': 1}}
+
+    # Copies aren't in sync with the database.
+    assert copy.copy(model)._changes is None
+
+    # By default, changes are tracked once a model sends a partial update.
+    class UntrackedModel(Model):
+        class Meta:
+            database = 'test'
+
+    model = UntrackedModel({'_id': 1, 'x': 1})
+    model._mark_clean()
+    model.x = 2
+    assert model._changes is None
+    UntrackedModel._start_tracking()
+    model._mark_clean()
+    model.y = 1
+    assert model._get_update_document() == {'$set': {'y': 1}}
+
+
+def test_decode_in_place():
+    class MappedModel(Model):
+        class Meta:
+            database = 'test'
+            field_map = (
+                (lambda k, v: k == 'x' and isinstance(v, int),
+                 lambda v: float(v)),
+            )
+            track_changes = True
+
+    class CustomModel(MappedModel):
+        class Meta:
+            database = 'test'
+
+        def __setitem__(self, key, value):
+            super(CustomModel, self).__setitem__(key, value)
+
+    assert MappedModel._decode_in_place
+    assert not CustomModel._decode_in_place
+
+    data = BSON.encode({'x': 1, 'y': {'x': 2, 'z': {}}, 'l': [{'x': 3}]})
+    document = BSON(data).decode(DecodedDocument)
+    model = MappedModel._from_document(document)
+
+    assert model is document
+    assert type(model) is MappedModel
+    assert model == {'x': 1.0, 'y': {'x': 2, 'z': {}}, 'l': [{'x': 3}]}
+    assert type(model.x) is float
+    assert type(model.y.x) is int  # Nested fields aren't mapped.
+    assert type(model.y) is type(model.y.z) is type(model.l[0]) is AttrDict
+
+    batch = [BSON(data).decode(DecodedDocument) for _ in range(3)]
+    models = _wrap_many(MappedModel, batch)
+    assert models == batch and models[0] is batch[0]
+    assert all(type(model) is MappedModel for model in models)
+    assert all(type(model.x) is float for model in models)
+    assert all(model._changes == () for model in models)
+
+    models = _wrap_many(CustomModel, [{'x': 1}, {'x': 2}])
+    assert all(type(model) is CustomModel for model in models)
+    assert [model.x for model in models] == [1, 2]
+
+
+def test_compiled_field_map():
+    calls = []
+
+    def is_small(key, value):
+        calls.append(key)
+        return isinstance(value, float) and value < 10
+
+    class MappedModel(Model):
+        class Meta:
+            database = 'test'
+            field_map = (
+                (('x', int), lambda v: float(v)),
+                (float, lambda v: str(v)),
+                (is_small, lambda v: int(v)),
+                ((list, tuple), lambda v: set(v)),
+            )
+
+    class UnmappedModel(MappedModel):
+        class Meta:
+            database = 'test'
+
+    model = MappedModel(x=1, y=2.5, z=[1], w=u'1')
+    assert model == {'x': '1.0', 'y': '2.5', 'z': set([1]), 'w': u'1'}
+    # Callable matchers are called for every field, though.
+    assert sorted(calls) == ['w', 'x', 'y', 'z']
+
+    model.y = 3.0
+    assert model.y == '3.0'
+
+    # Key matchers are dispatched on the value type too, so loaded values
+    # aren't mapped again.
+    model = MappedModel(x='1.0')
+    assert model.x == '1.0'
+    assert UnmappedModel(x=1).x == 1
+
+    class CallableModel(Model):
+        class Meta:
+            database = 'test'
+            field_map = (
+                (is_small, lambda v: int(v)),
+            )
+
+    model = CallableModel(a=1.0, b=11.0)
+    assert model == {'a': 1, 'b': 11.0}
+    assert not isinstance(CallableModel._field_mapper, _FieldMapper)
+
+    class PureModel(Model):
+        class Meta:
+            database = 'test'
+            field_map = (
+                (lambda k, v: calls.append(k) or isinstance(v, float),
+                 lambda v: int(v)),
+            )
+            field_map_pure = True
+
+    del calls[:]
+    model = PureModel(a=1.0, b=2.0)
+    model.a = 3.0
+    assert model == {'a': 3, 'b': 2}
+    assert sorted(calls) == ['a', 'b']  # Once per key and value type.
+
+    class BrokenModel(Model):
+        class Meta:
+            database = 'test'
+            field_map = (
+                (int, lambda v: v + 1),
+            )
+
+    with pytest.raises(Exception):
+        BrokenModel(x=1)
+
+
+def test_compact_record():
+    class CompactModel(Model):
+        class Meta:
+            database = 'test'
+            fields = ('_id', 'x', 'y')
+            track_changes = True
+            field_map = (
+                (('y', int), lambda v: float(v)),
+            )
+
+    record_class = CompactModel._compact_class
+    assert issubclass(record_class, CompactRecord)
+    data = BSON.encode({'_id': 1, 'x': {'a': 1}, 'y': 2, 'z': [{'b': 2}]})
+    record = _wrap(record_class, BSON(data).decode(DecodedDocument))
+
+    assert not hasattr(record, '__dict__')
+    assert record == {'_id': 1, 'x': {'a': 1}, 'y': 2.0, 'z': [{'b': 2}]}
+    assert record.keys() == ['_id', 'x', 'y', 'z']
+    assert len(record) == 4
+    assert type(record.y) is float
+    assert record.x.a == record['x']['a'] == 1
+    assert record.z[0].b == 2
+    assert type(record.x) is type(record.z[0]) is AttrDict
+
+    record.w = 3
+    assert record['w'] == 3 and 'w' in record
+    del record.x
+    assert 'x' not in record and record.get('x') is None
+    with pytest.raises(KeyError):
+        record['x']
+    with pytest.raises(AttributeError):
+        record.x
+    with pytest.raises(AttributeError):
+        del record.missing
+
+    model = record.to_model()
+    assert type(model) is CompactModel
+    assert model == record
+    assert model._changes == ()
+
+    record = record_class(x=1)
+    assert record._overflow is None  # Nothing to overflow.
+
+    with pytest.raises(Exception):
+        class ReservedModel(Model):
+            class Meta:
+                database = 'test'
+                fields = ('keys', )
+
+
+def test_connection_registry():
+    created = []
+
+    def factory(uri, **options):
+        created.append((uri, options))
+        return object()
+
+    registry = ConnectionRegistry(factory)
+    first = registry.get('mongodb://localhost', max_pool_size=10)
+    assert registry.get('mongodb://localhost', max_pool_size=10) is first
+    assert registry.get('mongodb://localhost', max_pool_size=5) is not first
+    assert registry.get('mongodb://localhost') is not first
+    assert created[0] == ('mongodb://localhost', {'max_pool_size': 10})
+
+    stats = registry.stats()
+    assert stats['connections'] == len(registry) == 3
+    assert stats['lookups'] == 4
+    assert stats['wait_time'] >= 0
+
+    # Pretend the process was forked.
+    registry._pid = -1
+    assert registry.get('mongodb://localhost', max_pool_size=10) is not first
+    assert registry.stats()['connections'] == 1
+
+    class URIModel(Model):
+        class Meta:
+            database = 'test'
+            uri = 'mongodb://localhost:27017/?w=1'
+            max_pool_size = 7
+            auto_index = False
+
+    assert URIModel.connection.max_pool_size == 7
+    assert URIModel.connection is connections.registry.get(
+        'mongodb://localhost:27017/?w=1', max_pool_size=7)
+
+
+def test_lazy_binding():
+    class LazyModel(Model):
+        class Meta:
+            database = 'test'
+            indices = (Index('x'), )
+            collection_class = Collection
+
+    assert '_binding' not in LazyModel.__dict__
+    assert LazyModel in LazyModel._unindexed
+
+    ensured = []
+    LazyModel.auto_index = staticmethod(lambda: ensured.append(LazyModel))
+    collection = LazyModel.collection
+    assert ensured == [LazyModel]
+    assert LazyModel not in LazyModel._unindexed
+    assert collection.document_class is LazyModel
+    assert collection.database is LazyModel.database
+    assert LazyModel.database.connection is LazyModel.connection
+    assert LazyModel().collection is collection
+
+    # Pretend the process was forked.
+    LazyModel._binding = (-1, ) + LazyModel._binding[1:]
+    assert LazyModel.collection is not collection
+    assert ensured == [LazyModel]
+
+
+def test_lazy_binding_retries_indices():
+    class RetriedModel(Model):
+        class Meta:
+            database = 'test'
+            indices = (Index('x'), )
+            collection_class = Collection
+
+    attempts = []
+
+    def auto_index():
+        attempts.append(RetriedModel)
+        if len(attempts) == 1:
+            raise AutoReconnect('not reachable')
+    RetriedModel.auto_index = staticmethod(auto_index)
+
+    with pytest.raises(AutoReconnect):
+        RetriedModel.collection
+    assert RetriedModel in RetriedModel._unindexed
+
+    # Indices are generated again on next use, then never again.
+    RetriedModel.collection
+    RetriedModel.collection
+    assert len(attempts) == 2
+    assert RetriedModel not in RetriedModel._unindexed
+
+
+def test_index_document():
+    assert Index('x').document() == {'key': {'x': 1}, 'name': 'x_1'}
+    document = Index([('x', 1), ('y', -1)], unique=True, drop_dups=True,
+                     cache_for=60).document()
+    assert document == {'key': SON([('x', 1), ('y', -1)]),
+                        'name': 'x_1_y_-1', 'unique': True, 'dropDups': True}
+    assert Index('x', name='foo').document()['name'] == 'foo'
+
+
+def test_query_shape():
+    assert query_shape({'a': 1, 'b': {'$gt': 1}, 'c': {'$in': [1]}},
+                       SON([('d', -1)])) == \
+        (('a', 'c'), (('d', -1), ), ('b', ))
+    assert query_shape({'$and': [{'a': {'x': 1}}, {'b': {'$ne': 1}}],
+                        '$or': [{'c': 1}]}) == (('a', ), (), ('b', ))
+    assert query_shape(42) == (('_id', ), (), ())
+    assert query_shape(None) == ((), (), ())
+
+
+def test_advise():
+    class AdvisedModel(Model):
+        class Meta:
+            database = 'test'
+            indices = (
+                Index([('a', 1), ('d', -1)]),
+                Index('unused'),
+            )
+
+    recorder = QueryRecorder()
+    recorder.record(AdvisedModel, 'find', {'a': 1}, [('d', 1)], 0.1)
+    recorder.record(AdvisedModel, 'find', {'a': 1, 'b': {'$gt': 1}},
+                    [('c', 1)], 0.2)
+    recorder.record(AdvisedModel, 'find', {'a': 1, 'b': {'$gt': 2}},
+                    [('c', 1)], 0.3)
+    recorder.record(AdvisedModel, 'update', {'_id': 1}, None, 0.1)
+    recorder.record(AdvisedModel, 'remove', None, None, 0.1)
+
+    shapes = recorder.shapes(AdvisedModel)
+    assert len(shapes) == 4
+    assert shapes[0]['count'] == 2
+    assert abs(shapes[0]['time'] - 0.5) < 1e-9
+
+    advice = advise([AdvisedModel, Model], recorder)
+    assert advice['missing'] == [
+        (AdvisedModel, [('a', 1), ('c', 1), ('b', 1)], shapes[0])]
+    assert [index for _, index in advice['unused']] == \
+        [AdvisedModel._meta.indices[1]]
+    assert 'missing index' in report([AdvisedModel], recorder)
+
+    recorder.clear()
+    assert advise([AdvisedModel], recorder) == {'missing': [], 'unused': []}
+
+
+def test_metrics():
+    class MeasuredModel(Model):
+        class Meta:
+            database = 'test'
+
+    registry = Metrics(buckets=(0.01, 0.1))
+    registry.observe(MeasuredModel, 'find', 0.005, 10)
+    registry.observe(MeasuredModel, 'find', 0.05, 5)
+    registry.observe(MeasuredModel, 'find', 1.0)
+    with registry.timer(MeasuredModel, 'save') as timer:
+        timer.documents = 1
+
+    snapshot = registry.snapshot()
+    assert snapshot[MeasuredModel, 'find'] == {
+        'count': 3, 'time': 1.055, 'documents': 15,
+        'buckets': [(0.01, 1), (0.1, 2)]}
+    assert snapshot[MeasuredModel, 'save']['count'] == 1
+
+    text = registry.exposition()
+    assert '# TYPE minimongo_operation_duration_seconds histogram' in text
+    assert 'minimongo_operation_duration_seconds_bucket{model=' \
+        '"MeasuredModel",operation="find",le="0.1"} 2' in text
+    assert 'minimongo_operation_duration_seconds_bucket{model=' \
+        '"MeasuredModel",operation="find",le="+Inf"} 3' in text
+    assert 'minimongo_operation_duration_seconds_count{model="MeasuredModel"' \
+        ',operation="find"} 3' in text
+    assert 'minimongo_documents_total{model="MeasuredModel",' \
+        'operation="find"} 15' in text
+
+    registry.clear()
+    assert registry.snapshot() == {}
+
+
+def test_explain_summary():
+    assert explain_summary({'cursor': 'BtreeCursor x_1', 'n': 2,
+                            'nscannedObjects': 10}) == {
+        'plan': 'BtreeCursor x_1', 'index': 'x_1',
+        'examined': 10, 'returned': 2}
+    assert explain_summary({
+        'queryPlanner': {'winningPlan': {
+            'stage': 'FETCH',
+            'inputStage': {'stage': 'IXSCAN', 'indexName': 'x_1'}}},
+        'executionStats': {'nReturned': 2, 'totalDocsExamined': 10}}) == {
+        'plan': 'FETCH <- IXSCAN', 'index': 'x_1',
+        'examined': 10, 'returned': 2}
+
+
+def test_slow_query_log():
+    class SlowModel(Model):
+        class Meta:
+            database = 'test'
+            slow_query_threshold = 0.1
+            slow_query_explain = 1.0
+
+    class FakeCursor(object):
+        collection = type('FakeCollection', (object, ),
+                          {'document_class': SlowModel})()
+
+        def __init__(self):
+            self._Cursor__spec = {'x': 1}
+
+        def clone(self):
+            return self
+
+        def explain(self):
+            return {'cursor': 'BasicCursor', 'n': 1, 'nscannedObjects': 5}
+
+    records = []
+    handler = logging.Handler()
+    handler.emit = records.append
+    test_logger = logging.getLogger('minimongo.tests.slowlog')
+    test_logger.addHandler(handler)
+    original = slowlog.log
+    slowlog.log = SlowQueryLog(test_logger)
+    try:
+        slowlog.maybe_log(FakeCursor(), 0.01)  # Fast enough.
+        slowlog.maybe_log(FakeCursor(), 0.5)
+        slowlog.log._queue.join()
+    finally:
+        slowlog.log = original
+        test_logger.removeHandler(handler)
+
+    record, = records
+    assert record.query['model'] == 'SlowModel'
+    assert record.query['filter'] == {'x': 1}
+    assert record.query['examined'] == 5
+    assert 'took 0.500s' in record.getMessage()
+    assert 'plan=BasicCursor' in record.getMessage()
+
+
+def test_identity_map():
+    class MappedModel(Model):
+        class Meta:
+            database = 'test'
+
+    model = MappedModel(_id=1)
+    assert identity.current() is None
+    identity.remember(model)  # No-op outside of a scope.
+
+    with IdentityMap() as outer:
+        assert identity.current() is outer
+        identity.remember(model)
+        assert outer.get(MappedModel, 1) is model
+        assert outer.get(Model, 1) is None
+        assert outer.get(MappedModel, {'unhashable': 1}) is None
+
+        with IdentityMap() as inner:
+            assert identity.current() is inner
+            assert inner.get(MappedModel, 1) is None
+
+        assert identity.current() is outer
+        identity.forget(model)
+        assert outer.get(MappedModel, 1) is None
+
+    assert identity.current() is None
+
+    assert _id_of(42) == 42
+    assert _id_of({'_id': 42}) == 42
+    assert _id_of({'_id': {'$gt': 42}}) is None
+    assert _id_of({'_id': 42, 'x': 1}) is None
+    assert _id_of(None) is None
+
+
+def test_query_cache():
+    now = [0]
+    cache = QueryCache(ttl=10, max_entries=2, timer=lambda: now[0])
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    assert cache.get('missing') is None
+
+    # 'b' is the least recently used entry now.
+    cache.set('c', 3)
+    assert len(cache) == 2
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+
+    now[0] = 11
+    assert cache.get('a') is None
+    cache.set('a', 1)
+    assert cache.get('a') == 1
+
+    # Values read before the cache was cleared aren't stored.
+    generation = cache.generation
+    cache.clear()
+    assert len(cache) == 0
+    cache.set('a', 1, generation)
+    assert cache.get('a') is None
+    cache.set('a', 1, cache.generation)
+    assert cache.get('a') == 1
+
+    class CachedModel(Model):
+        class Meta:
+            database = 'test'
+            cache = {'ttl': 5}
+
+    assert isinstance(CachedModel._meta.cache, QueryCache)
+    assert CachedModel._meta.cache.ttl == 5
+    assert CachedModel.collection.cache is CachedModel._meta.cache
+
+
+def test_freeze():
+    assert _freeze({'a': 1, 'b': [1, {'c': 2}]}) == \
+        _freeze({'b': [1, {'c': 2}], 'a': 1})
+    assert _freeze(SON([('a', 1), ('b', 2)])) != \
+        _freeze(SON([('b', 2), ('a', 1)]))
+    assert _freeze({'a': [1]}) != _freeze({'a': 1})
+    hash(_freeze({'a': set([1])}))
+
 
 class AttrDictDerived(AttrDict):
 
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+from __future__ import with_statement
+
+import time
+
+import pytest
+
+from minimongo import Index, Model, WriteBehind
+from minimongo.memory import get_database, MemoryCollection
+from minimongo.writebehind import BufferFull
+
+
+class BufferedModel(Model):
+    class Meta:
+        database = 'minimongo_writebehind'
+        collection = 'minimongo_buffered'
+        collection_class = MemoryCollection
+        # Only flushed explicitly, unless a test says otherwise.
+        write_behind = {'max_ops': 1000, 'max_delay': 60}
+        track_changes = True
+
+
+class BufferedModelUnique(Model):
+    class Meta:
+        database = 'minimongo_writebehind'
+        collection = 'minimongo_buffered_unique'
+        collection_class = MemoryCollection
+        uri = 'mongodb://localhost:27017/?w=1'
+        indices = (
+            Index('x', unique=True),
+        )
+        write_behind = {'max_ops': 1000, 'max_delay': 60}
+
+
+def setup_function(function):
+    BufferedModel._meta.write_behind.flush()
+    get_database('minimongo_writebehind').drop()
+    BufferedModelUnique.auto_index()
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def test_save():
+    buffer = BufferedModel._meta.write_behind
+    assert isinstance(buffer, WriteBehind)
+
+    model = BufferedModel({'x': 1, 'nested': {'y': 1}}).save()
+    assert '_id' in model and len(buffer) == 1
+    assert BufferedModel.collection.find().count() == 0
+
+    # Buffered documents are copies.
+    model.nested.y = 2
+    assert buffer.flush() == 0 and len(buffer) == 0
+    assert BufferedModel.collection.find_one(model._id) == \
+        {'_id': model._id, 'x': 1, 'nested': {'y': 1}}
+
+
+def test_merge():
+    buffer = BufferedModel._meta.write_behind
+    model = BufferedModel({'x': 1, 'nested': {'y': 1, 'z': 1}}).save()
+    model.x = 2
+    del model.nested.z
+    model.save(partial=True)
+    model.nested.y = 3
+    model.save(partial=True)
+    assert len(buffer) == 1  # Merged into the buffered replacement.
+
+    other = BufferedModel({'x': 10}).save()
+    buffer.flush()
+    other.x = 11
+    other.save(partial=True)
+    other.y = 12
+    other.save(partial=True)
+    assert len(buffer) == 1  # Merged into the buffered update.
+    # Other update operators aren't merged, but keep the order.
+    other.mongo_update({'$inc': {'x': 1}})
+    other.x = 20
+    other.save(partial=True)
+    assert len(buffer) == 3
+
+    buffer.flush()
+    find_one = BufferedModel.collection.find_one
+    assert find_one(model._id) == {'_id': model._id, 'x': 2,
+                                   'nested': {'y': 3}}
+    assert find_one(other._id) == {'_id': other._id, 'x': 20, 'y': 12}
+
+
+def test_merge_into_arrays():
+    buffer = BufferedModel._meta.write_behind
+    model = BufferedModel({'a': [1, 2, 3]}).save()
+    # Array elements can't be unset in the buffered replacement, so the
+    # update is buffered on its own; later updates are merged into it.
+    model.mongo_update({'$unset': {'a.1': 1}})
+    model.mongo_update({'$set': {'a.2': 4}})
+    assert len(buffer) == 2
+
+    buffer.flush()
+    assert BufferedModel.collection.find_one(model._id) == \
+        {'_id': model._id, 'a': [1, None, 4]}
+
+
+def test_background_flush():
+    buffer = WriteBehind(max_ops=3, max_delay=60)
+    BufferedModel._meta.write_behind = buffer
+    try:
+        for x in range(2):
+            BufferedModel({'x': x}).save()
+        time.sleep(0.1)
+        assert len(buffer) == 2
+        BufferedModel({'x': 2}).save()
+        wait_for(lambda: BufferedModel.collection.find().count() == 3)
+
+        buffer.max_delay = 0.01
+        BufferedModel({'x': 3}).save()
+        wait_for(lambda: BufferedModel.collection.find().count() == 4)
+    finally:
+        BufferedModel._meta.write_behind = \
+            WriteBehind(max_ops=1000, max_delay=60)
+
+
+def test_backpressure():
+    buffer = WriteBehind(max_ops=1000, max_delay=60, max_pending=2,
+                         timeout=0.05)
+    BufferedModel._meta.write_behind = buffer
+    try:
+        with buffer._sending:  # Nothing can be sent meanwhile.
+            BufferedModel({'x': 1}).save()
+            BufferedModel({'x': 2}).save()
+            with pytest.raises(BufferFull):
+                BufferedModel({'x': 3}).save()
+        # Waits for the buffer to be flushed, if it's full.
+        buffer.timeout = None
+        BufferedModel({'x': 4}).save()
+        BufferedModel({'x': 5}).save()
+        buffer.flush()
+        assert sorted(model.x for model in BufferedModel.collection.find()) \
+            == [1, 2, 4, 5]
+    finally:
+        BufferedModel._meta.write_behind = \
+            WriteBehind(max_ops=1000, max_delay=60)
+
+
+def test_errors():
+    buffer = BufferedModelUnique._meta.write_behind
+    BufferedModelUnique({'x': 1}).save()
+    BufferedModelUnique({'x': 1}).save()
+    BufferedModelUnique({'x': 2}).save()
+    # The rest of the writes are sent after a failed one.
+    assert buffer.flush() == 1
+    assert sorted(model.x for model in
+                  BufferedModelUnique.collection.find()) == [1, 2]
+
+
+def test_unbuffered():
+    buffer = BufferedModel._meta.write_behind
+    model = BufferedModel({'x': 1}).save()
+    # Writes with options, and removals, are sent right away, after the
+    # buffered ones.
+    model.x = 2
+    model.save(w=1)
+    assert len(buffer) == 0
+    assert BufferedModel.collection.find_one(model._id).x == 2
+
+    model.x = 3
+    model.save()
+    model.remove()
+    assert len(buffer) == 0
+    assert BufferedModel.collection.find().count() == 0
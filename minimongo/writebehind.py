@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+'''
+    minimongo.writebehind
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Buffering of saves and updates of the models with ``write_behind``
+    option set: instead of a round trip per write, they're queued and
+    sent as ordered bulk writes by a background thread, once there're
+    ``max_ops`` of them, or ``max_delay`` seconds after the oldest one was
+    queued. Repeated saves and updates of the same document are merged.
+
+    Buffered writes trade durability for throughput: they're lost if the
+    process dies, their errors are only logged, and reads don't see them
+    until they're sent, see :meth:`WriteBehind.flush`.
+'''
+import atexit
+import logging
+import operator
+import os
+import threading
+import time
+from itertools import groupby
+
+from bson import BSON
+from pymongo.errors import BulkWriteError
+
+from minimongo import metrics
+
+logger = logging.getLogger('minimongo.writebehind')
+
+# Update operators, which buffered updates of a document can be merged by.
+MERGEABLE_OPERATORS = frozenset(['$set', '$unset'])
+
+
+class BufferFull(Exception):
+    """Raised if a write couldn't be buffered within the ``timeout``."""
+
+
+class WriteBehind(object):
+    """A buffer of writes, see ``write_behind`` option of ``class Meta``.
+
+    >>> class Reading(Model):
+    ...     class Meta:
+    ...         database = 'telemetry'
+    ...         write_behind = {'max_ops': 1000, 'max_delay': 0.05}
+    ...
+    >>> Reading(sensor=1, value=42).save()  # Returns right away.
+    {'sensor': 1, 'value': 42, '_id': ObjectId('...')}
+    >>> Reading._meta.write_behind.flush()  # Sends the buffered writes.
+    0
+
+    Once `max_pending` writes are buffered, the ones that follow block
+    until the buffer is flushed, or raise :exc:`BufferFull` after
+    `timeout` seconds, if given. Bulk writes are sent with a given
+    `write_concern`, or the one of the collection.
+
+    Pending writes are flushed at exit; after :func:`os.fork` they are
+    only sent by the parent process.
+    """
+
+    def __init__(self, max_ops=1000, max_delay=0.05, max_pending=10000,
+                 timeout=None, write_concern=None):
+        self.max_ops = max_ops
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.write_concern = write_concern
+        self._pid = None
+        self._registered = False
+        self._check_fork()
+
+    def __len__(self):
+        return len(self._operations) if self._pid == os.getpid() else 0
+
+    def save(self, collection, document):
+        """Buffers a save of a given `document`, which must have an
+        ``_id``, to a given `collection`."""
+        self._add(collection, document['_id'],
+                  BSON.encode(document, True).decode(), True)
+
+    def update(self, collection, _id, update):
+        """Buffers an update of a document with a given `_id` in a given
+        `collection`."""
+        self._add(collection, _id, BSON.encode(update).decode(), False)
+
+    def flush(self):
+        """Sends all of the buffered writes right away, returns the number
+        of the ones, which failed (they're logged)."""
+        self._check_fork()
+        with self._sending:
+            with self._condition:
+                operations = self._operations
+                self._clear()
+                self._condition.notify_all()  # There's room for more.
+            return self._send(operations)
+
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            # Locks might have been held by threads, which don't exist in
+            # this process, and writes are flushed by the parent.
+            self._pid = os.getpid()
+            self._condition = threading.Condition()
+            self._sending = threading.Lock()
+            self._worker = None
+            self._clear()
+
+    def _clear(self):
+        self._operations = []  # [collection, _id, document, replace]
+        self._latest = {}      # By (collection name, _id).
+        self._oldest = None    # When the first of the operations was added.
+
+    def _add(self, collection, _id, document, replace):
+        self._check_fork()
+        try:
+            key = collection.full_name, _id
+            hash(key)
+        except TypeError:
+            key = None  # Writes with unhashable ids aren't merged.
+
+        deadline = None if self.timeout is None else \
+            time.time() + self.timeout
+        with self._condition:
+            if self._worker is None:
+                self._start()
+
+            latest = self._latest.get(key)
+            if latest is not None and _merge(latest, document, replace):
+                return
+
+            while len(self._operations) >= self.max_pending:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise BufferFull('%d writes are pending' %
+                                         len(self._operations))
+                self._condition.notify_all()  # Hurry the worker up.
+                self._condition.wait(remaining)
+
+            operation = [collection, _id, document, replace]
+            self._operations.append(operation)
+            if key is not None:
+                self._latest[key] = operation
+            if self._oldest is None:
+                self._oldest = time.time()
+                self._condition.notify_all()
+            elif len(self._operations) >= \
+                    min(self.max_ops, self.max_pending):
+                self._condition.notify_all()
+
+    def _start(self):
+        self._worker = threading.Thread(target=self._work,
+                                        name='minimongo-writebehind')
+        self._worker.daemon = True
+        self._worker.start()
+        if not self._registered:
+            atexit.register(self.flush)
+            self._registered = True
+
+    def _work(self):
+        condition = self._condition
+        while True:
+            with condition:
+                while True:
+                    remaining = None
+                    if self._operations:
+                        remaining = self._oldest + self.max_delay - \
+                            time.time()
+                        if remaining <= 0 or len(self._operations) >= \
+                           min(self.max_ops, self.max_pending):
+                            break
+                    condition.wait(remaining)
+            self.flush()
+
+    def _send(self, operations):
+        """Sends given operations as ordered bulk writes, one per
+        collection, returns the number of the failed ones."""
+        failed = 0
+        for collection, batch in groupby(operations, operator.itemgetter(0)):
+            batch = list(batch)
+            model = collection.document_class
+            while batch:
+                collection._invalidate_cache()
+                bulk = collection.initialize_ordered_bulk_op()
+                for _, _id, document, replace in batch:
+                    if replace:
+                        bulk.find({'_id': _id}).upsert().replace_one(document)
+                    else:
+                        bulk.find({'_id': _id}).update_one(document)
+
+                try:
+                    with metrics.registry.timer(model, 'write_behind'):
+                        bulk.execute(self.write_concern)
+                except BulkWriteError as excn:
+                    errors = excn.details.get('writeErrors')
+                    logger.error('Buffered writes of %s failed: %s',
+                                 model.__name__, excn.details)
+                    if not errors:
+                        break  # Write concern errors -- all were applied.
+                    failed += 1
+                    # Ordered writes stop on the first error.
+                    batch = batch[errors[0]['index'] + 1:]
+                except Exception:
+                    logger.exception('%d buffered writes of %s failed',
+                                     len(batch), model.__name__)
+                    failed += len(batch)
+                    break
+                else:
+                    break
+        return failed
+
+
+def _merge(operation, document, replace):
+    """Merges a write of a `document` (either a replacement or an update)
+    into a buffered `operation` of the same document, if possible."""
+    if replace:
+        operation[2:] = document, True  # Overrides whatever was there.
+        return True
+    if not _is_mergeable(document):
+        return False
+
+    if operation[3]:
+        # An update of a buffered replacement is applied to it, unless
+        # it goes into values, which aren't documents, ex: arrays.
+        replacement = operation[2]
+        paths = document.get('$set', {}).keys() + \
+            document.get('$unset', {}).keys()
+        if not all(_settable(replacement, path) for path in paths):
+            return False
+        for path, value in document.get('$set', {}).iteritems():
+            _set(replacement, path, value)
+        for path in document.get('$unset', ()):
+            _unset(replacement, path)
+        return True
+
+    update = operation[2]
+    if not _is_mergeable(update):
+        return False
+    paths = update.get('$set', {}).keys() + update.get('$unset', {}).keys()
+    new_paths = document.get('$set', {}).keys() + \
+        document.get('$unset', {}).keys()
+    if any(new.startswith(path + '.') for new in new_paths
+           for path in paths):
+        return False  # Nested into an earlier one, can't be replaced.
+
+    for name in MERGEABLE_OPERATORS:
+        fields = update.get(name)
+        if not fields:
+            continue
+        for path in list(fields):
+            if any(path == new or path.startswith(new + '.')
+                   for new in new_paths):
+                del fields[path]  # Overridden.
+        if not fields:
+            del update[name]
+    for name, fields in document.iteritems():
+        update.setdefault(name, {}).update(fields)
+    return True
+
+
+def _is_mergeable(update):
+    return MERGEABLE_OPERATORS.issuperset(update) and \
+        not any('$' in path for fields in update.itervalues()
+                for path in fields)
+
+
+def _settable(document, path):
+    """Checks whether a dotted `path` can be set in a given `document`
+    without replacing values, which aren't documents."""
+    value = document
+    for part in path.split('.')[:-1]:
+        if part not in value:
+            return True
+        value = value[part]
+        if not isinstance(value, dict):
+            return False
+    return True
+
+
+def _set(document, path, value):
+    parts = path.split('.')
+    for part in parts[:-1]:
+        document = document.setdefault(part, {})
+    document[parts[-1]] = value
+
+
+def _unset(document, path):
+    parts = path.split('.')
+    for part in parts[:-1]:
+        document = document.get(part)
+        if not isinstance(document, dict):
+            return
+    document.pop(parts[-1], None)
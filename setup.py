@@ -48,7 +48,7 @@ setup(name="minimongo",
       cmdclass={"test": PyTest},
       platforms=["any"],
 
-      install_requires = ["pymongo>=1.9"],
+      install_requires = ["pymongo>=2.7,<3.0"],
       zip_safe=False,
       include_package_data=True,
 